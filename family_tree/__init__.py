@@ -15,9 +15,10 @@ from flask_migrate import Migrate
 from sqlalchemy import text
 
 from family_tree.config import Config
+from family_tree.routing import RoutingSession, init_replicas
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 migrate = Migrate()
@@ -30,6 +31,7 @@ def create_app(config_class = Config):
 
     # Initialize extensions with app
     db.init_app(app)
+    init_replicas(app)
     bcrypt.init_app(app)
     login_manager.init_app(app)
     migrate.init_app(app, db)
@@ -42,8 +44,9 @@ def create_app(config_class = Config):
     # User loader function
     @login_manager.user_loader
     def load_user(user_id):
+        from family_tree.cursor import Cursor
         from family_tree.models import User
-        return User.query.get(int(user_id))
+        return Cursor().prepared(db, 'user_by_id', User, id=int(user_id)).first()
 
     # Import models so they are registered with SQLAlchemy
     from family_tree.models import (
@@ -55,9 +58,40 @@ def create_app(config_class = Config):
         ImportantDates,
         ContactDetails,
         RelativesTypeEnum,
-        Relatives
+        Relatives,
+        AncestryClosure,
+        PersonDirectory,
+        GraphVersion,
+        TableVersion
     )
 
+    # person_directory, the SQLite name search index and the typeahead name
+    # index follow every flush
+    from family_tree.services.directory import init_directory
+    init_directory(db)
+    from family_tree.services.search import init_search
+    init_search(db)
+    from family_tree.name_index import init_name_index
+    init_name_index(db)
+
+    # Every write to Relatives bumps graph_version so that each process
+    # notices when its kinship graph is out of date
+    from family_tree.graph import init_graph
+    init_graph(db)
+
+    # Opt-in read-through cache for cursor.query(..., cache=True)
+    from family_tree.query_cache import init_query_cache
+    init_query_cache(app, db)
+
+    # Worker threads for cursor.gather(), created once here so that
+    # concurrent requests never race to create them
+    from family_tree.cursor import init_read_executor
+    init_read_executor(app)
+
+    # Server-Timing header and N+1 warnings for every request
+    from family_tree.sql_stats import init_sql_stats
+    init_sql_stats(app)
+
     # Register blueprints
     from family_tree.routes.common import bp as common_bp
     app.register_blueprint(common_bp)
@@ -66,6 +100,10 @@ def create_app(config_class = Config):
     from family_tree.routes.admin import bp as admin_bp
     app.register_blueprint(admin_bp)
 
+    # Register CLI commands
+    from family_tree.commands import register_commands
+    register_commands(app)
+
     return app
 
 def init_logging(app):
@@ -0,0 +1,141 @@
+"""
+Disjoint-set (union-find) index of connected family components.
+
+Unions are applied as relations are added. Removing a relation can split a
+component, which union-find cannot undo, so removals only mark the index
+dirty and it is rebuilt in one batch from the kinship graph on the next read.
+The graph resets the index when it reloads because Relatives changed in
+another process, and the rebuild interval bounds how long anything else can
+leave it behind.
+"""
+import threading
+import time
+
+from flask import current_app as app
+
+from family_tree.graph import current_graph, get_graph
+
+# Seconds after which the index is rebuilt from the graph even without a removal
+DEFAULT_REBUILD_INTERVAL = 3600
+
+
+class FamilyClusters:
+    def __init__(self, rebuild_interval=DEFAULT_REBUILD_INTERVAL):
+        self.rebuild_interval = rebuild_interval
+        self.dirty = True
+        self.built_at = None
+        # Reentrant since union() and components() call find()
+        self._lock = threading.RLock()
+        self._parent = {}
+        self._size = {}
+        self._components = None
+
+    def find(self, user_id):
+        with self._lock:
+            parent = self._parent
+            if user_id not in parent:
+                return user_id
+            while parent[user_id] != user_id:
+                # Path halving
+                parent[user_id] = parent[parent[user_id]]
+                user_id = parent[user_id]
+            return user_id
+
+    def union(self, user_id, other_user_id):
+        with self._lock:
+            for member in (user_id, other_user_id):
+                if member not in self._parent:
+                    self._parent[member] = member
+                    self._size[member] = 1
+            root, other_root = self.find(user_id), self.find(other_user_id)
+            if root == other_root:
+                return root
+            if self._size[root] < self._size[other_root]:
+                root, other_root = other_root, root
+            self._parent[other_root] = root
+            self._size[root] += self._size.pop(other_root)
+            self._components = None
+            return root
+
+    def rebuild(self, graph):
+        """
+        Recompute every component from the kinship graph in one pass.
+        """
+        # Relations added while the graph is read wait on the lock, so none
+        # is lost when the index is marked clean
+        with self._lock:
+            self._parent = {}
+            self._size = {}
+            self._components = None
+            for user_id in graph.user_ids():
+                for relative_user_id in graph.neighbours(user_id):
+                    self.union(user_id, relative_user_id)
+            self.dirty = False
+            self.built_at = time.monotonic()
+        app.logger.info(f'Rebuilt family clusters: {len(self._size)} components')
+
+    def stale(self):
+        if self.dirty or self.built_at is None:
+            return True
+        return (self.rebuild_interval is not None
+                and time.monotonic() - self.built_at > self.rebuild_interval)
+
+    # Graph listener interface
+    def edge_added(self, user_id, relative_user_id):
+        with self._lock:
+            if not self.dirty:
+                self.union(user_id, relative_user_id)
+
+    def edge_removed(self, user_id, relative_user_id):
+        with self._lock:
+            self.dirty = True
+
+    def user_removed(self, user_id):
+        with self._lock:
+            self.dirty = True
+
+    def reset(self):
+        with self._lock:
+            self.dirty = True
+
+    def same_family(self, user_id, other_user_id):
+        return user_id == other_user_id or self.find(user_id) == self.find(other_user_id)
+
+    def component_size(self, user_id):
+        with self._lock:
+            return self._size.get(self.find(user_id), 1)
+
+    def components(self):
+        """
+        Return {root_id: sorted member ids} for every component with relations.
+        """
+        with self._lock:
+            if self._components is None:
+                components = {}
+                for user_id in self._parent:
+                    components.setdefault(self.find(user_id), []).append(user_id)
+                for members in components.values():
+                    members.sort()
+                self._components = components
+            return self._components
+
+    def component(self, user_id):
+        return self.components().get(self.find(user_id), [user_id])
+
+
+def get_clusters(db):
+    """
+    Return the family cluster index of the current app, rebuilding it first
+    if a relation was removed, the graph was reloaded or the rebuild interval
+    has passed.
+    """
+    # Sync the graph first so a reload resets the index before it is read
+    graph = get_graph(db)
+    clusters = app.extensions.get('family_clusters')
+    if clusters is None:
+        clusters = app.extensions['family_clusters'] = FamilyClusters(
+            app.config.get('FAMILY_CLUSTER_REBUILD_INTERVAL', DEFAULT_REBUILD_INTERVAL))
+        current_graph().listeners.append(clusters)
+    if clusters.stale():
+        clusters.rebuild(graph)
+    return clusters
@@ -0,0 +1,62 @@
+import click
+
+from family_tree import db
+
+
+def register_commands(app):
+    @app.cli.command('rebuild-closure')
+    def rebuild_closure_command():
+        """Rebuild the ancestry closure table from Relatives."""
+        from family_tree.models import AncestryClosure, Relatives
+        from family_tree.services.closure import rebuild_closure
+
+        count = rebuild_closure(db, AncestryClosure, Relatives)
+        click.echo(f'Rebuilt ancestry closure with {count} rows.')
+
+    @app.cli.command('invalidate-graph')
+    def invalidate_graph_command():
+        """Make every worker reload its kinship graph from Relatives."""
+        from family_tree.graph import invalidate_graphs
+
+        invalidate_graphs(db)
+        click.echo('Kinship graphs will be reloaded on their next use.')
+
+    @app.cli.command('rebuild-generations')
+    def rebuild_generations_command():
+        """Recompute every person's generation from Relatives."""
+        from family_tree.models import Person, Relatives
+        from family_tree.services.generation import rebuild_generations
+
+        count = rebuild_generations(db, Person, Relatives)
+        click.echo(f'Updated the generation of {count} people.')
+
+    @app.cli.command('rebuild-directory')
+    def rebuild_directory_command():
+        """Rebuild the person directory from Person and Picture."""
+        from family_tree.models import Person, PersonDirectory, Picture
+        from family_tree.services.directory import rebuild_directory
+
+        count = rebuild_directory(db, PersonDirectory, Person, Picture)
+        click.echo(f'Rebuilt person directory with {count} rows.')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the SQLite name search index from Person."""
+        from family_tree.models import Person
+        from family_tree.services.search import rebuild_search_index
+
+        count = rebuild_search_index(db, Person)
+        click.echo(f'Indexed {count} people for name search.')
+
+    @app.cli.command('audit-relatives')
+    def audit_relatives_command():
+        """Check the whole Relatives table for cycles and contradictions."""
+        from family_tree.models import AncestryClosure, ImportantDates, Person, Relatives
+        from family_tree.services.audit import audit_relatives
+
+        issues = audit_relatives(db, Relatives, Person, AncestryClosure, ImportantDates)
+        for issue in issues:
+            click.echo(f"[{issue['issue']}] {issue['detail']}")
+        click.echo(f'{len(issues)} issue(s) found.')
+        if issues:
+            raise SystemExit(1)
@@ -1,6 +1,8 @@
 import os
 from dotenv import load_dotenv
 
+from family_tree.pool_stats import TimedQueuePool
+
 load_dotenv()
 
 class Config:
@@ -13,5 +15,34 @@ class Config:
     uri = f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
     SQLALCHEMY_DATABASE_URI = f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-
-
+    # Shared by the primary and the replicas; the pool settings apply per worker process
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        'query_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500)),
+    }
+    # Comma separated read replica URIs; cursor.query() reads from them
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv('DB_REPLICA_URIS', '').split(',') if uri]
+    # Threads per worker running cursor.gather() lookups; each holds a pooled connection.
+    # Fewer than the five lookups of the overview page would run some of them in turn
+    CONCURRENT_READ_WORKERS = int(os.getenv('CONCURRENT_READ_WORKERS', 5))
+    # Read-through cache for cursor.query(..., cache=True), kept in step across workers
+    # through table_version; 0 disables it
+    QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 1024))
+    QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 30))
+    # Per-request SQL timings; warn when one statement runs more than SQL_REPEAT_WARNING times
+    SQL_STATS = os.getenv('SQL_STATS', '1') == '1'
+    SQL_REPEAT_WARNING = int(os.getenv('SQL_REPEAT_WARNING', 10))
+    SQL_SLOWEST_SHOWN = int(os.getenv('SQL_SLOWEST_SHOWN', 3))
+    # Seconds between reloads of each worker's typeahead name index
+    NAME_INDEX_REBUILD_INTERVAL = float(os.getenv('NAME_INDEX_REBUILD_INTERVAL', 300))
+    # Seconds between batch rebuilds of each worker's family cluster index
+    FAMILY_CLUSTER_REBUILD_INTERVAL = float(os.getenv('FAMILY_CLUSTER_REBUILD_INTERVAL', 3600))
+    # Ancestor tables each worker keeps for relationship lookups
+    LINEAGE_CACHE_SIZE = int(os.getenv('LINEAGE_CACHE_SIZE', 10000))
+    # Seconds a rendered chart is reused before it is drawn again
+    CHART_CACHE_TTL = float(os.getenv('CHART_CACHE_TTL', 300))
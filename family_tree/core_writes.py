@@ -0,0 +1,58 @@
+"""
+Core INSERT, UPDATE and DELETE statements executed on the session.
+
+cursor.update(), the bulk writes and ORM bulk UPDATEs by primary key never
+flush, so listeners that keep derived data in sync on after_flush do not see
+them. A do_orm_execute listener calls written_user_ids() to find the users
+such a statement is about to change, runs the statement with
+invoke_statement() and then syncs those users.
+"""
+from sqlalchemy import select
+
+# Execution option handing the user ids found by written_user_ids() on to the
+# listeners that run after the one that looked them up
+USER_IDS_OPTION = 'written_user_ids'
+
+
+def written_user_ids(orm_execute_state, *models):
+    """
+    Return the user ids of the rows of the given models that a Core INSERT,
+    UPDATE or DELETE is about to write, or None if it writes none of them.
+
+    INSERTs report the user_id of their parameters. The rows of an UPDATE or
+    DELETE are looked up by its WHERE clause, or by the primary keys of an
+    ORM bulk UPDATE, so call this before the statement runs.
+    """
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete):
+        return None
+    statement = orm_execute_state.statement
+    model = next((model for model in models
+                  if model.__tablename__ == statement.table.name), None)
+    if model is None:
+        return None
+    known = orm_execute_state.execution_options.get(USER_IDS_OPTION)
+    if known is not None:
+        return known
+
+    parameters = orm_execute_state.parameters
+    rows = parameters if isinstance(parameters, list) else [parameters or {}]
+    # An INSERT, or an UPDATE moving rows to another user
+    user_ids = {row['user_id'] for row in rows if row.get('user_id') is not None}
+    if orm_execute_state.is_insert:
+        return user_ids
+    query = select(model.user_id)
+    if statement.whereclause is not None:
+        query = query.where(statement.whereclause)
+    elif any('id' in row for row in rows):
+        query = query.where(model.id.in_([row['id'] for row in rows if 'id' in row]))
+    user_ids.update(orm_execute_state.session.execute(query).scalars())
+    return user_ids
+
+
+def invoke_statement(orm_execute_state, user_ids):
+    """
+    Run the statement, passing the user ids it writes on to the next
+    listeners so that they do not look them up again.
+    """
+    return orm_execute_state.invoke_statement(execution_options={USER_IDS_OPTION: user_ids})
@@ -1,7 +1,121 @@
-from flask import current_app as app
+import base64
+import binascii
+import enum
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from flask import current_app as app, g
+from sqlalchemy import (
+    Integer, delete, func, insert, inspect, literal, literal_column, select, tuple_, update
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from family_tree.query_cache import CACHE_OPTION
+from family_tree.routing import PRIMARY_KEY, REPLICA_OPTION, use_primary
+from family_tree.sql_stats import current_stats
+from family_tree.statements import statements
+
+# Key in session.info holding how many cursor.transaction() blocks are open
+TRANSACTION_DEPTH_KEY = 'cursor_transaction_depth'
+
+# Rows sent per executemany() by the bulk writes
+BULK_BATCH_SIZE = 5000
+
+# Rows per page returned by paginate() unless a limit is given
+DEFAULT_PAGE_SIZE = 50
+
+# Threads per app running the lookups of cursor.gather(); at least as many
+# as the largest gather, the five lookups of the profile overview
+DEFAULT_CONCURRENT_READ_WORKERS = 5
+
+# QueuePool's own max_overflow, used when SQLALCHEMY_ENGINE_OPTIONS sets none
+DEFAULT_MAX_OVERFLOW = 10
+
+# Upper bound on generations walked by the recursive lineage queries, so a
+# cycle in Relatives cannot make the CTE recurse forever.
+MAX_LINEAGE_DEPTH = 100
+
+
+def init_read_executor(app):
+    """
+    Create the thread pool that runs the lookups of cursor.gather(). Its
+    threads are only started once gather() needs them.
+    """
+    app.extensions['read_executor'] = ThreadPoolExecutor(
+        max_workers=app.config.get('CONCURRENT_READ_WORKERS', DEFAULT_CONCURRENT_READ_WORKERS),
+        thread_name_prefix='read')
+
+
+def _run_lookup(flask_app, db, lookup, primary, stats):
+    # The app context gives the thread its own session, removed on exit.
+    # The caller's read routing and SQL stats carry over to it.
+    with flask_app.app_context():
+        if primary:
+            use_primary(db.session)
+        if stats is not None:
+            g.sql_stats = stats
+        return lookup(db)
+
+
+def _free_connections(pool, max_overflow):
+    """
+    Return how many more connections the pool can hand out without
+    waiting: the idle ones plus those it may still open. None if it is
+    unbounded.
+    """
+    if not isinstance(pool, QueuePool) or max_overflow < 0:
+        return None
+    # overflow() counts up from -size() as connections are opened
+    return pool.checkedin() + max_overflow - pool.overflow()
+
 
 class Cursor:
-    def query(self, db, table, *args, filter_by=False, **kwargs):
+    @contextmanager
+    def transaction(self, db):
+        """
+        Group several writes into one unit of work.
+
+        add(), update() and delete() called inside the block do not commit;
+        the outermost block commits once when it exits, or rolls everything
+        back if it raises. Blocks can be nested.
+
+        Usage:
+            with cursor.transaction(db):
+                cursor.add(db, Relatives, ...)
+                cursor.add(db, Relatives, ...)
+        """
+        info = db.session.info
+        # Reads that decide what to write must not see a lagging replica
+        use_primary(db.session)
+        depth = info.get(TRANSACTION_DEPTH_KEY, 0)
+        info[TRANSACTION_DEPTH_KEY] = depth + 1
+        try:
+            yield
+        except Exception:
+            if depth == 0:
+                db.session.rollback()
+            raise
+        else:
+            if depth == 0:
+                db.session.commit()
+        finally:
+            info[TRANSACTION_DEPTH_KEY] = depth
+
+    def in_transaction(self, db):
+        return db.session.info.get(TRANSACTION_DEPTH_KEY, 0) > 0
+
+    def commit(self, db):
+        """
+        Commit unless inside cursor.transaction(), which commits on exit.
+        """
+        if not self.in_transaction(db):
+            db.session.commit()
+
+    def query(self, db, table, *args, filter_by=False, options=None, cache=False, primary=False,
+              **kwargs):
         """
         Query a SQLAlchemy table with either filter() or filter_by().
 
@@ -10,22 +124,172 @@ class Cursor:
         - table: The SQLAlchemy model (e.g. User, Order)
         - *args: Positional filter expressions (for .filter())
         - filter_by: If True, use filter_by(**kwargs); otherwise use filter(*args)
+        - options: Loader options such as selectinload(User.person) or
+          joinedload(User.profile_picture), to fetch relationships eagerly
+          instead of one lazy load per row
+        - cache: If True, serve the results from the app's query cache when
+          enabled (see family_tree.query_cache)
+        - primary: If True, read from the primary even when read replicas
+          are configured (see family_tree.routing)
         - **kwargs: Keyword filter arguments (used only if filter_by=True)
 
         Returns:
         - A query object you can call .all(), .first(), etc.
         """
 
+        query = db.session.query(table)
+        if options:
+            query = query.options(*options)
+        if cache:
+            query = query.execution_options(**{CACHE_OPTION: True})
+        if not primary:
+            query = query.execution_options(**{REPLICA_OPTION: True})
         if filter_by:
-            return db.session.query(table).filter_by(**kwargs)
+            return query.filter_by(**kwargs)
         elif args and kwargs:
-            return db.session.query(table).filter(*args).filter_by(**kwargs)
+            return query.filter(*args).filter_by(**kwargs)
         elif args:
-            return db.session.query(table).filter(*args)
+            return query.filter(*args)
         else:
-            return db.session.query(table)
+            return query
         
     
+    def prepared(self, db, name, *tables, **params):
+        """
+        Run a prebuilt statement from family_tree.statements.
+
+        Parameters:
+        - db: The SQLAlchemy instance (usually `from yourapp import db`)
+        - name: The name the statement is registered under, e.g. 'user_by_id'
+        - *tables: The models the statement is built from, e.g. User
+        - **params: Values for the statement's bind parameters
+
+        Returns:
+        - The scalar result; call .first(), .all(), etc.
+
+        Usage:
+            cursor.prepared(db, 'user_by_email', User, email=email).first()
+        """
+        return db.session.execute(statements.get(name, *tables), params).scalars()
+
+    def gather(self, db, **lookups):
+        """
+        Run several independent reads at the same time.
+
+        Each lookup is a function of db, run in a worker thread with its own
+        app context, session and pooled connection, so it goes through the
+        same pool limits, replica routing and query cache as any other read.
+        A session that already reads from the primary makes the lookups read
+        from it too, and their statements count towards the request's SQL
+        stats. The objects returned are detached, so a lookup must load
+        everything its caller uses.
+
+        The lookups run one after the other, in the caller's session, when:
+        - the caller is inside cursor.transaction(), because other
+          connections cannot see its uncommitted writes;
+        - the pool cannot hand out a connection per lookup without waiting,
+          because the caller keeps its own connection meanwhile;
+        - the database is in-memory SQLite, whose StaticPool shares a single
+          connection.
+
+        Usage:
+            results = cursor.gather(
+                db,
+                person=lambda db: cursor.query(db, Person, filter_by=True, user_id=1).first(),
+                addresses=lambda db: cursor.query(db, Address, filter_by=True, user_id=1).all())
+
+        Returns:
+            {name: result} with the same names as the lookups.
+        """
+        pool = db.engine.pool
+        max_overflow = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}).get(
+            'max_overflow', DEFAULT_MAX_OVERFLOW)
+        free = _free_connections(pool, max_overflow)
+        if (len(lookups) < 2 or isinstance(pool, StaticPool) or self.in_transaction(db)
+                or (free is not None and free < len(lookups))):
+            return {name: lookup(db) for name, lookup in lookups.items()}
+        flask_app = app._get_current_object()
+        executor = flask_app.extensions['read_executor']
+        primary = db.session.info.get(PRIMARY_KEY, False)
+        stats = current_stats()
+        futures = {
+            name: executor.submit(_run_lookup, flask_app, db, lookup, primary, stats)
+            for name, lookup in lookups.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+    def paginate(self, query, order_by, after=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Return one page of a query using keyset pagination.
+
+        Instead of OFFSET, each page continues after the sort key of the last
+        row of the previous one, so every page costs the same however deep it
+        is and rows added meanwhile do not shift later pages.
+
+        Parameters:
+        - query: A query from cursor.query() or db.session.query()
+        - order_by: Non-null columns to sort by in ascending order, ending in
+          a unique one, e.g. [Person.last_name, Person.id]
+        - after: The token returned with the previous page, or None for the
+          first page
+        - limit: Maximum number of rows on the page
+
+        Returns:
+        - (items, next_token) where next_token is None on the last page
+
+        Raises:
+        - ValueError if `after` is not a token issued for these columns
+        """
+        order_by = list(order_by)
+        if after:
+            values = self._decode_token(order_by, after)
+            if len(order_by) == 1:
+                query = query.filter(order_by[0] > values[0])
+            else:
+                query = query.filter(tuple_(*order_by) > tuple_(*[
+                    literal(value, column.type) for column, value in zip(order_by, values)
+                ]))
+        rows = query.add_columns(*order_by).order_by(None).order_by(*order_by).limit(limit + 1).all()
+
+        keys = len(order_by)
+        items = [row[0] if len(row) == keys + 1 else tuple(row[:-keys]) for row in rows[:limit]]
+        next_token = self._encode_token(rows[limit - 1][-keys:]) if len(rows) > limit else None
+        return items, next_token
+
+    @staticmethod
+    def _encode_token(values):
+        values = [
+            value.name if isinstance(value, enum.Enum)
+            else value.isoformat() if isinstance(value, (date, datetime))
+            else value
+            for value in values
+        ]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def _decode_token(order_by, token):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ValueError(f"Invalid page token {token!r}")
+        if not isinstance(values, list) or len(values) != len(order_by):
+            raise ValueError(f"Invalid page token {token!r}")
+        decoded = []
+        for column, value in zip(order_by, values):
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:
+                python_type = None
+            try:
+                if python_type and issubclass(python_type, enum.Enum):
+                    value = python_type[value]
+                elif python_type in (date, datetime):
+                    value = python_type.fromisoformat(value)
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Invalid page token {token!r}")
+            decoded.append(value)
+        return decoded
+
     def add(self, db, table, **kwargs):
         """
         Add a new record to a SQLAlchemy table.
@@ -35,41 +299,196 @@ class Cursor:
             table: The SQLAlchemy model class to instantiate (e.g. User, Order)
             **kwargs: Field values for the new record (passed to model constructor)
 
-        Commits the new record to the database.
+        Commits the new record to the database, unless called inside
+        cursor.transaction().
         """
         new_record = table(**kwargs)
         db.session.add(new_record)
-        db.session.commit()
+        self.commit(db)
 
     def update(self, db, table, record_id, **kwargs):
         """
-        Update an existing record in a SQLAlchemy table.
+        Update an existing record in a SQLAlchemy table with a single
+        UPDATE statement, without loading the record first.
 
         Parameters:
             db: The SQLAlchemy instance (usually `from yourapp import db`)
             table: The SQLAlchemy model class (e.g. User, Order)
             record_id: The primary key of the record to update
-            **kwargs: Field values to update (passed to model instance)
+            **kwargs: Field values to update
         """
-        record = db.session.query(table).filter_by(id=record_id).first()
-        if not record:
+        result = db.session.execute(
+            update(table).where(table.id == record_id).values(**kwargs))
+        if result.rowcount == 0:
             raise ValueError(f"Record with id {record_id} not found in {table.__tablename__}")
-        for key, value in kwargs.items():
-            setattr(record, key, value)
-        db.session.commit()
+        self.commit(db)
 
-    def delete(self, db, table, **kwargs):
+    def delete(self, db, table, *args, **kwargs):
         """
-        Delete a record from a SQLAlchemy table.
+        Delete records from a SQLAlchemy table.
+
+        Tables without ORM delete cascades are deleted with a single DELETE
+        statement. Tables with cascades (e.g. User) are loaded and deleted
+        through the session so that their dependent rows are removed too.
+
+        Parameters:
+            db: The SQLAlchemy instance (usually `from yourapp import db`)
+            table: The SQLAlchemy model class (e.g. User, Order)
+            *args: Filter expressions selecting the records to delete
+            **kwargs: Keyword filters selecting the records to delete
+
+        Returns:
+            The number of records deleted.
+        """
+        if self._has_delete_cascades(table):
+            records = db.session.query(table).filter(*args).filter_by(**kwargs).all()
+            for record in records:
+                db.session.delete(record)
+            count = len(records)
+        else:
+            count = db.session.execute(
+                delete(table).where(*args).filter_by(**kwargs)).rowcount
+        if not count:
+            app.logger.warning(f"No records found in {table.__tablename__} matching {kwargs or args}")
+        self.commit(db)
+        return count
+
+    @staticmethod
+    def _has_delete_cascades(table):
+        return any(relationship.cascade.delete
+                   for relationship in inspect(table).relationships)
+
+    def bulk_add(self, db, table, rows):
+        """
+        Insert many records with Core INSERT statements instead of one ORM
+        object per row.
 
         Parameters:
             db: The SQLAlchemy instance (usually `from yourapp import db`)
             table: The SQLAlchemy model class (e.g. User, Order)
-            record_id: The primary key of the record to delete
-        """
-        records = db.session.query(table).filter_by(**kwargs).all()
-        if not records:
-            app.logger.warning(f"No records found in {table.__tablename__} matching {kwargs}")
-        for record in records:
-            db.session.delete(record)
-        db.session.commit()
+            rows: A list of dicts of field values, all with the same keys
+
+        Returns:
+            The number of rows inserted.
+        """
+        for start in range(0, len(rows), BULK_BATCH_SIZE):
+            db.session.execute(insert(table), rows[start:start + BULK_BATCH_SIZE])
+        self.commit(db)
+        return len(rows)
+
+    def bulk_upsert(self, db, table, rows, conflict_cols):
+        """
+        Insert many records, updating the existing ones that clash on
+        conflict_cols, which must carry a unique constraint.
+
+        Uses INSERT ... ON CONFLICT DO UPDATE on both PostgreSQL and SQLite.
+
+        Parameters:
+            db: The SQLAlchemy instance (usually `from yourapp import db`)
+            table: The SQLAlchemy model class (e.g. User, Order)
+            rows: A list of dicts of field values, all with the same keys
+            conflict_cols: Names of the columns identifying an existing row
+
+        Returns:
+            The number of rows written.
+        """
+        if not rows:
+            return 0
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            statement = postgresql.insert(table)
+        elif dialect == 'sqlite':
+            statement = sqlite.insert(table)
+        else:
+            raise NotImplementedError(f"bulk_upsert does not support the {dialect} dialect")
+        updates = {
+            column: statement.excluded[column]
+            for column in rows[0] if column not in conflict_cols
+        }
+        if updates:
+            statement = statement.on_conflict_do_update(index_elements=conflict_cols, set_=updates)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=conflict_cols)
+        for start in range(0, len(rows), BULK_BATCH_SIZE):
+            db.session.execute(statement, rows[start:start + BULK_BATCH_SIZE])
+        self.commit(db)
+        return len(rows)
+
+    def bulk_delete(self, db, table, *args, **kwargs):
+        """
+        Delete every matching record with a single DELETE statement.
+
+        Unlike delete(), this never falls back to the ORM, so cascades such
+        as User -> Person do not run even on tables that declare them.
+
+        Parameters:
+            db: The SQLAlchemy instance (usually `from yourapp import db`)
+            table: The SQLAlchemy model class (e.g. User, Order)
+            *args: Filter expressions selecting the records to delete
+            **kwargs: Keyword filters selecting the records to delete
+
+        Returns:
+            The number of rows deleted.
+        """
+        result = db.session.execute(delete(table).where(*args).filter_by(**kwargs))
+        self.commit(db)
+        return result.rowcount
+
+    def ancestors(self, db, relatives_table, user_id, max_depth=None):
+        """
+        Return every ancestor of a user in one recursive query over PARENT edges.
+
+        Parameters:
+            db: The SQLAlchemy instance (usually `from yourapp import db`)
+            relatives_table: The Relatives model
+            user_id: The user whose ancestors are wanted
+            max_depth: Optional number of generations to walk up (1 = parents)
+
+        Returns:
+            A list of (user_id, depth) tuples ordered by depth, where depth is
+            the shortest number of generations between the two users.
+        """
+        return self._lineage(db, relatives_table, user_id, 'PARENT', max_depth)
+
+    def descendants(self, db, relatives_table, user_id, max_depth=None):
+        """
+        Return every descendant of a user in one recursive query over CHILD edges.
+
+        Parameters are the same as ancestors(); depth 1 means children.
+        """
+        return self._lineage(db, relatives_table, user_id, 'CHILD', max_depth)
+
+    def _lineage(self, db, relatives_table, user_id, relation_type, max_depth):
+        if max_depth is None or max_depth > MAX_LINEAGE_DEPTH:
+            max_depth = MAX_LINEAGE_DEPTH
+        if max_depth < 1:
+            return []
+
+        lineage = select(
+            relatives_table.relative_user_id.label('user_id'),
+            literal_column('1', Integer).label('depth')
+        ).where(
+            relatives_table.user_id == user_id,
+            relatives_table.relation_type == relation_type
+        ).cte('lineage', recursive=True)
+
+        # UNION rather than UNION ALL: each (user, depth) pair is expanded
+        # once, so pedigree collapse (cousin marriages) cannot make the
+        # number of rows grow with the number of paths
+        lineage = lineage.union(
+            select(
+                relatives_table.relative_user_id,
+                lineage.c.depth + 1
+            ).join(
+                lineage, relatives_table.user_id == lineage.c.user_id
+            ).where(
+                relatives_table.relation_type == relation_type,
+                lineage.c.depth < max_depth
+            )
+        )
+
+        depth = func.min(lineage.c.depth)
+        statement = select(lineage.c.user_id, depth).where(
+            lineage.c.user_id != user_id
+        ).group_by(lineage.c.user_id).order_by(depth, lineage.c.user_id)
+        return [tuple(row) for row in db.session.execute(statement)]
@@ -17,6 +17,7 @@ from wtforms import (
     DateField,
     IntegerField
 )
+from wtforms.widgets import HiddenInput
 
 
 class LoginForm(FlaskForm):
@@ -96,8 +97,9 @@ class UpsertContactDetailsForm(FlaskForm):
 
 
 class UpsertRelativeForm(FlaskForm):
-    relative_user_id = SelectField(
-        'Relative', choices=[], coerce=int, validators=[DataRequired()])
+    # Filled in by the typeahead; check_relative_constraints() checks the id
+    relative_user_id = IntegerField(
+        'Relative', widget=HiddenInput(), validators=[DataRequired()])
     relation_type = SelectField(
         'Relation Type', choices=[], validators=[DataRequired()])
     submit = SubmitField('Add Relative')
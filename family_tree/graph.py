@@ -0,0 +1,432 @@
+"""
+In-memory kinship graph built from the Relatives table.
+
+Relatives are stored as a CSR (compressed sparse row) adjacency: one
+``offsets`` array indexed by row, and parallel ``targets``/``kinds`` arrays
+holding the relative's user id and the relation type as a small int.
+Writes made through the services are applied to a small overlay of added
+and removed edges which is folded back into the CSR arrays once it grows.
+
+Every write to Relatives also bumps the graph_version row in the same
+transaction. get_graph() compares it with the version the graph was loaded
+at, once per request, and reloads when another worker, a command or a
+direct write changed the relations in the meantime.
+"""
+import threading
+from array import array
+from collections import deque
+
+from flask import current_app as app, has_request_context, request
+from sqlalchemy import event, select, update
+
+from family_tree.models import GraphVersion, Relatives, RelativesTypeEnum, User
+from family_tree.query_cache import table_names
+
+
+RELATION_CODES = {relation: code for code, relation in enumerate(RelativesTypeEnum)}
+RELATIONS = list(RelativesTypeEnum)
+
+PARENT = RELATION_CODES[RelativesTypeEnum.PARENT]
+CHILD = RELATION_CODES[RelativesTypeEnum.CHILD]
+SPOUSE = RELATION_CODES[RelativesTypeEnum.SPOUSE]
+EXSPOUSE = RELATION_CODES[RelativesTypeEnum.EXSPOUSE]
+SIBLING_CODES = frozenset(
+    RELATION_CODES[r] for r in (
+        RelativesTypeEnum.SIBLING,
+        RelativesTypeEnum.HALFSIBLING,
+        RelativesTypeEnum.STEPSIBLING
+    )
+)
+
+# Rebuild the CSR arrays once the overlay holds this many pending changes
+MIN_COMPACT_THRESHOLD = 1024
+
+# Keys in session.info holding the graph versions written by the open
+# transaction and by the last committed one
+PENDING_VERSIONS_KEY = 'graph_versions_pending'
+COMMITTED_VERSIONS_KEY = 'graph_versions_committed'
+# Key in the WSGI environ holding the graphs whose version was checked this request
+CHECKED_KEY = 'family_tree.graph_version_checked'
+
+
+def relation_code(relation_type):
+    """
+    Map a RelativesTypeEnum member or its string value to its small int code.
+    """
+    return RELATION_CODES[RelativesTypeEnum(relation_type)]
+
+
+def reverse_code(code):
+    reverse = Relatives.get_reverse_relation(RELATIONS[code].value)
+    return RELATION_CODES[RelativesTypeEnum(reverse)]
+
+
+class KinshipGraph:
+    def __init__(self):
+        self.loaded = False
+        self.version = 0
+        # graph_version the graph was loaded at, see get_graph()
+        self.db_version = None
+        # Objects notified of changes through edge_added(), edge_removed(),
+        # user_removed() and reset() so derived indexes stay in step
+        self.listeners = []
+        # Guards the arrays and overlay. Listeners are notified after it is
+        # released since they take their own locks and read the graph back.
+        self._lock = threading.RLock()
+        self._reset({})
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+    def _reset(self, edges):
+        """
+        Build the CSR arrays from a {user_id: {relative_user_id: code}} mapping.
+        """
+        self._index = {}
+        self._offsets = array('i', [0])
+        self._targets = array('i')
+        self._kinds = array('b')
+        for row, user_id in enumerate(sorted(edges)):
+            self._index[user_id] = row
+            for relative_user_id, code in sorted(edges[user_id].items()):
+                self._targets.append(relative_user_id)
+                self._kinds.append(code)
+            self._offsets.append(len(self._targets))
+        self._added = {}
+        self._removed = set()
+        self._pending = 0
+
+    def load(self, db, relatives_table=Relatives):
+        """
+        Load every Relatives row in a single query.
+
+        Rows are written in forward/reverse pairs. A missing reverse row is
+        mirrored in memory so that traversals do not depend on direction.
+        """
+        # Read before the rows, so a write in between triggers another reload
+        db_version = stored_version(db)
+        rows = db.session.query(
+            relatives_table.user_id,
+            relatives_table.relative_user_id,
+            relatives_table.relation_type
+        ).all()
+        self.load_rows(rows)
+        self.db_version = db_version
+        app.logger.info(f'Loaded kinship graph with {len(rows)} relations')
+
+    def load_rows(self, rows):
+        edges = {}
+        for user_id, relative_user_id, relation_type in rows:
+            code = relation_code(relation_type)
+            edges.setdefault(user_id, {})[relative_user_id] = code
+            edges.setdefault(relative_user_id, {}).setdefault(
+                user_id, reverse_code(code))
+        with self._lock:
+            self._reset(edges)
+            self.loaded = True
+            self.version += 1
+        self._notify('reset')
+
+    def invalidate(self):
+        """
+        Drop the graph so the next get_graph() reloads it from the database.
+        """
+        with self._lock:
+            self.loaded = False
+            self.version += 1
+            self.db_version = None
+            self._reset({})
+        self._notify('reset')
+
+    def _advance(self, versions):
+        """
+        Accept the graph versions written by a transaction of this process
+        whose change the caller has just applied. If another writer got in
+        between, they do not follow on and the next get_graph() reloads.
+        """
+        if versions and self.db_version is not None and versions[0] == self.db_version + 1:
+            self.db_version = versions[-1]
+
+    def _edges(self, user_id):
+        """
+        Return a list of (target, code) for a user's current edges.
+        """
+        edges = []
+        with self._lock:
+            row = self._index.get(user_id)
+            if row is not None:
+                for i in range(self._offsets[row], self._offsets[row + 1]):
+                    target = self._targets[i]
+                    if (user_id, target) not in self._removed:
+                        edges.append((target, self._kinds[i]))
+            edges.extend(self._added.get(user_id, {}).items())
+        return edges
+
+    def _snapshot(self):
+        return {
+            user_id: dict(self._edges(user_id))
+            for user_id in set(self._index) | set(self._added)
+        }
+
+    def _set(self, user_id, relative_user_id, code):
+        if user_id in self._index:
+            # Shadow any base edge so the overlay value wins
+            self._removed.add((user_id, relative_user_id))
+        self._added.setdefault(user_id, {})[relative_user_id] = code
+
+    def _unset(self, user_id, relative_user_id):
+        added = self._added.get(user_id)
+        if added:
+            added.pop(relative_user_id, None)
+        if user_id in self._index:
+            self._removed.add((user_id, relative_user_id))
+
+    def _changed(self, count):
+        self.version += 1
+        self._pending += count
+        if self._pending >= max(MIN_COMPACT_THRESHOLD, len(self._targets) // 8):
+            self._reset(self._snapshot())
+
+    def add_edge(self, user_id, relative_user_id, relation_type, versions=()):
+        """
+        Record that relative_user_id is relation_type of user_id, together
+        with the reverse edge. A no-op until the graph has been loaded.
+
+        versions are the graph versions the write committed, as returned by
+        committed_versions().
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            code = relation_code(relation_type)
+            self._set(user_id, relative_user_id, code)
+            self._set(relative_user_id, user_id, reverse_code(code))
+            self._changed(2)
+            self._advance(versions)
+        self._notify('edge_added', user_id, relative_user_id)
+
+    def remove_edge(self, user_id, relative_user_id, versions=()):
+        """
+        Remove the relation between two users in both directions.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            self._unset(user_id, relative_user_id)
+            self._unset(relative_user_id, user_id)
+            self._changed(2)
+            self._advance(versions)
+        self._notify('edge_removed', user_id, relative_user_id)
+
+    def remove_user(self, user_id, versions=()):
+        """
+        Remove a user and every relation pointing at them.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            relative_ids = [relative_user_id for relative_user_id, _ in self._edges(user_id)]
+            for relative_user_id in relative_ids:
+                self._unset(user_id, relative_user_id)
+                self._unset(relative_user_id, user_id)
+            self._changed(2 * len(relative_ids))
+            self._advance(versions)
+        self._notify('user_removed', user_id)
+
+    def relatives(self, user_id):
+        """
+        Return a list of (relative_user_id, RelativesTypeEnum) for a user.
+        """
+        return [(target, RELATIONS[code]) for target, code in self._edges(user_id)]
+
+    def user_ids(self):
+        """
+        Return the ids of every user with at least one relation.
+        """
+        with self._lock:
+            return [user_id for user_id in set(self._index) | set(self._added)
+                    if self._edges(user_id)]
+
+    def neighbours(self, user_id):
+        return [target for target, _ in self._edges(user_id)]
+
+    def relation(self, user_id, relative_user_id):
+        """
+        Return what relative_user_id is to user_id as a RelativesTypeEnum, or None.
+        """
+        for target, code in self._edges(user_id):
+            if target == relative_user_id:
+                return RELATIONS[code]
+        return None
+
+    def _related(self, user_id, codes):
+        return [target for target, code in self._edges(user_id) if code in codes]
+
+    def parents(self, user_id):
+        return self._related(user_id, (PARENT,))
+
+    def children(self, user_id):
+        return self._related(user_id, (CHILD,))
+
+    def _walk(self, user_id, code, max_depth):
+        depths = {}
+        queue = deque([(user_id, 0)])
+        while queue:
+            current, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for target, kind in self._edges(current):
+                if kind == code and target not in depths and target != user_id:
+                    depths[target] = depth + 1
+                    queue.append((target, depth + 1))
+        return depths
+
+    def ancestors(self, user_id, max_depth=None):
+        """
+        Return {ancestor_id: generations_up} following PARENT edges.
+        """
+        return self._walk(user_id, PARENT, max_depth)
+
+    def descendants(self, user_id, max_depth=None):
+        """
+        Return {descendant_id: generations_down} following CHILD edges.
+        """
+        return self._walk(user_id, CHILD, max_depth)
+
+    def siblings(self, user_id):
+        """
+        Return users recorded as any kind of sibling, plus users who share a parent.
+        """
+        siblings = set(self._related(user_id, SIBLING_CODES))
+        for parent in self.parents(user_id):
+            siblings.update(self.children(parent))
+        siblings.discard(user_id)
+        return siblings
+
+    def spouses(self, user_id, include_former=False):
+        codes = (SPOUSE, EXSPOUSE) if include_former else (SPOUSE,)
+        return self._related(user_id, codes)
+
+
+def current_graph():
+    """
+    Return the kinship graph of the current app without loading it.
+    """
+    graph = app.extensions.get('kinship_graph')
+    if graph is None:
+        graph = app.extensions['kinship_graph'] = KinshipGraph()
+    return graph
+
+
+def stored_version(db, for_update=False):
+    """
+    Return the graph version in the database. Always read from the primary.
+    """
+    statement = select(GraphVersion.version).where(GraphVersion.id == 1)
+    if for_update:
+        statement = statement.with_for_update()
+    return db.session.execute(statement).scalar()
+
+
+def _checked_this_request(graph):
+    """
+    Whether the graph's version was already compared during this request.
+    Outside requests every call compares it.
+    """
+    if not has_request_context():
+        return False
+    checked = request.environ.setdefault(CHECKED_KEY, set())
+    if id(graph) in checked:
+        return True
+    checked.add(id(graph))
+    return False
+
+
+def get_graph(db, for_update=False, recheck=False):
+    """
+    Return the kinship graph of the current app, loading it on first use
+    and reloading it when Relatives changed since it was loaded.
+
+    The version is compared once per request; recheck compares it again.
+    for_update also locks the graph_version row until the end of the
+    transaction, so no relation can change while the caller writes what it
+    derives from the graph.
+    """
+    graph = current_graph()
+    checked = _checked_this_request(graph)
+    if graph.loaded and checked and not (for_update or recheck):
+        return graph
+    version = stored_version(db, for_update=for_update)
+    if not graph.loaded or version != graph.db_version:
+        if graph.loaded:
+            app.logger.info(
+                f'Kinship graph is at version {graph.db_version} but the database '
+                f'is at {version}; reloading')
+        graph.load(db)
+    return graph
+
+
+def committed_versions(db):
+    """
+    Return and forget the graph versions written by the session's last
+    commit. Pass them to add_edge(), remove_edge() or remove_user() when
+    applying that commit to the graph.
+    """
+    return db.session.info.pop(COMMITTED_VERSIONS_KEY, [])
+
+
+def _bump(session):
+    version = session.execute(
+        update(GraphVersion).where(GraphVersion.id == 1)
+        .values(version=GraphVersion.version + 1)
+        .returning(GraphVersion.version)
+    ).scalar()
+    if version is not None:
+        session.info.setdefault(PENDING_VERSIONS_KEY, []).append(version)
+
+
+def _after_flush(session, flush_context):
+    if (any(isinstance(instance, Relatives)
+            for instance in (*session.new, *session.dirty, *session.deleted))
+            or any(isinstance(instance, User) for instance in session.deleted)):
+        _bump(session)
+
+
+def _do_orm_execute(orm_execute_state):
+    # Core INSERT, UPDATE and DELETE statements bypass the flush
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete):
+        return
+    tables = table_names(orm_execute_state.statement)
+    if 'relatives' in tables or (orm_execute_state.is_delete and 'user' in tables):
+        _bump(orm_execute_state.session)
+
+
+def _after_commit(session):
+    session.info[COMMITTED_VERSIONS_KEY] = session.info.pop(PENDING_VERSIONS_KEY, [])
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING_VERSIONS_KEY, None)
+
+
+def invalidate_graphs(db):
+    """
+    Make every process reload its kinship graph, e.g. after Relatives was
+    edited outside the app. Commits.
+    """
+    _bump(db.session)
+    db.session.commit()
+    current_graph().invalidate()
+
+
+def init_graph(db):
+    """
+    Bump graph_version in the same transaction as every write to Relatives.
+    """
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'do_orm_execute', _do_orm_execute)
+        event.listen(db.session, 'after_commit', _after_commit)
+        event.listen(db.session, 'after_rollback', _after_rollback)
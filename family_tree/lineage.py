@@ -0,0 +1,182 @@
+"""
+Lowest-common-ancestor index over the parent graph.
+
+Binary lifting and Euler tours assume every person has a single parent, so
+they cannot answer LCA queries on a pedigree where each person has up to two
+parents. Instead each person's ancestor table ({ancestor_id: generations})
+is built once, in topological order from their parents' tables, and LCA
+queries are answered by probing the smaller of two tables. The index listens
+to the kinship graph: a relation change only drops the tables of the people
+below it, and a reload drops them all.
+
+Tables are kept in an LRU bounded by LINEAGE_CACHE_SIZE, so a large tree
+costs at most that many tables per worker.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app as app
+
+from family_tree.graph import current_graph, get_graph
+
+DEFAULT_LINEAGE_CACHE_SIZE = 10000
+
+
+class LineageIndex:
+    def __init__(self, graph, maxsize=DEFAULT_LINEAGE_CACHE_SIZE):
+        self.graph = graph
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._tables = OrderedDict()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def _cached(self, user_id):
+        table = self._tables.get(user_id)
+        if table is not None:
+            self._tables.move_to_end(user_id)
+        return table
+
+    def ancestor_table(self, user_id):
+        """
+        Return {ancestor_id: shortest number of generations up}, including the
+        user themselves at depth 0.
+        """
+        with self._lock:
+            return self._ancestor_table(user_id)
+
+    def _ancestor_table(self, user_id):
+        table = self._cached(user_id)
+        if table is not None:
+            return table
+
+        # Build the missing tables in topological order without recursion.
+        # Tables built here are kept aside until the end so that evictions
+        # cannot drop a parent's table before its children are built.
+        built = {}
+        stack = [user_id]
+        visiting = set()
+        while stack:
+            current = stack[-1]
+            if current in built or self._cached(current) is not None:
+                stack.pop()
+                continue
+            missing = [p for p in self.graph.parents(current)
+                       if p not in built and p not in self._tables and p not in visiting]
+            if missing and current not in visiting:
+                visiting.add(current)
+                stack.extend(missing)
+                continue
+            stack.pop()
+            visiting.discard(current)
+            table = {current: 0}
+            for parent_id in self.graph.parents(current):
+                # A parent still being visited means an ancestry cycle; skip it
+                parent_table = built.get(parent_id) or self._tables.get(parent_id, {})
+                for ancestor_id, depth in parent_table.items():
+                    if depth + 1 < table.get(ancestor_id, depth + 2):
+                        table[ancestor_id] = depth + 1
+            built[current] = table
+
+        self._tables.update(built)
+        self._tables.move_to_end(user_id)
+        while len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return built[user_id]
+
+    def nearest_common_ancestors(self, user_id, other_user_id):
+        """
+        Return (ancestor_ids, up, down) for the common ancestors closest to both
+        users, where up/down are the generations from each user to them.
+        Full siblings share two nearest ancestors. Returns None if unrelated.
+        """
+        user_table = self.ancestor_table(user_id)
+        other_user_table = self.ancestor_table(other_user_id)
+        table, other_table = user_table, other_user_table
+        if len(other_table) < len(table):
+            table, other_table = other_table, table
+        best = None
+        found = []
+        for ancestor_id, depth in table.items():
+            other_depth = other_table.get(ancestor_id)
+            if other_depth is None:
+                continue
+            total = depth + other_depth
+            if best is None or total < best:
+                best = total
+                found = [ancestor_id]
+            elif total == best:
+                found.append(ancestor_id)
+        if best is None:
+            return None
+        found.sort()
+        first = found[0]
+        return found, user_table[first], other_user_table[first]
+
+    def cousin_degree(self, user_id, other_user_id):
+        """
+        Return (degree, removed) for two blood relatives who are cousins, e.g.
+        (2, 1) for second cousins once removed, or None otherwise.
+        """
+        common = self.nearest_common_ancestors(user_id, other_user_id)
+        if common is None:
+            return None
+        _, up, down = common
+        if min(up, down) < 2:
+            return None
+        return min(up, down) - 1, abs(up - down)
+
+    def line_to(self, user_id, ancestor_id):
+        """
+        Return the user ids from user_id up to ancestor_id along a shortest line.
+        """
+        line = [user_id]
+        depth = self.ancestor_table(user_id)[ancestor_id]
+        while depth:
+            depth -= 1
+            user_id = next(
+                p for p in self.graph.parents(user_id)
+                if self.ancestor_table(p).get(ancestor_id) == depth
+            )
+            line.append(user_id)
+        return line
+
+    def _drop_below(self, user_id):
+        members = [user_id, *self.graph.descendants(user_id)]
+        with self._lock:
+            for member in members:
+                self._tables.pop(member, None)
+
+    # Graph listener interface
+    def edge_added(self, user_id, relative_user_id):
+        self._drop_below(user_id)
+        self._drop_below(relative_user_id)
+
+    def edge_removed(self, user_id, relative_user_id):
+        self._drop_below(user_id)
+        self._drop_below(relative_user_id)
+
+    def user_removed(self, user_id):
+        # The user's relations are already gone, so their former descendants
+        # cannot be found through the graph any more
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._tables.clear()
+
+
+def get_lineage(db):
+    """
+    Return the lineage index of the current app, with its graph brought up
+    to date first.
+    """
+    lineage = app.extensions.get('lineage_index')
+    if lineage is None:
+        graph = current_graph()
+        lineage = app.extensions['lineage_index'] = LineageIndex(
+            graph, app.config.get('LINEAGE_CACHE_SIZE', DEFAULT_LINEAGE_CACHE_SIZE))
+        graph.listeners.append(lineage)
+    get_graph(db)
+    return lineage
@@ -1,7 +1,9 @@
 from datetime import datetime
 import enum
+import time
 
 from flask_login import UserMixin
+from sqlalchemy import DDL, event
 
 from family_tree import db, bcrypt
 
@@ -58,7 +60,7 @@ class User(db.Model, UserMixin):
 
 class Picture(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     picture_filename = db.Column(db.String(100), nullable=False)
 
 class GenderEnum(enum.Enum):
@@ -71,19 +73,54 @@ class GenderEnum(enum.Enum):
 
 class Person(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     gender = db.Column(db.Enum(GenderEnum), nullable=False)
     first_name = db.Column(db.String(100), nullable=False)
     middle_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100), nullable=False)
+    # Generation within the person's family, 0 being the oldest. Maintained
+    # by family_tree.services.generation.
+    generation = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0', index=True)
 
     def __repr__(self):
         return f'<Person {self.first_name} {self.last_name}>'
 
 
+# SQLite has no trigram or phonetic indexes, so name search reads an FTS5
+# table kept in sync by family_tree.services.search
+event.listen(Person.__table__, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS person_search "
+    "USING fts5(names, phonetic, tokenize='trigram')"
+).execute_if(dialect='sqlite'))
+event.listen(Person.__table__, 'before_drop', DDL(
+    "DROP TABLE IF EXISTS person_search"
+).execute_if(dialect='sqlite'))
+
+
+class PersonDirectory(db.Model):
+    """
+    One narrow row per person with everything name pickers and listings
+    show, so they read a single indexed table instead of joining Person
+    and Picture. Kept in sync by family_tree.services.directory.
+    """
+    __table_args__ = (
+        db.Index('ix_person_directory_sort_key', 'sort_key', 'user_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    display_name = db.Column(db.String(201), nullable=False)
+    # Lowercased "last first", the order names are listed in
+    sort_key = db.Column(db.String(201), nullable=False)
+    gender = db.Column(db.Enum(GenderEnum), nullable=False)
+    picture_filename = db.Column(db.String(100))
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Address(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     is_permanent = db.Column(db.Boolean, nullable=False)
     first_line = db.Column(db.String(255), nullable=False)
     second_line = db.Column(db.String(255))
@@ -104,7 +141,7 @@ class ImportantDateTypeEnum(enum.Enum):
 
 class ImportantDates(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     date_type = db.Column(db.Enum(ImportantDateTypeEnum),
                           nullable=False)  # e.g., Birth, Anniversary
     date = db.Column(db.Date, nullable=False)
@@ -112,7 +149,7 @@ class ImportantDates(db.Model):
 
 class ContactDetails(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     country_code = db.Column(db.Integer)
     mobile_no = db.Column(db.String(15))
     email = db.Column(db.String(120))
@@ -131,10 +168,18 @@ class RelativesTypeEnum(enum.Enum):
 
 
 class Relatives(db.Model):
+    # One directed edge per pair of users; the unique index also serves
+    # lookups by user_id alone
+    __table_args__ = (
+        db.Index('uq_relatives_user_id_relative_user_id',
+                 'user_id', 'relative_user_id', unique=True),
+        db.Index('ix_relatives_user_id_relation_type', 'user_id', 'relation_type'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     relative_user_id = db.Column(
-        db.Integer, db.ForeignKey('user.id'), nullable=False)
+        db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     # e.g., 'parent', 'sibling', 'child'
     relation_type = db.Column(db.Enum(RelativesTypeEnum), nullable=False)
 
@@ -157,3 +202,48 @@ class Relatives(db.Model):
         if relation_type not in Relatives.REVERSE_RELATIONSHIP_MAP:
             return "UNKNOWN"
         return Relatives.REVERSE_RELATIONSHIP_MAP[relation_type]
+
+
+class AncestryClosure(db.Model):
+    """
+    Transitive closure of the PARENT relation: one row for every
+    (ancestor, descendant) pair with the shortest number of generations
+    between them. Maintained by family_tree.services.closure.
+    """
+    ancestor_id = db.Column(
+        db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    descendant_id = db.Column(
+        db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+
+class GraphVersion(db.Model):
+    """
+    Single-row counter bumped in the same transaction as every write to
+    Relatives. Each process compares it with the version its kinship graph
+    was loaded at to pick up writes made by other workers and commands.
+    Maintained by family_tree.graph.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+def _insert_graph_version(target, connection, **kw):
+    # Start from the clock so a recreated table never repeats a version an
+    # older graph was loaded at
+    connection.execute(target.insert().values(id=1, version=int(time.time())))
+
+
+event.listen(GraphVersion.__table__, 'after_create', _insert_graph_version)
+
+
+class TableVersion(db.Model):
+    """
+    Per-table counter bumped in the same transaction as every write to the
+    table while the query cache is enabled. Each process compares it with
+    the version its cached results were read at to drop results that
+    other workers' writes made stale. Maintained by family_tree.query_cache.
+    """
+    __tablename__ = 'table_version'
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
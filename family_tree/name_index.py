@@ -0,0 +1,211 @@
+"""
+In-memory sorted index of people's names for the relative typeahead.
+
+Every name of a person (first, middle and last, lowercased) is one entry in
+a sorted list, so the people whose names start with a prefix form one
+contiguous run found by bisection, and the first k distinct people in that
+run are the top-k matches. The index is loaded from Person on first use.
+Writes to Person, flushed or as Core statements, are buffered on the session
+and applied to the index when their transaction commits, so a rollback never
+leaves names behind.
+
+Each process keeps its own index, so under gunicorn a worker only sees
+other workers' writes once its rebuild interval has passed.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import current_app as app, has_app_context
+from sqlalchemy import event, select
+
+from family_tree.core_writes import invoke_statement, written_user_ids
+from family_tree.models import Person
+from family_tree.services.search import full_name, search_terms
+
+DEFAULT_TYPEAHEAD_LIMIT = 10
+# Seconds after which the index is reloaded from Person
+DEFAULT_REBUILD_INTERVAL = 300
+# Key in session.info holding {user_id: names, or None if removed} written by
+# the open transaction
+PENDING_NAMES_KEY = 'name_index_pending'
+
+
+def _name_entries(user_id, first_name, middle_name, last_name):
+    """
+    Index entries of a person: (name, sort key, user id) for each distinct
+    name, the sort key ordering people with the same name like
+    person_directory does.
+    """
+    sort_key = f'{last_name} {first_name}'.lower()
+    names = set(search_terms(full_name(first_name, middle_name, last_name)))
+    return [(name, sort_key, user_id) for name in sorted(names)]
+
+
+class NameIndex:
+    def __init__(self, rebuild_interval=DEFAULT_REBUILD_INTERVAL):
+        self.rebuild_interval = rebuild_interval
+        self.built_at = None
+        self._lock = threading.Lock()
+        self._entries = []
+        self._people = {}
+
+    def load(self, db):
+        entries, people = [], {}
+        for user_id, first_name, middle_name, last_name in db.session.execute(
+                select(Person.user_id, Person.first_name, Person.middle_name, Person.last_name)):
+            person_entries = _name_entries(user_id, first_name, middle_name, last_name)
+            entries.extend(person_entries)
+            people[user_id] = (f'{first_name} {last_name}', person_entries)
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._people = people
+            self.built_at = time.monotonic()
+        app.logger.info(f'Loaded the name index with {len(people)} people')
+
+    def stale(self):
+        if self.built_at is None:
+            return True
+        return (self.rebuild_interval is not None
+                and time.monotonic() - self.built_at > self.rebuild_interval)
+
+    def _discard(self, user_id):
+        _, entries = self._people.pop(user_id, (None, ()))
+        for entry in entries:
+            position = bisect_left(self._entries, entry)
+            if position < len(self._entries) and self._entries[position] == entry:
+                del self._entries[position]
+
+    def update(self, user_id, first_name, middle_name, last_name):
+        with self._lock:
+            self._discard(user_id)
+            entries = _name_entries(user_id, first_name, middle_name, last_name)
+            for entry in entries:
+                insort(self._entries, entry)
+            self._people[user_id] = (f'{first_name} {last_name}', entries)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def __len__(self):
+        return len(self._people)
+
+    def complete(self, query, limit=DEFAULT_TYPEAHEAD_LIMIT, exclude=()):
+        """
+        Return the first `limit` people, in name order, that have a name
+        starting with every word of the query.
+
+        Returns:
+            A list of {'user_id', 'name'} dicts.
+        """
+        terms = search_terms(query)
+        if not terms or limit < 1:
+            return []
+        # Scan the run of the longest word, the others only filter it
+        prefix = max(terms, key=len)
+        results, seen = [], set(exclude)
+        with self._lock:
+            for position in range(bisect_left(self._entries, (prefix,)), len(self._entries)):
+                name, _, user_id = self._entries[position]
+                if not name.startswith(prefix):
+                    break
+                if user_id in seen:
+                    continue
+                display_name, entries = self._people[user_id]
+                if all(any(entry[0].startswith(term) for entry in entries) for term in terms):
+                    seen.add(user_id)
+                    results.append({'user_id': user_id, 'name': display_name})
+                    if len(results) == limit:
+                        break
+        return results
+
+
+def current_name_index():
+    """
+    Return the name index of the current app without loading it, or None
+    outside an app context.
+    """
+    if not has_app_context():
+        return None
+    index = app.extensions.get('name_index')
+    if index is None:
+        index = app.extensions['name_index'] = NameIndex(
+            app.config.get('NAME_INDEX_REBUILD_INTERVAL', DEFAULT_REBUILD_INTERVAL))
+    return index
+
+
+def get_name_index(db):
+    """
+    Return the name index of the current app, reloading it first on first
+    use or once the rebuild interval has passed.
+    """
+    index = current_name_index()
+    if index.stale():
+        index.load(db)
+    return index
+
+
+def _loaded_index():
+    index = current_name_index()
+    # An index that has not been loaded yet will read the rows when it is
+    if index is None or index.built_at is None:
+        return None
+    return index
+
+
+def _after_flush(session, flush_context):
+    if _loaded_index() is None:
+        return
+    pending = session.info.setdefault(PENDING_NAMES_KEY, {})
+    for instance in (*session.new, *session.dirty):
+        if isinstance(instance, Person) and instance.user_id is not None:
+            pending[instance.user_id] = (
+                instance.first_name, instance.middle_name, instance.last_name)
+    for instance in session.deleted:
+        if isinstance(instance, Person) and instance.user_id is not None:
+            pending[instance.user_id] = None
+
+
+def _do_orm_execute(orm_execute_state):
+    # Core INSERT, UPDATE and DELETE statements bypass the flush
+    user_ids = written_user_ids(orm_execute_state, Person)
+    if not user_ids or _loaded_index() is None:
+        return None
+    result = invoke_statement(orm_execute_state, user_ids)
+    session = orm_execute_state.session
+    pending = session.info.setdefault(PENDING_NAMES_KEY, {})
+    pending.update(dict.fromkeys(user_ids))
+    for user_id, *names in session.execute(
+            select(Person.user_id, Person.first_name, Person.middle_name, Person.last_name)
+            .where(Person.user_id.in_(user_ids))):
+        pending[user_id] = tuple(names)
+    return result
+
+
+def _after_commit(session):
+    pending = session.info.pop(PENDING_NAMES_KEY, None)
+    index = _loaded_index()
+    if not pending or index is None:
+        return
+    for user_id, names in pending.items():
+        if names is None:
+            index.remove(user_id)
+        else:
+            index.update(user_id, *names)
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING_NAMES_KEY, None)
+
+
+def init_name_index(db):
+    """
+    Keep the name index in sync with every committed write to Person.
+    """
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'do_orm_execute', _do_orm_execute)
+        event.listen(db.session, 'after_commit', _after_commit)
+        event.listen(db.session, 'after_rollback', _after_rollback)
@@ -0,0 +1,86 @@
+"""
+Connection pool metrics.
+
+TimedQueuePool is a QueuePool that also records how long checkouts wait
+for a connection, how often they time out and how often it opens new
+connections. Config uses it for the primary and the replicas, and
+pool_snapshot() reports it along with the pool's own counters.
+
+The numbers are per process, so under gunicorn each worker reports its own
+pool.
+"""
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Seconds over which connects_per_second is averaged
+CONNECT_WINDOW = 60
+
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._connects = deque()
+        event.listen(self, 'connect', self._record_connect)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def _record_connect(self, dbapi_connection, connection_record):
+        now = time.monotonic()
+        with self._stats_lock:
+            self._connects.append(now)
+            self._trim_connects(now)
+
+    def _trim_connects(self, now):
+        while self._connects and self._connects[0] < now - CONNECT_WINDOW:
+            self._connects.popleft()
+
+    def connects_per_second(self):
+        with self._stats_lock:
+            self._trim_connects(time.monotonic())
+            return len(self._connects) / CONNECT_WINDOW
+
+
+def pool_snapshot(engine):
+    """
+    Return the current state of an engine's connection pool as a dict.
+
+    Counters a pool class does not keep (e.g. the StaticPool used for
+    in-memory SQLite) are None.
+    """
+    pool = engine.pool
+    queue_pool = isinstance(pool, QueuePool)
+    timed = isinstance(pool, TimedQueuePool)
+    return {
+        'pool': type(pool).__name__,
+        'size': pool.size() if queue_pool else None,
+        'checked_out': pool.checkedout() if queue_pool else None,
+        'checked_in': pool.checkedin() if queue_pool else None,
+        'overflow': pool.overflow() if queue_pool else None,
+        'checkouts': pool.checkouts if timed else None,
+        'timeouts': pool.timeouts if timed else None,
+        'wait_time': round(pool.wait_time, 6) if timed else None,
+        'max_wait': round(pool.max_wait, 6) if timed else None,
+        'connects_per_second': round(pool.connects_per_second(), 3) if timed else None,
+    }
@@ -0,0 +1,242 @@
+"""
+Read-through cache for ORM SELECTs.
+
+Queries opt in with cursor.query(..., cache=True). Their results are frozen
+and stored under the statement's compiled SQL and parameters, then merged
+back into the session on a hit. Every INSERT, UPDATE or DELETE that goes
+through the session (flushes, Cursor writes and Core statements executed on
+db.session alike) drops the entries that read from the tables it touches,
+and drops them again once its transaction commits or rolls back: other
+threads can cache the old rows in between, and reads of the session's own
+uncommitted rows are never cached.
+
+Each process keeps its own cache, so every write also bumps the written
+tables' rows in table_version, in the same transaction. Before serving a
+table from the cache, a process compares that row with the version it last
+saw, once per request, and drops the table's entries when another worker or
+a command wrote to it since.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app as app, has_app_context, has_request_context, request
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import loading
+from sqlalchemy.sql.util import find_tables
+
+from family_tree.models import TableVersion
+
+# Execution option set by cursor.query(..., cache=True)
+CACHE_OPTION = 'query_cache'
+# Key in session.info holding the tables written by the open transaction
+PENDING_TABLES_KEY = 'query_cache_pending'
+# Key in the WSGI environ holding the tables whose version was checked this request
+CHECKED_KEY = 'family_tree.query_cache_checked'
+
+DEFAULT_QUERY_CACHE_SIZE = 0
+DEFAULT_QUERY_CACHE_TTL = 60
+
+
+class QueryCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_table = {}
+        # {table: table_version.version} as last read from the database
+        self._versions = {}
+        # Statement cache used to compile offline cache keys
+        self._statements = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, statement, parameters):
+        return statement._generate_cache_key().to_offline_string(
+            self._statements, statement, parameters or {})
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, frozen, tables):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (time.monotonic() + self.ttl, frozen, tables)
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        for table in (entry[2] if entry else ()):
+            keys = self._by_table.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    self._discard(key)
+
+    def observe(self, versions):
+        """
+        Drop the entries of every table whose stored version differs from
+        the one last seen, given as {table: version}.
+        """
+        with self._lock:
+            for table, version in versions.items():
+                if self._versions.get(table) != version:
+                    for key in list(self._by_table.get(table, ())):
+                        self._discard(key)
+                    self._versions[table] = version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+
+
+def current_cache():
+    """
+    Return the query cache of the current app, or None if it is disabled.
+    """
+    if not has_app_context():
+        return None
+    return app.extensions.get('query_cache')
+
+
+def table_names(statement):
+    """
+    Names of the tables a statement reads or writes.
+    """
+    return frozenset(table.name for table in find_tables(
+        statement, include_joins=True, include_crud=True, check_columns=True)
+        if hasattr(table, 'name'))
+
+
+def _do_orm_execute(orm_execute_state):
+    cache = current_cache()
+    if cache is None:
+        return None
+    statement = orm_execute_state.statement
+    if not orm_execute_state.is_select:
+        _written(orm_execute_state.session, cache, table_names(statement))
+        return None
+    if not orm_execute_state.execution_options.get(CACHE_OPTION):
+        return None
+    tables = table_names(statement)
+    # The transaction's own writes are not committed yet, so keep them out
+    if tables & orm_execute_state.session.info.get(PENDING_TABLES_KEY, set()):
+        return None
+
+    _sync(orm_execute_state.session, cache, tables)
+
+    key = cache.key(statement, orm_execute_state.parameters)
+    frozen = cache.get(key)
+    if frozen is None:
+        frozen = orm_execute_state.invoke_statement().freeze()
+        cache.put(key, frozen, tables)
+    return loading.merge_frozen_result(
+        orm_execute_state.session, statement, frozen, load=False)()
+
+
+def _unchecked_this_request(tables):
+    """
+    The tables whose version was not compared yet during this request.
+    Outside requests every read compares them.
+    """
+    if not has_request_context():
+        return tables
+    checked = request.environ.setdefault(CHECKED_KEY, set())
+    unchecked = tables - checked
+    checked.update(unchecked)
+    return unchecked
+
+
+def _sync(session, cache, tables):
+    """
+    Drop the entries made stale by other processes' writes to the tables.
+    The versions are read from the primary, which replicas may lag behind.
+    """
+    tables = _unchecked_this_request(tables)
+    if not tables:
+        return
+    stored = dict(session.execute(
+        select(TableVersion.table_name, TableVersion.version)
+        .where(TableVersion.table_name.in_(sorted(tables)))).all())
+    cache.observe({table: stored.get(table) for table in tables})
+
+
+def _bump(session, tables):
+    dialect = session.get_bind().dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        raise NotImplementedError(f"The query cache does not support the {dialect} dialect")
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    # Sorted so that concurrent writers lock the rows in the same order
+    statement = insert(TableVersion).values(
+        [{'table_name': table, 'version': 1} for table in sorted(tables)])
+    session.execute(statement.on_conflict_do_update(
+        index_elements=[TableVersion.table_name],
+        set_={'version': TableVersion.version + 1}))
+
+
+def _written(session, cache, tables):
+    # Bumping table_version is a write too, which must not bump it again
+    tables = set(tables) - {TableVersion.__tablename__}
+    if not tables:
+        return
+    cache.invalidate(tables)
+    session.info.setdefault(PENDING_TABLES_KEY, set()).update(tables)
+    _bump(session, tables)
+
+
+def _after_flush(session, flush_context):
+    cache = current_cache()
+    if cache is None:
+        return
+    _written(session, cache, {
+        table.name
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        for table in type(instance).__mapper__.tables
+    })
+
+
+def _after_transaction(session):
+    tables = session.info.pop(PENDING_TABLES_KEY, None)
+    cache = current_cache()
+    if tables and cache is not None:
+        cache.invalidate(tables)
+
+
+def init_query_cache(app, db):
+    """
+    Enable the cache for an app if QUERY_CACHE_SIZE is set.
+    """
+    size = app.config.get('QUERY_CACHE_SIZE', DEFAULT_QUERY_CACHE_SIZE)
+    if not size:
+        return
+    app.extensions['query_cache'] = QueryCache(
+        size, app.config.get('QUERY_CACHE_TTL', DEFAULT_QUERY_CACHE_TTL))
+    if not event.contains(db.session, 'do_orm_execute', _do_orm_execute):
+        event.listen(db.session, 'do_orm_execute', _do_orm_execute)
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'after_commit', _after_transaction)
+        event.listen(db.session, 'after_rollback', _after_transaction)
@@ -5,10 +5,12 @@ from flask import (
     redirect,
     url_for,
     request,
+    jsonify,
     current_app as app
     )
 
 from flask_login import current_user, login_required
+from sqlalchemy.orm import joinedload
 
 from family_tree import (
     db,
@@ -17,15 +19,29 @@ from family_tree import (
 
 from family_tree.models import (
     User,
-    Person
+    Person,
+    Relatives,
+    AncestryClosure,
+    PersonDirectory
 )
 
 from family_tree.cursor import Cursor
+from family_tree.clusters import get_clusters
+from family_tree.graph import committed_versions, current_graph, get_graph
+from family_tree.pool_stats import pool_snapshot
+from family_tree.services.closure import (
+    remove_user_from_closure,
+    refresh_descendants
+)
+from family_tree.services.generation import refresh_generations
 
 cursor = Cursor()   
 
 bp = Blueprint('admin',__name__,url_prefix='/admin')
 
+MAX_CLUSTERS_SHOWN = 100
+MAX_CLUSTER_MEMBERS_SHOWN = 20
+
 @bp.before_request
 def restrict_access_to_admin():
     if not (current_user.is_authenticated and current_user.is_admin):
@@ -41,19 +57,59 @@ def dashboard():
 @bp.route('/display_user/<int:user_id>')
 @login_required
 def display_user(user_id):
-    user = cursor.query(db, User, filter_by=True, id=user_id).first()
+    user = cursor.query(db, User, filter_by=True, id=user_id,
+                        options=[joinedload(User.person)]).first()
     return render_template('admin/display_user.html', user=user)
 
 @bp.route('/display_users')
 @login_required
 def display_users():
-    users = cursor.query(db, User, *[User.is_admin == False], filter_by=False).all()
-    return render_template('admin/display_users.html', users=users)
+    query = db.session.query(User, PersonDirectory.display_name).outerjoin(
+        PersonDirectory, PersonDirectory.user_id == User.id
+    ).filter(User.is_admin == False)
+    try:
+        users, next_token = cursor.paginate(query, [User.id], after=request.args.get('after'))
+    except ValueError as error:
+        app.logger.warning(f'Admin {current_user.username} requested users: {error}')
+        flash('Invalid page.', 'danger')
+        return redirect(url_for('admin.display_users'))
+    return render_template('admin/display_users.html', users=users, next_token=next_token)
 
 @bp.route('/delete_user/<int:user_id>', methods = ['POST'])
 @login_required
 def delete_user(user_id):
-    cursor.delete(db, User, id=user_id)
+    relative_ids = get_graph(db).neighbours(user_id)
+    with cursor.transaction(db):
+        descendant_ids = remove_user_from_closure(db, AncestryClosure, user_id)
+        cursor.delete(db, User, id=user_id)
+        refresh_descendants(db, AncestryClosure, Relatives, descendant_ids)
+    current_graph().remove_user(user_id, versions=committed_versions(db))
+    if relative_ids:
+        refresh_generations(db, Person, relative_ids)
     app.logger.info(f'Deleted user {user_id}')
     flash('Deleted Successfully!', 'success')
-    return redirect(url_for('admin.display_users'))
\ No newline at end of file
+    return redirect(url_for('admin.display_users'))
+
+@bp.route('/family_clusters')
+@login_required
+def family_clusters():
+    clusters = sorted(get_clusters(db).components().values(), key=len, reverse=True)
+    clusters = clusters[:MAX_CLUSTERS_SHOWN]
+    member_ids = [user_id for members in clusters for user_id in members[:MAX_CLUSTER_MEMBERS_SHOWN]]
+    persons = {
+        person.user_id: person
+        for person in cursor.query(db, Person, Person.user_id.in_(member_ids)).all()
+    }
+    return render_template(
+        'admin/family_clusters.html',
+        clusters=clusters,
+        persons=persons,
+        max_members=MAX_CLUSTER_MEMBERS_SHOWN)
+
+@bp.route('/pool_stats')
+@login_required
+def pool_stats():
+    return jsonify({
+        'primary': pool_snapshot(db.engine),
+        'replicas': [pool_snapshot(engine) for engine in app.extensions.get('replicas', [])]
+    })
@@ -46,7 +46,7 @@ def login():
     else:
         form = LoginForm()
         if form.validate_on_submit():
-            user = cursor.query(db, User, filter_by=True, email=form.email.data).first()
+            user = cursor.prepared(db, 'user_by_email', User, email=form.email.data).first()
             if user and user.check_password(form.password.data):
                 login_user(user, remember=form.remember.data)
                 app.logger.info(f"User {form.email.data} logged in successfully.")
@@ -70,11 +70,11 @@ def register():
     else:
         form = RegistrationForm()
         if form.validate_on_submit():
-            user = cursor.query(db, User, filter_by=True, email=form.email.data).first()
+            user = cursor.prepared(db, 'user_by_email', User, email=form.email.data).first()
             if user:
                 flash('Email already registered. Please log in.', 'warning')
                 return redirect(url_for('common.register'))
-            user = cursor.query(db, User, filter_by=True, username=form.username.data).first()
+            user = cursor.prepared(db, 'user_by_username', User, username=form.username.data).first()
             if user:
                 flash('Username already registered. Please use a different one.', 'warning')
                 return redirect(url_for('common.register'))
@@ -6,6 +6,9 @@ from flask import (
     redirect,
     url_for,
     request,
+    jsonify,
+    Response,
+    abort,
     current_app as app
 )
 
@@ -24,7 +27,21 @@ from family_tree.services.user import (
     check_validity_relation,
     add_relative_to_database,
     prefill_upsert_relative_form,
-    delete_relative_from_database
+    delete_relative_from_database,
+    get_neighbourhood,
+    get_profile_overview,
+    NEIGHBOURHOOD_FIELDS
+)
+from family_tree.services.kinship import find_relationship
+from family_tree.services.generation import same_generation
+from family_tree.services.search import DEFAULT_SEARCH_LIMIT, search_people
+from family_tree.name_index import DEFAULT_TYPEAHEAD_LIMIT, get_name_index
+from family_tree.services.chart import (
+    CHART_KINDS,
+    DEFAULT_CHART_GENERATIONS,
+    MAX_CHART_GENERATIONS,
+    bump_family,
+    render_chart
 )
 from family_tree.models import (
     User,
@@ -36,7 +53,9 @@ from family_tree.models import (
     ImportantDates,
     ContactDetails,
     RelativesTypeEnum,
-    Relatives
+    Relatives,
+    AncestryClosure,
+    PersonDirectory
 )
 from family_tree.forms import (
     UpsertProfilePictureForm,
@@ -121,6 +140,7 @@ def edit_profile():
                 last_name=form.last_name.data,
                 gender=GenderEnum(form.gender.data)
             )
+            bump_family(db, current_user.id)
             flash('Profile created successfully!', 'success')
             app.logger.info(
                 f"Profile created for user {current_user.username}.")
@@ -147,9 +167,11 @@ def address():
     app.logger.info(
         f"Rendering address page for user {current_user.username}.")
 
+    addresses = cursor.query(db, Address, filter_by=True, cache=True,
+                             user_id=current_user.id).order_by(Address.id).all()
     return render_template(
         'user/address.html',
-        addresses=current_user.addresses
+        addresses=addresses
     )
 
 
@@ -253,7 +275,7 @@ def display_address(address_id):
     """
     app.logger.info(
         f"Rendering display address page for user {current_user.username}, address ID {address_id}.")
-    address = cursor.query(db, Address, filter_by=True,
+    address = cursor.query(db, Address, filter_by=True, cache=True,
                            id=address_id, user_id=current_user.id).first()
     if not address:
         app.logger.warning(
@@ -275,18 +297,14 @@ def delete_address(address_id):
     """
     app.logger.info(
         f"Rendering delete address page for user {current_user.username}, address ID {address_id}.")
-    address = cursor.query(db, Address, filter_by=True,
-                           id=address_id, user_id=current_user.id).first()
-    if not address:
-        app.logger.warning(
-            f"Address ID {address_id} not found for user {current_user.username}.")
-        flash('Address not found.', 'danger')
-
-    if request.method == 'POST':
-        cursor.delete(db, Address, id=address_id, user_id=current_user.id)
+    if cursor.delete(db, Address, id=address_id, user_id=current_user.id):
         flash('Address deleted successfully!', 'success')
         app.logger.info(
             f"Address ID {address_id} deleted for user {current_user.username}.")
+    else:
+        app.logger.warning(
+            f"Address ID {address_id} not found for user {current_user.username}.")
+        flash('Address not found.', 'danger')
 
     return redirect(url_for('user.address'))
 
@@ -300,9 +318,20 @@ def display_important_dates():
     app.logger.info(
         f"Rendering important dates page for user {current_user.username}.")
 
+    query = cursor.query(db, ImportantDates, filter_by=True, cache=True,
+                         user_id=current_user.id)
+    try:
+        important_dates, next_token = cursor.paginate(
+            query, [ImportantDates.id], after=request.args.get('after'))
+    except ValueError:
+        app.logger.warning(
+            f"User {current_user.username} sent an invalid important dates page token.")
+        flash('Invalid page.', 'danger')
+        return redirect(url_for('user.display_important_dates'))
     return render_template(
         'user/display_important_dates.html',
-        important_dates=current_user.important_dates
+        important_dates=important_dates,
+        next_token=next_token
     )
 
 
@@ -381,15 +410,12 @@ def delete_important_date(date_id):
     """
     app.logger.info(
         f"User {current_user.username} attempting to delete important date ID {date_id}.")
-    important_date = cursor.query(db, ImportantDates, filter_by=True,
-                                  id=date_id, user_id=current_user.id).first()
-    if not important_date:
+    if not cursor.delete(db, ImportantDates, id=date_id, user_id=current_user.id):
         app.logger.warning(
             f"Important date ID {date_id} not found for user {current_user.username}.")
         flash('Important date not found.', 'danger')
         return redirect(url_for('user.display_important_dates'))
 
-    cursor.delete(db, ImportantDates, id=date_id, user_id=current_user.id)
     flash('Important date deleted successfully!', 'success')
     app.logger.info(
         f"Important date ID {date_id} deleted for user {current_user.username}.")
@@ -405,9 +431,20 @@ def display_contact_details():
     app.logger.info(
         f"Rendering contact details page for user {current_user.username}.")
 
+    query = cursor.query(db, ContactDetails, filter_by=True, cache=True,
+                         user_id=current_user.id)
+    try:
+        contact_details, next_token = cursor.paginate(
+            query, [ContactDetails.id], after=request.args.get('after'))
+    except ValueError:
+        app.logger.warning(
+            f"User {current_user.username} sent an invalid contact details page token.")
+        flash('Invalid page.', 'danger')
+        return redirect(url_for('user.display_contact_details'))
     return render_template(
         'user/display_contact_details.html',
-        contact_details=current_user.contact_details
+        contact_details=contact_details,
+        next_token=next_token
     )
 
 
@@ -483,15 +520,12 @@ def delete_contact_details(contact_id):
     """
     app.logger.info(
         f"User {current_user.username} attempting to delete contact details ID {contact_id}.")
-    contact = cursor.query(db, ContactDetails, filter_by=True,
-                           id=contact_id, user_id=current_user.id).first()
-    if not contact:
+    if not cursor.delete(db, ContactDetails, id=contact_id, user_id=current_user.id):
         app.logger.warning(
             f"Contact details ID {contact_id} not found for user {current_user.username}.")
         flash('Contact details not found.', 'danger')
         return redirect(url_for('user.display_contact_details'))
 
-    cursor.delete(db, ContactDetails, id=contact_id, user_id=current_user.id)
     flash('Contact details deleted successfully!', 'success')
     app.logger.info(
         f"Contact details ID {contact_id} deleted for user {current_user.username}.")
@@ -506,12 +540,18 @@ def display_relatives():
     """
     app.logger.info(
         f"Rendering relatives page for user {current_user.username}.")
-    relatives = cursor.query(
-        db, Relatives, filter_by=True, user_id=current_user.id).all()
-    relative_details = get_relative_details(db, User, relatives)
+    try:
+        relative_details, next_token = get_relative_details(
+            db, Relatives, PersonDirectory, current_user.id, after=request.args.get('after'))
+    except ValueError:
+        app.logger.warning(
+            f"User {current_user.username} sent an invalid relatives page token.")
+        flash('Invalid page.', 'danger')
+        return redirect(url_for('user.display_relatives'))
     return render_template(
         'user/display_relatives.html',
-        relative_details=relative_details
+        relative_details=relative_details,
+        next_token=next_token
     )
 
 
@@ -524,13 +564,13 @@ def add_relative():
     app.logger.info(
         f"Rendering add relative page for user {current_user.username}.")
     form = UpsertRelativeForm()
-    prefill_upsert_relative_form(db, User, current_user.id, form)
+    prefill_upsert_relative_form(form)
     if form.validate_on_submit():
         if (check_relative_constraints(db, User, Relatives, current_user, form)
-                and check_validity_relation(db, User, Relatives, current_user,
-                                            form.relative_user_id.data, form.relation_type.data)):
-            add_relative_to_database(
-                db, Relatives, RelativesTypeEnum, current_user, form)
+                and check_validity_relation(db, User, Relatives, AncestryClosure, current_user,
+                                            form.relative_user_id.data, form.relation_type.data)
+                and add_relative_to_database(
+                    db, Relatives, RelativesTypeEnum, AncestryClosure, Person, current_user, form)):
             flash('Relative added successfully!', 'success')
             app.logger.info(
                 f"Relative added for user {current_user.username}.")
@@ -551,7 +591,7 @@ def delete_relative(relative_user_id):
     app.logger.info(
         f'Delete relative_user_id {relative_user_id} from current_user_id {current_user.id} relatives tables')
     result = delete_relative_from_database(
-        db, User, Relatives, current_user, relative_user_id)
+        db, User, Relatives, AncestryClosure, Person, current_user, relative_user_id)
     if result:
         app.logger.info(
             f'Deleted successfully relative_user_id {relative_user_id} from current_user_id {current_user.id} relatives tables')
@@ -560,3 +600,134 @@ def delete_relative(relative_user_id):
         app.logger.info(
             f'Delete unsuccessfull: relative_user_id {relative_user_id} from current_user_id {current_user.id} relatives tables')
     return redirect(url_for('user.display_relatives'))
+
+
+@bp.route('/relationship/<int:user_id>/<int:other_user_id>')
+@login_required
+def relationship(user_id, other_user_id):
+    """
+    Render how two users are related.
+    """
+    app.logger.info(
+        f"User {current_user.username} looked up the relationship between {user_id} and {other_user_id}.")
+    result = find_relationship(db, Person, user_id, other_user_id)
+    if result is None:
+        flash('No relationship found between these two people.', 'info')
+    return render_template(
+        'user/relationship.html',
+        result=result
+    )
+
+
+@bp.route('/overview')
+@login_required
+def overview():
+    """
+    Render the user's profile, addresses, important dates, contact details
+    and relatives on one page, fetched concurrently.
+    """
+    app.logger.info(
+        f"Rendering overview page for user {current_user.username}.")
+    details = get_profile_overview(
+        db, Person, Address, ImportantDates, ContactDetails, Relatives, current_user.id)
+    return render_template('user/overview.html', **details)
+
+
+@bp.route('/my_generation')
+@login_required
+def my_generation():
+    """
+    Render everyone in the user's family who belongs to their generation.
+    """
+    app.logger.info(
+        f"Rendering generation page for user {current_user.username}.")
+    persons = same_generation(db, Person, current_user.id)
+    return render_template(
+        'user/my_generation.html',
+        persons=persons
+    )
+
+
+@bp.route('/chart/<kind>/<int:user_id>')
+@login_required
+def chart(kind, user_id):
+    """
+    Render a user's pedigree or descendant chart.
+    """
+    if kind not in CHART_KINDS:
+        app.logger.warning(f'Unknown chart kind {kind} requested by user {current_user.username}')
+        flash('Unknown chart type.', 'danger')
+        return redirect(url_for('user.dashboard'))
+    generations = request.args.get('generations', DEFAULT_CHART_GENERATIONS, type=int)
+    generations = max(1, min(generations, MAX_CHART_GENERATIONS))
+    app.logger.info(
+        f"Rendering {kind} chart of user {user_id} for user {current_user.username}.")
+    return render_template(
+        'user/chart.html',
+        svg=render_chart(db, Person, user_id, kind, generations),
+        kind=kind,
+        user_id=user_id,
+        generations=generations,
+        max_generations=MAX_CHART_GENERATIONS
+    )
+
+
+@bp.route('/chart/<kind>/<int:user_id>/svg')
+@login_required
+def chart_svg(kind, user_id):
+    """
+    Return a user's pedigree or descendant chart as an SVG image.
+    """
+    if kind not in CHART_KINDS:
+        # An <img> cannot follow a redirect to an HTML page
+        app.logger.warning(f'Unknown chart kind {kind} requested by user {current_user.username}')
+        abort(404)
+    generations = request.args.get('generations', DEFAULT_CHART_GENERATIONS, type=int)
+    return Response(render_chart(db, Person, user_id, kind, generations),
+                    mimetype='image/svg+xml')
+
+
+@bp.route('/api/relatives/<int:user_id>')
+@login_required
+def relatives_json(user_id):
+    """
+    Return a user's immediate relatives for the tree viewer to expand a node.
+    Rows are arrays ordered like 'fields' to keep the payload small.
+    """
+    rows = get_neighbourhood(db, Relatives, Person, Picture, user_id)
+    app.logger.info(
+        f"Expanded {len(rows)} relatives of user {user_id} for user {current_user.username}.")
+    return jsonify({
+        'user_id': user_id,
+        'fields': NEIGHBOURHOOD_FIELDS,
+        'picture_url': url_for('static', filename='profile_pictures/'),
+        'relatives': rows
+    })
+
+
+@bp.route('/api/search/people')
+@login_required
+def search_people_json():
+    """
+    Return the people whose names match ?q=, best matches first. Matches
+    name prefixes, misspellings and names that sound alike.
+    """
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int), DEFAULT_SEARCH_LIMIT)
+    results = search_people(db, Person, query, limit=max(limit, 1))
+    app.logger.info(
+        f"Name search for {query!r} by user {current_user.username} returned {len(results)} people.")
+    return jsonify({'query': query, 'results': results})
+
+
+@bp.route('/api/typeahead/people')
+@login_required
+def typeahead_people_json():
+    """
+    Return the first people, in name order, with a name starting with each
+    word of ?q=. Backs the relative picker, so the current user is left out.
+    """
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', DEFAULT_TYPEAHEAD_LIMIT, type=int), DEFAULT_TYPEAHEAD_LIMIT)
+    results = get_name_index(db).complete(query, limit=limit, exclude=(current_user.id,))
+    return jsonify({'query': query, 'results': results})
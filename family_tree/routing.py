@@ -0,0 +1,76 @@
+"""
+Read/write routing between the primary database and its read replicas.
+
+Replicas are listed in SQLALCHEMY_REPLICA_URIS and get an engine each,
+created with the same SQLALCHEMY_ENGINE_OPTIONS as the primary.
+
+Queries built with cursor.query() carry the REPLICA_OPTION execution option
+and run on one replica per session; everything else, including all flushes
+and INSERT/UPDATE/DELETE statements, runs on the primary.
+
+Once a session has written, or a cursor.transaction() has started, its
+remaining reads go to the primary too, so a request always sees its own
+writes even while the replicas lag behind. The session is removed at the
+end of each request, which resets this.
+"""
+import random
+
+from flask import current_app as app, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.sql.dml import UpdateBase
+
+# Execution option set by cursor.query() on reads that may use a replica
+REPLICA_OPTION = 'read_replica'
+
+# Keys in session.info
+PRIMARY_KEY = 'read_primary'
+REPLICA_KEY = 'replica_engine'
+
+
+def replica_engines():
+    """
+    Return the engines of the current app's replicas.
+    """
+    if not has_app_context():
+        return []
+    return app.extensions.get('replicas', [])
+
+
+def use_primary(session):
+    """
+    Send the session's remaining reads to the primary.
+    """
+    session.info[PRIMARY_KEY] = True
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                use_primary(self)
+            elif self._reads_replica(clause):
+                engine = self.info.get(REPLICA_KEY)
+                if engine is None:
+                    engine = self.info[REPLICA_KEY] = random.choice(replica_engines())
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_replica(self, clause):
+        return (
+            clause is not None
+            and not self.info.get(PRIMARY_KEY)
+            and getattr(clause, '_execution_options', {}).get(REPLICA_OPTION, False)
+            and bool(replica_engines())
+        )
+
+
+def init_replicas(app):
+    """
+    Create an engine for each replica in SQLALCHEMY_REPLICA_URIS.
+    """
+    options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    app.extensions['replicas'] = [
+        create_engine(uri, **options)
+        for uri in app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    ]
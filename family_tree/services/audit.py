@@ -0,0 +1,179 @@
+from flask import current_app as app
+from sqlalchemy import and_, or_
+
+from family_tree.clusters import get_clusters
+from family_tree.graph import get_graph
+from family_tree.services.closure import lineage_edge
+from family_tree.services.generation import compute_generations
+
+
+def _issue(kind, user_ids, detail):
+    return {'issue': kind, 'user_ids': list(user_ids), 'detail': detail}
+
+
+def _parent_cycles(parents_of):
+    """
+    Return the strongly connected components of the parent graph that contain
+    more than one user, i.e. the users caught in an ancestry cycle.
+    Iterative Tarjan so that deep lineages cannot exhaust the stack.
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    cycles = []
+    counter = 0
+    for root in parents_of:
+        if root in index:
+            continue
+        work = [(root, iter(parents_of.get(root, ())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, parents = work[-1]
+            advanced = False
+            for parent in parents:
+                if parent not in index:
+                    index[parent] = lowlink[parent] = counter
+                    counter += 1
+                    stack.append(parent)
+                    on_stack.add(parent)
+                    work.append((parent, iter(parents_of.get(parent, ()))))
+                    advanced = True
+                    break
+                if parent in on_stack:
+                    lowlink[node] = min(lowlink[node], index[parent])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1:
+                    cycles.append(sorted(component))
+    return cycles
+
+
+def audit_relatives(db, relatives_table, person_table, closure_table, dates_table=None):
+    """
+    Check the whole Relatives table in one pass.
+
+    Reports self relations, duplicate rows for one pair of users, missing or
+    mismatched reverse rows, users with more than two parents or two parents
+    of the same gender, more than one spouse, ancestry cycles, siblings who
+    are also ancestor/descendant and stored generations that no longer match
+    the relations. If dates_table is given, parents born after their
+    children are reported too.
+
+    Returns:
+        A list of dicts with 'issue', 'user_ids' and 'detail'.
+    """
+    issues = []
+    edges = {}
+    parents_of = {}
+    spouses_of = {}
+    for user_id, relative_user_id, relation_type in db.session.query(
+            relatives_table.user_id,
+            relatives_table.relative_user_id,
+            relatives_table.relation_type):
+        if user_id == relative_user_id:
+            issues.append(_issue('self_relation', [user_id],
+                                 f'user {user_id} is recorded as their own {relation_type.value}'))
+            continue
+        if (user_id, relative_user_id) in edges:
+            issues.append(_issue('duplicate_relation', [user_id, relative_user_id],
+                                 f'{relative_user_id} is related to {user_id} more than once'))
+        edges[(user_id, relative_user_id)] = relation_type.value
+        edge = lineage_edge(user_id, relative_user_id, relation_type)
+        if edge:
+            parents_of.setdefault(edge[0], set()).add(edge[1])
+        elif relation_type.value == 'SPOUSE':
+            spouses_of.setdefault(user_id, set()).add(relative_user_id)
+
+    for (user_id, relative_user_id), relation_type in edges.items():
+        reverse = edges.get((relative_user_id, user_id))
+        expected = relatives_table.get_reverse_relation(relation_type)
+        if reverse is None:
+            issues.append(_issue('missing_reverse', [user_id, relative_user_id],
+                                 f'{relative_user_id} is {relation_type} of {user_id} but no reverse row exists'))
+        elif reverse != expected and user_id < relative_user_id:
+            issues.append(_issue('mismatched_reverse', [user_id, relative_user_id],
+                                 f'{relative_user_id} is {relation_type} of {user_id} but the reverse row says {reverse}'))
+
+    genders = {
+        user_id: gender.value for user_id, gender in
+        db.session.query(person_table.user_id, person_table.gender)
+    }
+    for child_id, parents in parents_of.items():
+        if len(parents) > 2:
+            issues.append(_issue('too_many_parents', [child_id] + sorted(parents),
+                                 f'user {child_id} has {len(parents)} parents'))
+        parent_genders = [genders.get(parent_id) for parent_id in parents]
+        for gender in ('MALE', 'FEMALE'):
+            if parent_genders.count(gender) > 1:
+                issues.append(_issue('same_gender_parents', [child_id] + sorted(parents),
+                                     f'user {child_id} has more than one {gender} parent'))
+
+    for user_id, spouses in spouses_of.items():
+        if len(spouses) > 1:
+            issues.append(_issue('multiple_spouses', [user_id] + sorted(spouses),
+                                 f'user {user_id} has {len(spouses)} spouses'))
+
+    in_cycle = set()
+    for cycle in _parent_cycles(parents_of):
+        in_cycle.update(cycle)
+        issues.append(_issue('ancestry_cycle', cycle,
+                             f'users {cycle} are each other\'s ancestors'))
+
+    lineal_siblings = db.session.query(
+        relatives_table.user_id, relatives_table.relative_user_id
+    ).join(closure_table, or_(
+        and_(closure_table.ancestor_id == relatives_table.user_id,
+             closure_table.descendant_id == relatives_table.relative_user_id),
+        and_(closure_table.ancestor_id == relatives_table.relative_user_id,
+             closure_table.descendant_id == relatives_table.user_id)
+    )).filter(
+        relatives_table.relation_type.in_(['SIBLING', 'HALFSIBLING']),
+        relatives_table.user_id < relatives_table.relative_user_id
+    ).distinct()
+    for user_id, relative_user_id in lineal_siblings:
+        issues.append(_issue('lineal_sibling', [user_id, relative_user_id],
+                             f'siblings {user_id} and {relative_user_id} are also ancestor and descendant'))
+
+    stored = {
+        user_id: generation for user_id, generation in
+        db.session.query(person_table.user_id, person_table.generation)
+    }
+    graph = get_graph(db)
+    for members in get_clusters(db).components().values():
+        for user_id, generation in compute_generations(graph, members).items():
+            # The generation of someone in an ancestry cycle is undefined
+            if user_id in stored and user_id not in in_cycle and stored[user_id] != generation:
+                issues.append(_issue('stale_generation', [user_id],
+                                     f'user {user_id} is stored in generation {stored[user_id]} '
+                                     f'but belongs to generation {generation}'))
+
+    if dates_table is not None:
+        births = {
+            user_id: date for user_id, date in
+            db.session.query(dates_table.user_id, dates_table.date)
+            .filter(dates_table.date_type == 'BIRTH')
+        }
+        for child_id, parents in parents_of.items():
+            for parent_id in sorted(parents):
+                if child_id in births and parent_id in births and births[parent_id] >= births[child_id]:
+                    issues.append(_issue('parent_born_after_child', [child_id, parent_id],
+                                         f'user {parent_id} was born on {births[parent_id]}, '
+                                         f'not before their child {child_id} ({births[child_id]})'))
+
+    app.logger.info(f'Relatives audit found {len(issues)} issues')
+    return issues
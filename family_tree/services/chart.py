@@ -0,0 +1,260 @@
+"""
+Pedigree and descendant charts rendered as SVG.
+
+Charts are laid out as tidy trees in the Reingold-Tilford style: each
+subtree is laid out on its own, siblings are pushed apart by comparing the
+contours (leftmost and rightmost x per level) of neighbouring subtrees, and
+parents are centred over their first and last child. Rendered charts are
+cached against a per-family version counter that is bumped whenever a
+Relatives or Person row in the family changes. Person changes made by other
+workers are not seen by that counter, so cached charts also expire after
+CHART_CACHE_TTL seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app as app, render_template
+
+from family_tree.clusters import get_clusters
+from family_tree.cursor import Cursor
+from family_tree.graph import current_graph, get_graph
+
+cursor = Cursor()
+
+CHART_KINDS = ('pedigree', 'descendants')
+DEFAULT_CHART_GENERATIONS = 4
+MAX_CHART_GENERATIONS = 8
+CHART_CACHE_SIZE = 256
+DEFAULT_CHART_CACHE_TTL = 300
+
+NODE_WIDTH = 160
+NODE_HEIGHT = 40
+HORIZONTAL_GAP = 20
+VERTICAL_GAP = 60
+MARGIN = 10
+
+
+class ChartCache:
+    """
+    LRU cache of rendered charts keyed on (kind, user_id, generations,
+    family root, family version).
+
+    A relation added inside a family bumps its version. Removals can split a
+    family and every rebuild of the cluster index can move roots, so both
+    drop the whole cache instead. Entries also expire after `ttl` seconds.
+    The cache is shared by the threads of a worker, cursor.gather()'s
+    included, so every method holds its lock.
+    """
+
+    def __init__(self, clusters, maxsize=CHART_CACHE_SIZE, ttl=DEFAULT_CHART_CACHE_TTL):
+        self.clusters = clusters
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clusters_built_at = clusters.built_at
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def version(self, root):
+        with self._lock:
+            return self._versions.get(root, 0)
+
+    def bump(self, user_id):
+        root = self.clusters.find(user_id)
+        with self._lock:
+            self._counter += 1
+            self._versions[root] = self._counter
+
+    def key(self, kind, user_id, generations):
+        root = self.clusters.find(user_id)
+        with self._lock:
+            if self.clusters.built_at != self.clusters_built_at:
+                self._clear()
+                self.clusters_built_at = self.clusters.built_at
+            return kind, user_id, generations, root, self._versions.get(root, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, svg):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, svg)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Graph listener interface
+    def edge_added(self, user_id, relative_user_id):
+        self.bump(user_id)
+        self.bump(relative_user_id)
+
+    def edge_removed(self, user_id, relative_user_id):
+        self.reset()
+
+    def user_removed(self, user_id):
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._versions.clear()
+
+
+def get_chart_cache(db):
+    """
+    Return the chart cache of the current app. The cluster index is brought
+    up to date first so that family roots are current.
+    """
+    clusters = get_clusters(db)
+    cache = app.extensions.get('chart_cache')
+    if cache is None:
+        cache = app.extensions['chart_cache'] = ChartCache(
+            clusters, ttl=app.config.get('CHART_CACHE_TTL', DEFAULT_CHART_CACHE_TTL))
+        current_graph().listeners.append(cache)
+    return cache
+
+
+def bump_family(db, user_id):
+    """
+    Invalidate the cached charts of a user's family. Call after their
+    Person row changes.
+    """
+    get_chart_cache(db).bump(user_id)
+
+
+def build_tree(graph, user_id, kind, generations):
+    """
+    Expand a user's ancestors or descendants into a tree of at most
+    `generations` levels. People reached twice (pedigree collapse, cousin
+    marriages) appear once per line.
+
+    Returns:
+        A list of nodes (user_id, depth, child_indices) with the root first.
+    """
+    step = graph.parents if kind == 'pedigree' else graph.children
+    nodes = [(user_id, 0, [])]
+    stack = [0]
+    while stack:
+        index = stack.pop()
+        node_user_id, depth, children = nodes[index]
+        if depth + 1 >= generations:
+            continue
+        for next_user_id in sorted(step(node_user_id)):
+            children.append(len(nodes))
+            stack.append(len(nodes))
+            nodes.append((next_user_id, depth + 1, []))
+    return nodes
+
+
+def _contour(nodes, index, offsets):
+    """
+    Lay out the subtree at index. Stores each child's x relative to its
+    parent in offsets and returns the subtree's contour as a list of
+    (leftmost, rightmost) x per level, relative to the subtree root.
+    """
+    children = nodes[index][2]
+    if not children:
+        return [(0, 0)]
+    merged = None
+    positions = []
+    for child in children:
+        contour = _contour(nodes, child, offsets)
+        if merged is None:
+            shift = 0
+            merged = list(contour)
+        else:
+            # Closest placement that keeps one slot between the subtrees on every level
+            shift = max(merged[d][1] - contour[d][0] + 1
+                        for d in range(min(len(merged), len(contour))))
+            for d, (left, right) in enumerate(contour):
+                if d < len(merged):
+                    merged[d] = (merged[d][0], right + shift)
+                else:
+                    merged.append((left + shift, right + shift))
+        positions.append(shift)
+    centre = (positions[0] + positions[-1]) / 2
+    for child, position in zip(children, positions):
+        offsets[child] = position - centre
+    return [(0, 0)] + [(left - centre, right - centre) for left, right in merged]
+
+
+def tidy_layout(nodes):
+    """
+    Return the (x, depth) slot of every node, with x starting at 0.
+    """
+    offsets = {0: 0}
+    _contour(nodes, 0, offsets)
+    xs = [0] * len(nodes)
+    for index, (_, _, children) in enumerate(nodes):
+        for child in children:
+            xs[child] = xs[index] + offsets[child]
+    lowest = min(xs)
+    return [(x - lowest, node[1]) for x, node in zip(xs, nodes)]
+
+
+def render_chart(db, person_table, user_id, kind, generations=DEFAULT_CHART_GENERATIONS):
+    """
+    Render a user's pedigree or descendant chart as an SVG document,
+    reusing the cached rendering while their family is unchanged.
+    """
+    generations = max(1, min(generations, MAX_CHART_GENERATIONS))
+    cache = get_chart_cache(db)
+    graph = get_graph(db)
+    key = cache.key(kind, user_id, generations)
+    svg = cache.get(key)
+    if svg is not None:
+        return svg
+
+    nodes = build_tree(graph, user_id, kind, generations)
+    slots = tidy_layout(nodes)
+    depth = max(node[1] for node in nodes)
+    persons = {
+        person.user_id: person for person in
+        cursor.query(db, person_table, person_table.user_id.in_({node[0] for node in nodes})).all()
+    }
+
+    boxes = []
+    for (node_user_id, _, _), (x, level) in zip(nodes, slots):
+        # Ancestors are drawn above the user, descendants below
+        row = depth - level if kind == 'pedigree' else level
+        person = persons.get(node_user_id)
+        boxes.append({
+            'user_id': node_user_id,
+            'name': f'{person.first_name} {person.last_name}' if person else 'Unknown',
+            'x': MARGIN + x * (NODE_WIDTH + HORIZONTAL_GAP),
+            'y': MARGIN + row * (NODE_HEIGHT + VERTICAL_GAP)
+        })
+    links = [
+        (boxes[index], boxes[child])
+        for index, node in enumerate(nodes) for child in node[2]
+    ]
+    width = max(slot[0] for slot in slots) * (NODE_WIDTH + HORIZONTAL_GAP) + NODE_WIDTH + 2 * MARGIN
+    height = depth * (NODE_HEIGHT + VERTICAL_GAP) + NODE_HEIGHT + 2 * MARGIN
+    svg = render_template(
+        'user/chart.svg',
+        boxes=boxes,
+        links=links,
+        width=width,
+        height=height,
+        node_width=NODE_WIDTH,
+        node_height=NODE_HEIGHT
+    )
+    cache.put(key, svg)
+    app.logger.info(
+        f'Rendered {kind} chart of user {user_id} with {len(nodes)} boxes over {generations} generations')
+    return svg
@@ -0,0 +1,178 @@
+from collections import deque
+
+from flask import current_app as app
+from sqlalchemy import delete, or_
+
+from family_tree.cursor import BULK_BATCH_SIZE, Cursor
+
+cursor = Cursor()
+
+
+def _batches(user_ids):
+    """
+    Split user ids into sorted lists of at most BULK_BATCH_SIZE, so that no
+    IN list grows with the size of the tree.
+    """
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), BULK_BATCH_SIZE):
+        yield user_ids[start:start + BULK_BATCH_SIZE]
+
+
+def lineage_edge(user_id, relative_user_id, relation_type):
+    """
+    Return (child_id, parent_id) if a relation is a PARENT/CHILD edge, else None.
+    """
+    relation_type = getattr(relation_type, 'value', relation_type)
+    if relation_type == 'PARENT':
+        return user_id, relative_user_id
+    if relation_type == 'CHILD':
+        return relative_user_id, user_id
+    return None
+
+
+def _parent_edges(db, relatives_table, child_ids=None):
+    """
+    Return {child_id: set(parent_ids)} from both the PARENT rows and their
+    CHILD reverse rows, optionally limited to the given children.
+    """
+    query = db.session.query(
+        relatives_table.user_id,
+        relatives_table.relative_user_id,
+        relatives_table.relation_type
+    ).filter(relatives_table.relation_type.in_(['PARENT', 'CHILD']))
+    if child_ids is None:
+        queries = [query]
+    else:
+        queries = [query.filter(or_(
+            (relatives_table.relation_type == 'PARENT') & relatives_table.user_id.in_(batch),
+            (relatives_table.relation_type == 'CHILD') & relatives_table.relative_user_id.in_(batch)
+        )) for batch in _batches(child_ids)]
+    parents_of = {}
+    for batch_query in queries:
+        for user_id, relative_user_id, relation_type in batch_query:
+            child_id, parent_id = lineage_edge(user_id, relative_user_id, relation_type)
+            parents_of.setdefault(child_id, set()).add(parent_id)
+    return parents_of
+
+
+def _compute(child_ids, parents_of, known):
+    """
+    Compute {descendant_id: {ancestor_id: depth}} for child_ids in topological
+    order. `known` holds the already correct closure of parents outside
+    child_ids and is extended in place. Users caught in a cycle are skipped.
+    """
+    child_ids = set(child_ids)
+    waiting = {}
+    children_of = {}
+    for child_id in child_ids:
+        inside = [p for p in parents_of.get(child_id, ()) if p in child_ids]
+        waiting[child_id] = len(inside)
+        for parent_id in inside:
+            children_of.setdefault(parent_id, []).append(child_id)
+
+    queue = deque(c for c, count in waiting.items() if count == 0)
+    computed = {}
+    while queue:
+        child_id = queue.popleft()
+        ancestors = {}
+        for parent_id in parents_of.get(child_id, ()):
+            candidates = [(parent_id, 1)] + [
+                (ancestor_id, depth + 1)
+                for ancestor_id, depth in known.get(parent_id, {}).items()
+            ]
+            for ancestor_id, depth in candidates:
+                if ancestor_id != child_id and depth < ancestors.get(ancestor_id, depth + 1):
+                    ancestors[ancestor_id] = depth
+        known[child_id] = computed[child_id] = ancestors
+        for grandchild_id in children_of.get(child_id, ()):
+            waiting[grandchild_id] -= 1
+            if waiting[grandchild_id] == 0:
+                queue.append(grandchild_id)
+
+    skipped = child_ids - set(computed)
+    if skipped:
+        app.logger.warning(
+            f'Ancestry closure skipped users {sorted(skipped)} caught in a parent cycle')
+    return computed
+
+
+def _insert(db, closure_table, computed):
+    rows = [
+        {'ancestor_id': ancestor_id, 'descendant_id': descendant_id, 'depth': depth}
+        for descendant_id, ancestors in computed.items()
+        for ancestor_id, depth in ancestors.items()
+    ]
+    return cursor.bulk_add(db, closure_table, rows)
+
+
+def _refresh(db, closure_table, relatives_table, affected):
+    # The closure is read, deleted and rewritten in one transaction
+    with cursor.transaction(db):
+        parents_of = _parent_edges(db, relatives_table, affected)
+        outside = {p for parents in parents_of.values() for p in parents} - affected
+        known = {}
+        for batch in _batches(outside):
+            for row in cursor.query(db, closure_table, closure_table.descendant_id.in_(batch)).all():
+                known.setdefault(row.descendant_id, {})[row.ancestor_id] = row.depth
+
+        computed = _compute(affected, parents_of, known)
+        for batch in _batches(affected):
+            db.session.execute(
+                delete(closure_table).where(closure_table.descendant_id.in_(batch)))
+        return _insert(db, closure_table, computed)
+
+
+def refresh_closure(db, closure_table, relatives_table, user_id):
+    """
+    Recompute the ancestry of a user and of everyone descended from them.
+    Call after a PARENT/CHILD edge with user_id as the child changes.
+    """
+    affected = {
+        row.descendant_id for row in
+        cursor.query(db, closure_table, filter_by=True, ancestor_id=user_id).all()
+    }
+    affected.add(user_id)
+    count = _refresh(db, closure_table, relatives_table, affected)
+    app.logger.info(
+        f'Refreshed ancestry closure of {len(affected)} users below user {user_id} ({count} rows)')
+
+
+def remove_user_from_closure(db, closure_table, user_id):
+    """
+    Drop a user from the closure table. Returns the ids of their descendants,
+    which must be passed to refresh_descendants() once the user is deleted.
+    """
+    descendant_ids = [
+        row.descendant_id for row in
+        cursor.query(db, closure_table, filter_by=True, ancestor_id=user_id).all()
+    ]
+    db.session.execute(delete(closure_table).where(or_(
+        closure_table.ancestor_id == user_id,
+        closure_table.descendant_id == user_id
+    )))
+    cursor.commit(db)
+    return descendant_ids
+
+
+def refresh_descendants(db, closure_table, relatives_table, descendant_ids):
+    """
+    Recompute the closure of users whose lineage passed through a deleted user.
+    """
+    if descendant_ids:
+        _refresh(db, closure_table, relatives_table, set(descendant_ids))
+
+
+def rebuild_closure(db, closure_table, relatives_table):
+    """
+    Rebuild the whole closure table from Relatives in bulk.
+
+    Returns:
+        The number of rows written.
+    """
+    with cursor.transaction(db):
+        parents_of = _parent_edges(db, relatives_table)
+        computed = _compute(parents_of.keys(), parents_of, {})
+        db.session.execute(delete(closure_table))
+        count = _insert(db, closure_table, computed)
+    app.logger.info(f'Rebuilt ancestry closure with {count} rows')
+    return count
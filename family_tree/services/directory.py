@@ -0,0 +1,92 @@
+from flask import current_app as app
+from sqlalchemy import delete, event, func, insert, select
+
+from family_tree.core_writes import invoke_statement, written_user_ids
+from family_tree.cursor import Cursor
+from family_tree.models import Person, PersonDirectory, Picture
+
+cursor = Cursor()
+
+DIRECTORY_COLUMNS = ('user_id', 'display_name', 'sort_key', 'gender',
+                     'picture_filename', 'generation')
+
+
+def _directory_rows(person_table, picture_table):
+    """
+    SELECT producing a person_directory row for every person, in
+    DIRECTORY_COLUMNS order.
+    """
+    return select(
+        person_table.user_id,
+        person_table.first_name + ' ' + person_table.last_name,
+        func.lower(person_table.last_name + ' ' + person_table.first_name),
+        person_table.gender,
+        picture_table.picture_filename,
+        person_table.generation
+    ).outerjoin(picture_table, picture_table.user_id == person_table.user_id)
+
+
+def _refresh(session, directory_table, person_table, picture_table, user_ids):
+    user_ids = list(user_ids)
+    session.execute(delete(directory_table).where(directory_table.user_id.in_(user_ids)))
+    session.execute(insert(directory_table).from_select(
+        DIRECTORY_COLUMNS,
+        _directory_rows(person_table, picture_table).where(person_table.user_id.in_(user_ids))))
+
+
+def refresh_directory(db, directory_table, person_table, picture_table, user_ids):
+    """
+    Rewrite the directory rows of the given users from Person and Picture,
+    dropping those who no longer have a profile. Does not commit.
+
+    Writes to Person and Picture made through the session, flushed or as
+    Core statements, are picked up automatically; call this after writes
+    made on a connection directly.
+    """
+    if user_ids:
+        _refresh(db.session, directory_table, person_table, picture_table, user_ids)
+
+
+def rebuild_directory(db, directory_table, person_table, picture_table):
+    """
+    Rebuild the whole directory from Person and Picture.
+
+    Returns:
+        The number of rows written.
+    """
+    with cursor.transaction(db):
+        db.session.execute(delete(directory_table))
+        db.session.execute(insert(directory_table).from_select(
+            DIRECTORY_COLUMNS, _directory_rows(person_table, picture_table)))
+    count = db.session.query(func.count()).select_from(directory_table).scalar()
+    app.logger.info(f'Rebuilt person directory with {count} rows')
+    return count
+
+
+def _after_flush(session, flush_context):
+    user_ids = {
+        instance.user_id
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, (Person, Picture)) and instance.user_id is not None
+    }
+    if user_ids:
+        _refresh(session, PersonDirectory, Person, Picture, user_ids)
+
+
+def _do_orm_execute(orm_execute_state):
+    # Core INSERT, UPDATE and DELETE statements bypass the flush
+    user_ids = written_user_ids(orm_execute_state, Person, Picture)
+    if not user_ids:
+        return None
+    result = invoke_statement(orm_execute_state, user_ids)
+    _refresh(orm_execute_state.session, PersonDirectory, Person, Picture, user_ids)
+    return result
+
+
+def init_directory(db):
+    """
+    Keep person_directory in sync with every write to Person or Picture.
+    """
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'do_orm_execute', _do_orm_execute)
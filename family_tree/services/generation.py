@@ -0,0 +1,254 @@
+from collections import deque
+
+from flask import current_app as app
+from sqlalchemy import exists, update
+
+from family_tree.clusters import get_clusters
+from family_tree.cursor import BULK_BATCH_SIZE, Cursor
+from family_tree.graph import get_graph
+from family_tree.models import RelativesTypeEnum
+
+cursor = Cursor()
+
+# Generation offset of a relative for the relations that do not go through
+# a parent. Used to place people who married into the family.
+SIDEWAYS_OFFSETS = {
+    RelativesTypeEnum.SPOUSE: 0,
+    RelativesTypeEnum.EXSPOUSE: 0,
+    RelativesTypeEnum.SIBLING: 0,
+    RelativesTypeEnum.HALFSIBLING: 0,
+    RelativesTypeEnum.STEPSIBLING: 0,
+    RelativesTypeEnum.STEPPARENT: -1,
+    RelativesTypeEnum.STEPCHILD: 1
+}
+
+
+def compute_generations(graph, members, fixed=None):
+    """
+    Layer one family component by generation.
+
+    Everyone is first placed one generation below their lowest parent
+    (topological order over PARENT edges, founders at 0). Founders are then
+    pulled down to sit just above their children, and founders without
+    children take the generation of a spouse, sibling or step relative.
+    Finally the component is shifted so that its oldest generation is 0.
+
+    `fixed` holds the stored generations of people outside `members` who are
+    related to them. They count as parents, children and sideways relatives
+    without being moved, and a component hanging from one of them as a
+    parent or child is not shifted.
+
+    Returns:
+        {user_id: generation} for every member.
+    """
+    members = set(members)
+    fixed = fixed or {}
+    parents_of = {m: [p for p in graph.parents(m) if p in members] for m in members}
+    children_of = {m: [c for c in graph.children(m) if c in members] for m in members}
+    fixed_parents_of = {m: [fixed[p] for p in graph.parents(m) if p in fixed] for m in members}
+    fixed_children_of = {m: [fixed[c] for c in graph.children(m) if c in fixed] for m in members}
+
+    waiting = {m: len(parents) for m, parents in parents_of.items()}
+    queue = deque(m for m, count in waiting.items() if count == 0)
+    order = []
+    generations = {}
+    while queue:
+        member = queue.popleft()
+        order.append(member)
+        generations[member] = max(
+            [generations[p] + 1 for p in parents_of[member]]
+            + [generation + 1 for generation in fixed_parents_of[member]], default=0)
+        for child in children_of[member]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                queue.append(child)
+
+    cycle = members - set(generations)
+    if cycle:
+        app.logger.warning(
+            f'Generation layering skipped users {sorted(cycle)} caught in a parent cycle')
+        for member in cycle:
+            generations[member] = 0
+
+    # Moving a founder never breaks another constraint since they have no parents
+    founders = [m for m in order if not parents_of[m] and not fixed_parents_of[m]]
+    for member in founders:
+        if children_of[member] or fixed_children_of[member]:
+            generations[member] = min(
+                [generations[c] for c in children_of[member]] + fixed_children_of[member]) - 1
+
+    # Childless founders are only placed by their sideways relations
+    unplaced = {m for m in founders if not children_of[m] and not fixed_children_of[m]}
+    changed = True
+    while unplaced and changed:
+        changed = False
+        for member in list(unplaced):
+            for relative_user_id, relation in graph.relatives(member):
+                offset = SIDEWAYS_OFFSETS.get(relation)
+                if offset is None or relative_user_id in unplaced:
+                    continue
+                if relative_user_id in members:
+                    generations[member] = generations[relative_user_id] - offset
+                elif relative_user_id in fixed:
+                    generations[member] = fixed[relative_user_id] - offset
+                else:
+                    continue
+                unplaced.discard(member)
+                changed = True
+                break
+
+    if any(fixed_parents_of[m] or fixed_children_of[m] for m in members):
+        return generations
+    lowest = min(generations.values(), default=0)
+    return {member: generation - lowest for member, generation in generations.items()}
+
+
+def affected_members(graph, user_ids):
+    """
+    Return the people whose generation can change when a relation of the
+    given users changes: the users and their descendants, the parentless
+    co-parents of any of them, and the parentless, childless people placed
+    beside any of them.
+    """
+    members = set(user_ids)
+    for user_id in user_ids:
+        members.update(graph.descendants(user_id))
+    for member in list(members):
+        members.update(p for p in graph.parents(member) if not graph.parents(p))
+    for member in list(members):
+        members.update(
+            relative_user_id for relative_user_id, relation in graph.relatives(member)
+            if relation in SIDEWAYS_OFFSETS
+            and not graph.parents(relative_user_id) and not graph.children(relative_user_id))
+    return members
+
+
+def _pieces(graph, members):
+    """
+    Split members into the groups connected by relations among themselves.
+    """
+    pieces, seen = [], set()
+    for member in members:
+        if member in seen:
+            continue
+        piece, stack = set(), [member]
+        seen.add(member)
+        while stack:
+            current = stack.pop()
+            piece.add(current)
+            for relative_user_id in graph.neighbours(current):
+                if relative_user_id in members and relative_user_id not in seen:
+                    seen.add(relative_user_id)
+                    stack.append(relative_user_id)
+        pieces.append(piece)
+    return pieces
+
+
+def _stored_generations(db, person_table, user_ids):
+    """
+    Yield (person_id, user_id, generation) for the given users, reading
+    them BULK_BATCH_SIZE at a time to keep each IN list bounded.
+    """
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), BULK_BATCH_SIZE):
+        yield from db.session.query(
+            person_table.id, person_table.user_id, person_table.generation
+        ).filter(person_table.user_id.in_(user_ids[start:start + BULK_BATCH_SIZE]))
+
+
+def _store(db, person_table, generations, stored):
+    """
+    Write the generations that differ from the stored ones, given as rows of
+    (person_id, user_id, generation). Returns the number of people updated.
+    """
+    changed = [
+        {'id': person_id, 'generation': generations[user_id]}
+        for person_id, user_id, generation in stored
+        if user_id in generations and generation != generations[user_id]
+    ]
+    # person_directory follows through its do_orm_execute listener
+    for start in range(0, len(changed), BULK_BATCH_SIZE):
+        db.session.execute(update(person_table), changed[start:start + BULK_BATCH_SIZE])
+    cursor.commit(db)
+    return len(changed)
+
+
+def refresh_generations(db, person_table, user_ids):
+    """
+    Recompute the generations of the people a relation between the given
+    users can move (see affected_members()), around the stored generations
+    of their other relatives. Call after the relation was added or removed.
+
+    This takes no lock of its own. Relation writes do serialize on the
+    graph_version row they bump, but they release it when they commit,
+    before this runs, so two relation changes racing inside one family can
+    leave it misaligned until `flask rebuild-generations` runs.
+    """
+    with cursor.transaction(db):
+        # Layers are written to the database, so they must come from the
+        # relations as they are now and not from a graph another worker
+        # has since changed
+        graph = get_graph(db, recheck=True)
+        members = affected_members(graph, user_ids)
+        around = {
+            relative_user_id
+            for member in members for relative_user_id in graph.neighbours(member)
+        } - members
+        fixed = {user_id: generation
+                 for _, user_id, generation in _stored_generations(db, person_table, around)}
+        generations = {}
+        for piece in _pieces(graph, members):
+            generations.update(compute_generations(graph, piece, fixed))
+        count = _store(db, person_table, generations,
+                       _stored_generations(db, person_table, generations))
+    app.logger.info(
+        f'Refreshed generations of {len(members)} users around {sorted(user_ids)} ({count} changed)')
+
+
+def rebuild_generations(db, person_table, relatives_table):
+    """
+    Recompute the generation of every person in bulk.
+
+    Returns:
+        The number of people whose generation changed.
+    """
+    with cursor.transaction(db):
+        graph = get_graph(db, for_update=True)
+        generations = {}
+        for members in get_clusters(db).components().values():
+            generations.update(compute_generations(graph, members))
+        related = exists().where(relatives_table.user_id == person_table.user_id)
+        # People without relations are the only generation of their own family
+        reset = db.session.execute(
+            update(person_table)
+            .where(~related)
+            .where(person_table.generation != 0)
+            .values(generation=0)
+            .returning(person_table.user_id))
+        stored = db.session.query(
+            person_table.id, person_table.user_id, person_table.generation
+        ).filter(related)
+        count = len(reset.scalars().all()) + _store(db, person_table, generations, stored)
+    app.logger.info(f'Rebuilt generations of {len(generations)} related users ({count} changed)')
+    return count
+
+
+def same_generation(db, person_table, user_id):
+    """
+    Return the people in the user's family who share their generation,
+    ordered by name.
+    """
+    person = cursor.query(db, person_table, filter_by=True, user_id=user_id).first()
+    if person is None:
+        return []
+    members = [m for m in get_clusters(db).component(user_id) if m != user_id]
+    persons = []
+    # A large family is read BULK_BATCH_SIZE people at a time to keep each
+    # IN list bounded
+    for start in range(0, len(members), BULK_BATCH_SIZE):
+        persons.extend(cursor.query(
+            db, person_table,
+            person_table.user_id.in_(members[start:start + BULK_BATCH_SIZE]),
+            person_table.generation == person.generation
+        ).all())
+    return sorted(persons, key=lambda p: (p.first_name, p.last_name))
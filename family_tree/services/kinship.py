@@ -0,0 +1,379 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app as app
+
+from family_tree.clusters import get_clusters
+from family_tree.cursor import Cursor
+from family_tree.graph import current_graph, get_graph
+from family_tree.lineage import get_lineage
+from family_tree.models import GenderEnum, RelativesTypeEnum
+
+cursor = Cursor()
+
+PATH_CACHE_SIZE = 4096
+
+# Neutral, male and female forms of each relationship noun
+NOUNS = {
+    'self': ('self', 'self', 'self'),
+    'parent': ('parent', 'father', 'mother'),
+    'child': ('child', 'son', 'daughter'),
+    'sibling': ('sibling', 'brother', 'sister'),
+    'pibling': ('aunt/uncle', 'uncle', 'aunt'),
+    'nibling': ('niece/nephew', 'nephew', 'niece'),
+    'cousin': ('cousin', 'cousin', 'cousin'),
+    'spouse': ('spouse', 'husband', 'wife'),
+    'exspouse': ('ex-spouse', 'ex-husband', 'ex-wife'),
+    'stepparent': ('stepparent', 'stepfather', 'stepmother'),
+    'stepchild': ('stepchild', 'stepson', 'stepdaughter'),
+    'stepsibling': ('stepsibling', 'stepbrother', 'stepsister'),
+    'parent-in-law': ('parent-in-law', 'father-in-law', 'mother-in-law'),
+    'child-in-law': ('child-in-law', 'son-in-law', 'daughter-in-law'),
+    'sibling-in-law': ('sibling-in-law', 'brother-in-law', 'sister-in-law')
+}
+
+NON_BLOOD_NOUNS = {
+    RelativesTypeEnum.SPOUSE: 'spouse',
+    RelativesTypeEnum.EXSPOUSE: 'exspouse',
+    RelativesTypeEnum.STEPPARENT: 'stepparent',
+    RelativesTypeEnum.STEPCHILD: 'stepchild',
+    RelativesTypeEnum.STEPSIBLING: 'stepsibling'
+}
+
+ORDINALS = ['first', 'second', 'third', 'fourth', 'fifth',
+            'sixth', 'seventh', 'eighth', 'ninth', 'tenth']
+
+
+class PathCache:
+    """
+    LRU cache of shortest relationship paths keyed on (user_id, other_user_id).
+
+    Entries are indexed by every user on their path. Removing a relation only
+    invalidates paths that touch it, while adding one clears the cache since
+    a new edge can shorten any path. It is cleared too whenever get_graph()
+    reloads the graph because Relatives changed in another process.
+    """
+
+    def __init__(self, maxsize=PATH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+
+    def put(self, key, path):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = path
+            for user_id in (path[0] if path else ()):
+                self._by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        path = self._entries.pop(key, None)
+        for user_id in (path[0] if path else ()):
+            keys = self._by_user.get(user_id)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[user_id]
+
+    def user_removed(self, user_id):
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._discard(key)
+
+    def edge_removed(self, user_id, relative_user_id):
+        self.user_removed(user_id)
+        self.user_removed(relative_user_id)
+
+    def edge_added(self, user_id, relative_user_id):
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+
+def get_path_cache():
+    cache = app.extensions.get('kinship_path_cache')
+    if cache is None:
+        cache = app.extensions['kinship_path_cache'] = PathCache()
+        current_graph().listeners.append(cache)
+    return cache
+
+
+def _expand(graph, frontier, visited, other):
+    """
+    Expand one BFS level. Returns the next frontier and the best meeting
+    point with the other search as (total_hops, node), or None.
+    """
+    next_frontier = []
+    best = None
+    for node in frontier:
+        depth = visited[node][1] + 1
+        for neighbour in graph.neighbours(node):
+            if neighbour in visited:
+                continue
+            visited[neighbour] = (node, depth)
+            next_frontier.append(neighbour)
+            if neighbour in other:
+                total = depth + other[neighbour][1]
+                if best is None or total < best[0]:
+                    best = (total, neighbour)
+    return next_frontier, best
+
+
+def shortest_path(graph, user_id, other_user_id):
+    """
+    Bidirectional BFS between two users over every kind of relation.
+
+    Returns the list of user ids from user_id to other_user_id, or None if
+    the two users are not connected.
+    """
+    if user_id == other_user_id:
+        return [user_id]
+    forward = {user_id: (None, 0)}
+    backward = {other_user_id: (None, 0)}
+    forward_frontier = [user_id]
+    backward_frontier = [other_user_id]
+    while forward_frontier and backward_frontier:
+        # Always grow the smaller side
+        if len(forward_frontier) <= len(backward_frontier):
+            forward_frontier, meet = _expand(graph, forward_frontier, forward, backward)
+        else:
+            backward_frontier, meet = _expand(graph, backward_frontier, backward, forward)
+        if meet:
+            node = meet[1]
+            path = []
+            while node is not None:
+                path.append(node)
+                node = forward[node][0]
+            path.reverse()
+            node = backward[meet[1]][0]
+            while node is not None:
+                path.append(node)
+                node = backward[node][0]
+            return path
+    return None
+
+
+def find_relationship_path(graph, user_id, other_user_id):
+    """
+    Return (user_ids, relations) for the shortest path between two users, where
+    relations[i] is what user_ids[i + 1] is to user_ids[i]. Results are memoized.
+    """
+    cache = get_path_cache()
+    key = (user_id, other_user_id)
+    hit, path = cache.get(key)
+    if hit:
+        return path
+    user_ids = shortest_path(graph, user_id, other_user_id)
+    if user_ids is None:
+        path = None
+    else:
+        relations = [graph.relation(a, b) for a, b in zip(user_ids, user_ids[1:])]
+        path = (tuple(user_ids), tuple(relations))
+    cache.put(key, path)
+    return path
+
+
+def _noun(key, gender):
+    neutral, male, female = NOUNS[key]
+    if gender == GenderEnum.MALE:
+        return male
+    if gender == GenderEnum.FEMALE:
+        return female
+    return neutral
+
+
+def _ordinal(n):
+    return ORDINALS[n - 1] if n <= len(ORDINALS) else f'{n}th'
+
+
+def _times(n):
+    return {1: 'once', 2: 'twice', 3: 'thrice'}.get(n, f'{n} times')
+
+
+def blood_label(up, down, gender=None, half=False):
+    """
+    Label a blood relative reached by going up `up` generations to a common
+    ancestor and down `down` generations from it.
+    """
+    if up == 0 and down == 0:
+        return _noun('self', gender)
+    if down == 0:
+        return 'great-' * (up - 2) + 'grand' * (up >= 2) + _noun('parent', gender)
+    if up == 0:
+        return 'great-' * (down - 2) + 'grand' * (down >= 2) + _noun('child', gender)
+    if up == 1 and down == 1:
+        return 'half-' * half + _noun('sibling', gender)
+    if up == 1:
+        return 'half-' * half + 'great-' * (down - 2) + _noun('nibling', gender)
+    if down == 1:
+        return 'half-' * half + 'great-' * (up - 2) + _noun('pibling', gender)
+    label = 'half-' * half + f'{_ordinal(min(up, down) - 1)} cousin'
+    if up != down:
+        label += f' {_times(abs(up - down))} removed'
+    return label
+
+
+def _parts(relations):
+    """
+    Split a path into blood segments ('blood', up, down, half) and single
+    non-blood steps ('step', noun). A blood segment always goes up then down.
+    """
+    parts = []
+    up = down = 0
+    half = False
+    for relation in relations:
+        if relation in (RelativesTypeEnum.PARENT, RelativesTypeEnum.SIBLING,
+                        RelativesTypeEnum.HALFSIBLING) and down:
+            parts.append(('blood', up, down, half))
+            up = down = 0
+            half = False
+        if relation == RelativesTypeEnum.PARENT:
+            up += 1
+        elif relation == RelativesTypeEnum.CHILD:
+            down += 1
+        elif relation in (RelativesTypeEnum.SIBLING, RelativesTypeEnum.HALFSIBLING):
+            up += 1
+            down += 1
+            half = half or relation == RelativesTypeEnum.HALFSIBLING
+        else:
+            if up or down:
+                parts.append(('blood', up, down, half))
+                up = down = 0
+                half = False
+            parts.append(('step', NON_BLOOD_NOUNS[relation]))
+    if up or down:
+        parts.append(('blood', up, down, half))
+    return parts
+
+
+def _in_law(parts):
+    """
+    Collapse a spouse step next to a parent, child or sibling into an in-law.
+    """
+    spouse = ('step', 'spouse')
+    if len(parts) != 2 or spouse not in parts:
+        return None
+    first, second = parts
+    if first == spouse and second[0] == 'blood':
+        if second[1:3] == (1, 0):
+            return 'parent-in-law'
+        if second[1:3] == (1, 1):
+            return 'sibling-in-law'
+    if second == spouse and first[0] == 'blood':
+        if first[1:3] == (0, 1):
+            return 'child-in-law'
+        if first[1:3] == (1, 1):
+            return 'sibling-in-law'
+    return None
+
+
+def _part_label(part, gender):
+    if part[0] == 'blood':
+        return blood_label(part[1], part[2], gender, part[3])
+    return _noun(part[1], gender)
+
+
+def describe_relationship(relations, gender=None, half=False):
+    """
+    Turn the relations along a path into a label such as "great-aunt" or
+    "second cousin once removed". Only the last word is gendered. Pass
+    half=True for a path through a single shared ancestor.
+    """
+    parts = _parts(relations)
+    if half:
+        parts = [part[:3] + (True,) if part[0] == 'blood' else part for part in parts]
+    if not parts:
+        return _noun('self', gender)
+    in_law = _in_law(parts)
+    if in_law:
+        return _noun(in_law, gender)
+    labels = [_part_label(part, None) for part in parts[:-1]]
+    labels.append(_part_label(parts[-1], gender))
+    return "'s ".join(labels)
+
+
+def blood_path(lineage, user_id, other_user_id):
+    """
+    Return (user_ids, relations, half) through the nearest common ancestor
+    of two blood relatives, or None if they share no ancestor. Preferred over
+    the shortest path so that e.g. a cousin who married a sibling is still
+    labelled a cousin.
+
+    half is True when the two lines meet at exactly one ancestor and each
+    line comes down from it through a child with a different recorded
+    other parent.
+    """
+    common = lineage.nearest_common_ancestors(user_id, other_user_id)
+    if common is None:
+        return None
+    found, up, down = common
+    ancestor_id = found[0]
+    line = lineage.line_to(user_id, ancestor_id)
+    other_line = lineage.line_to(other_user_id, ancestor_id)
+    # With a parent missing from either line the other parent may be shared
+    half = (up > 0 and down > 0 and len(found) == 1
+            and len(lineage.graph.parents(line[-2])) == 2
+            and len(lineage.graph.parents(other_line[-2])) == 2)
+    user_ids = line + other_line[-2::-1]
+    relations = [RelativesTypeEnum.PARENT] * up + [RelativesTypeEnum.CHILD] * down
+    return tuple(user_ids), tuple(relations), half
+
+
+def find_relationship(db, person_table, user_id, other_user_id):
+    """
+    Find how two users are related.
+
+    Returns:
+        None if they are not connected, otherwise a dict with the 'label' and
+        the 'path' as a list of dicts with user_id, name and relationship.
+    """
+    # Reload the graph first if another process changed Relatives, which
+    # also drops the memoized paths, clusters and ancestor tables
+    graph = get_graph(db)
+    half = False
+    if not get_clusters(db).same_family(user_id, other_user_id):
+        path = None
+    else:
+        blood = blood_path(get_lineage(db), user_id, other_user_id)
+        if blood is None:
+            path = find_relationship_path(graph, user_id, other_user_id)
+        else:
+            path, half = blood[:2], blood[2]
+    if path is None:
+        app.logger.info(f'No relationship path between users {user_id} and {other_user_id}')
+        return None
+    user_ids, relations = path
+
+    persons = {
+        person.user_id: person
+        for person in cursor.query(db, person_table, person_table.user_id.in_(user_ids)).all()
+    }
+    target = persons.get(other_user_id)
+    steps = []
+    for i, step_user_id in enumerate(user_ids):
+        person = persons.get(step_user_id)
+        steps.append({
+            'user_id': step_user_id,
+            'name': f'{person.first_name} {person.last_name}' if person else 'Unknown',
+            'relationship': relations[i - 1].value if i else None
+        })
+    return {
+        'label': describe_relationship(relations, target.gender if target else None, half),
+        'path': steps
+    }
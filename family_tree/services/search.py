@@ -0,0 +1,237 @@
+"""
+Name search over Person.
+
+A person matches when every search term is a prefix of one of their names,
+when a term is close to their first or last name (trigram similarity, so
+typos are tolerated), or when a term sounds like their first or last name
+(Soundex). Prefix matches rank first, then by similarity.
+
+PostgreSQL answers from pg_trgm, tsvector and soundex() expression indexes
+on person. SQLite reads the person_search FTS5 table (trigram tokenizer),
+which is kept in sync with every write to Person like person_directory, and
+ranks the candidates in Python the way pg_trgm does.
+"""
+import re
+
+from flask import current_app as app
+from sqlalchemy import bindparam, case, event, func, literal_column, or_, select, text
+
+from family_tree.core_writes import invoke_statement, written_user_ids
+from family_tree.cursor import Cursor
+from family_tree.models import Person
+
+cursor = Cursor()
+
+# Queries shorter than this are not searched; trigram indexes need 3 characters
+MIN_QUERY_LENGTH = 3
+DEFAULT_SEARCH_LIMIT = 20
+# Same default as pg_trgm.similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+# Candidates fetched from FTS5 per requested result before ranking
+CANDIDATE_FACTOR = 5
+
+_TERM = re.compile(r'\w+')
+_SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'), **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'), 'l': '4', **dict.fromkeys('mn', '5'), 'r': '6'
+}
+
+
+def search_terms(query):
+    return _TERM.findall(query.lower())
+
+
+def soundex(word):
+    """
+    American Soundex code of a word, as computed by PostgreSQL's soundex().
+    """
+    letters = [c for c in word.lower() if 'a' <= c <= 'z']
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = _SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = _SOUNDEX_CODES.get(letter)
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate letters with the same code, vowels do
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+def _trigrams(value):
+    """
+    Trigrams of a string the way pg_trgm extracts them: per word, lowercased
+    and padded with two spaces in front and one behind.
+    """
+    trigrams = set()
+    for word in search_terms(value):
+        padded = f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def similarity(first, second):
+    first, second = _trigrams(first), _trigrams(second)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def full_name(first_name, middle_name, last_name):
+    return ' '.join(name for name in (first_name, middle_name, last_name) if name)
+
+
+def search_people(db, person_table, query, limit=DEFAULT_SEARCH_LIMIT):
+    """
+    Search people by name.
+
+    Returns:
+        A list of {'user_id', 'name'} dicts, best matches first.
+    """
+    terms = search_terms(query)
+    if len(''.join(terms)) < MIN_QUERY_LENGTH:
+        return []
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        rows = _search_postgresql(db, person_table, terms, limit)
+    elif dialect == 'sqlite':
+        rows = _search_sqlite(db, person_table, terms, limit)
+    else:
+        raise NotImplementedError(f"Name search does not support the {dialect} dialect")
+    return [{'user_id': user_id, 'name': full_name(first_name, middle_name, last_name)}
+            for user_id, first_name, middle_name, last_name in rows]
+
+
+def name_expression(person_table):
+    """
+    The lowercased full name that the PostgreSQL tsvector index is built on.
+    """
+    return func.lower(person_table.first_name + ' ' + func.coalesce(person_table.middle_name, '')
+                      + ' ' + person_table.last_name)
+
+
+def _person_columns(person_table):
+    return (person_table.user_id, person_table.first_name,
+            person_table.middle_name, person_table.last_name)
+
+
+def _search_postgresql(db, person_table, terms, limit):
+    simple = literal_column("'simple'::regconfig")
+    prefix = func.to_tsvector(simple, name_expression(person_table)).op('@@')(
+        func.to_tsquery(simple, ' & '.join(f'{term}:*' for term in terms)))
+    names = (func.lower(person_table.first_name), func.lower(person_table.last_name))
+    close = [name.op('%')(term) for term in terms for name in names]
+    sounds_like = [
+        func.soundex(column) == func.soundex(term)
+        for term in terms for column in (person_table.first_name, person_table.last_name)
+    ]
+    score = sum(func.greatest(*[func.similarity(name, term) for name in names]) for term in terms)
+    return db.session.execute(
+        select(*_person_columns(person_table))
+        .where(or_(prefix, *close, *sounds_like))
+        .order_by(case((prefix, 0), else_=1), score.desc(),
+                  person_table.last_name, person_table.first_name)
+        .limit(limit)
+    ).all()
+
+
+def _search_sqlite(db, person_table, terms, limit):
+    trigrams = {term[i:i + 3] for term in terms for i in range(len(term) - 2)}
+    codes = {soundex(term) for term in terms}
+    match = ' OR '.join(
+        [f'names : "{trigram}"' for trigram in sorted(trigrams)]
+        + [f'phonetic : "{code}"' for code in sorted(codes)])
+    candidate_ids = db.session.execute(text(
+        'SELECT rowid FROM person_search WHERE person_search MATCH :match '
+        'ORDER BY rank LIMIT :candidates'
+    ), {'match': match, 'candidates': limit * CANDIDATE_FACTOR}).scalars().all()
+    if not candidate_ids:
+        return []
+
+    ranked = []
+    for row in db.session.execute(
+            select(*_person_columns(person_table))
+            .where(person_table.user_id.in_(candidate_ids))):
+        names = search_terms(full_name(*row[1:]))
+        first_last = (row.first_name, row.last_name)
+        prefix = all(any(name.startswith(term) for name in names) for term in terms)
+        scores = [max(similarity(name, term) for name in first_last) for term in terms]
+        close = max(scores) >= SIMILARITY_THRESHOLD
+        sounds_like = bool(codes & {soundex(name) for name in first_last})
+        if prefix or close or sounds_like:
+            ranked.append(((not prefix, -sum(scores), row.last_name, row.first_name), tuple(row)))
+    ranked.sort(key=lambda item: item[0])
+    return [row for _, row in ranked[:limit]]
+
+
+def _index_rows(session, person_table, *where):
+    rows = [{
+        'user_id': user_id,
+        'names': full_name(first_name, middle_name, last_name).lower(),
+        'phonetic': ' '.join(soundex(name) for name in (first_name, middle_name, last_name) if name)
+    } for user_id, first_name, middle_name, last_name in session.execute(
+        select(*_person_columns(person_table)).where(*where))]
+    if rows:
+        session.execute(text(
+            'INSERT INTO person_search (rowid, names, phonetic) '
+            'VALUES (:user_id, :names, :phonetic)'), rows)
+    return len(rows)
+
+
+def _refresh(session, person_table, user_ids):
+    session.execute(
+        text('DELETE FROM person_search WHERE rowid IN :user_ids')
+        .bindparams(bindparam('user_ids', expanding=True)),
+        {'user_ids': list(user_ids)})
+    _index_rows(session, person_table, person_table.user_id.in_(user_ids))
+
+
+def rebuild_search_index(db, person_table):
+    """
+    Rebuild the SQLite person_search table from Person. PostgreSQL searches
+    person directly, so there is nothing to rebuild there.
+
+    Returns:
+        The number of people indexed.
+    """
+    if db.session.get_bind().dialect.name != 'sqlite':
+        return 0
+    with cursor.transaction(db):
+        db.session.execute(text('DELETE FROM person_search'))
+        count = _index_rows(db.session, person_table)
+    app.logger.info(f'Rebuilt the name search index with {count} people')
+    return count
+
+
+def _after_flush(session, flush_context):
+    user_ids = {
+        instance.user_id
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, Person) and instance.user_id is not None
+    }
+    if user_ids and session.get_bind().dialect.name == 'sqlite':
+        _refresh(session, Person, user_ids)
+
+
+def _do_orm_execute(orm_execute_state):
+    # Core INSERT, UPDATE and DELETE statements bypass the flush
+    session = orm_execute_state.session
+    user_ids = written_user_ids(orm_execute_state, Person)
+    if not user_ids or session.get_bind().dialect.name != 'sqlite':
+        return None
+    result = invoke_statement(orm_execute_state, user_ids)
+    _refresh(session, Person, user_ids)
+    return result
+
+
+def init_search(db):
+    """
+    Keep the SQLite person_search table in sync with every write to Person.
+    """
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'do_orm_execute', _do_orm_execute)
@@ -2,13 +2,22 @@ import secrets
 import os
 
 from PIL import Image
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 
 from flask import (
     flash,
     current_app as app
 )
 
-from family_tree.cursor import Cursor
+from family_tree.cursor import Cursor, DEFAULT_PAGE_SIZE
+from family_tree.graph import committed_versions, current_graph
+from family_tree.query_cache import CACHE_OPTION
+from family_tree.routing import REPLICA_OPTION
+from family_tree.services.chart import bump_family
+from family_tree.services.closure import lineage_edge, refresh_closure
+from family_tree.services.generation import refresh_generations
 
 cursor = Cursor()
 
@@ -39,7 +48,7 @@ def update_profile_picture(db, picture_table, user, picture_filename):
 
         # Change profile picture filename in database
         user.profile_picture.picture_filename = picture_filename
-        db.session.commit()
+        cursor.commit(db)
         app.logger.info(f'Change profile picture filename of user {user.username}')
     else:
         cursor.add(db, picture_table, user_id=user.id, picture_filename = picture_filename)
@@ -55,7 +64,8 @@ def update_person(db, user, form):
         user.person.last_name = form.last_name.data
     if form.gender.data is not None:
         user.person.gender = form.gender.data
-    db.session.commit()
+    cursor.commit(db)
+    bump_family(db, user.id)
 
 
 def prefill_address_form(form, address):
@@ -78,30 +88,104 @@ def fill_address_from_form(address, form):
     address.landmark = form.landmark.data
 
 
-def get_relative_details(db, table, relatives):
-    relative_details = []
-    for rel in relatives:
-        relative_user = cursor.query(
-            db, table, filter_by=True, id=rel.relative_user_id).first()
-        person = relative_user.person
-        if person:
-            relative_details.append({
-                'first_name': person.first_name,
-                'middle_name': person.middle_name,
-                'last_name': person.last_name,
-                'relationship': rel.relation_type.value,
-                'relative_user_id': rel.relative_user_id
-            })
-    return relative_details
-
-
-def prefill_upsert_relative_form(db, user_table, user_id, form):
-    all_users = cursor.query(db, user_table, filter_by=False).all()
-    form.relative_user_id.choices = [
-        (u.id, f'{u.person.first_name} {u.person.last_name}')
-        for u in all_users
-        if u.id != user_id and u.person is not None
+def get_relative_details(db, relatives_table, directory_table, user_id, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return one page of the details of a user's relatives with a profile,
+    read together with their person_directory rows in a single joined query.
+
+    Returns:
+        (details, next_token) as from cursor.paginate().
+    """
+    query = db.session.query(
+        relatives_table.relative_user_id,
+        relatives_table.relation_type,
+        directory_table.display_name
+    ).join(
+        directory_table, directory_table.user_id == relatives_table.relative_user_id
+    ).filter(relatives_table.user_id == user_id).execution_options(**{CACHE_OPTION: True})
+    rows, next_token = cursor.paginate(query, [relatives_table.id], after=after, limit=limit)
+    details = [
+        {
+            'display_name': display_name,
+            'relationship': relation_type.value,
+            'relative_user_id': relative_user_id
+        }
+        for relative_user_id, relation_type, display_name in rows
     ]
+    return details, next_token
+
+
+def get_profile_overview(db, person_table, address_table, dates_table,
+                         contacts_table, relatives_table, user_id):
+    """
+    Fetch everything shown on a user's overview page concurrently with
+    cursor.gather(): their person, addresses, important dates, contact
+    details and the first DEFAULT_PAGE_SIZE relatives with a profile.
+
+    Returns:
+        {'person', 'addresses', 'important_dates', 'contact_details',
+         'relatives'}, where relatives are rows of (relative_user_id,
+        relation_type, first_name, middle_name, last_name).
+    """
+    relatives = select(
+        relatives_table.relative_user_id,
+        relatives_table.relation_type,
+        person_table.first_name,
+        person_table.middle_name,
+        person_table.last_name
+    ).join(
+        person_table, person_table.user_id == relatives_table.relative_user_id
+    ).where(relatives_table.user_id == user_id).order_by(relatives_table.id).limit(DEFAULT_PAGE_SIZE)
+    relatives = relatives.execution_options(**{REPLICA_OPTION: True})
+    return cursor.gather(
+        db,
+        person=lambda db: cursor.query(db, person_table, filter_by=True, user_id=user_id).first(),
+        addresses=lambda db: cursor.query(db, address_table, filter_by=True, user_id=user_id).all(),
+        important_dates=lambda db: cursor.query(db, dates_table, filter_by=True, user_id=user_id).all(),
+        contact_details=lambda db: cursor.query(
+            db, contacts_table, filter_by=True, user_id=user_id).all(),
+        relatives=lambda db: db.session.execute(relatives).all()
+    )
+
+
+# Column order of the rows returned by get_neighbourhood
+NEIGHBOURHOOD_FIELDS = ('user_id', 'relation', 'first_name', 'last_name',
+                        'gender', 'picture', 'relative_count')
+
+
+def get_neighbourhood(db, relatives_table, person_table, picture_table, user_id):
+    """
+    Return a user's immediate relatives as rows ordered like
+    NEIGHBOURHOOD_FIELDS, in a single query. relative_count tells a tree
+    viewer whether the relative can be expanded further.
+    """
+    others = aliased(relatives_table)
+    relative_count = db.session.query(func.count(others.id)).filter(
+        others.user_id == relatives_table.relative_user_id
+    ).scalar_subquery()
+    rows = db.session.query(
+        relatives_table.relative_user_id,
+        relatives_table.relation_type,
+        person_table.first_name,
+        person_table.last_name,
+        person_table.gender,
+        picture_table.picture_filename,
+        relative_count
+    ).join(
+        person_table, person_table.user_id == relatives_table.relative_user_id
+    ).outerjoin(
+        picture_table, picture_table.user_id == relatives_table.relative_user_id
+    ).filter(
+        relatives_table.user_id == user_id
+    ).order_by(relatives_table.relation_type, person_table.first_name)
+    return [
+        [relative_user_id, relation_type.value, first_name, last_name,
+         gender.value, picture_filename, count]
+        for relative_user_id, relation_type, first_name, last_name, gender, picture_filename, count in rows
+    ]
+
+
+def prefill_upsert_relative_form(form):
     form.relation_type.choices = [
         ('PARENT', 'PARENT'),
         ('STEPPARENT', 'STEPPARENT'),
@@ -113,153 +197,225 @@ def prefill_upsert_relative_form(db, user_table, user_id, form):
 
 
 def check_relative_constraints(db, user_table, relatives_table, user, form):
-    # Check if the relative exists
-    relative_user = cursor.query(
-        db, user_table, filter_by=True, id=int(form.relative_user_id.data)).first()
-    if not relative_user:
-        app.logger.warning("Relative user not found.")
-        flash("The selected relative does not exist.", "danger")
-        return False
+    # Read from the primary so that a lagging replica cannot hide a relation
+    # that already exists
+    with cursor.transaction(db):
+        # Check if the relative exists
+        relative_user = cursor.prepared(
+            db, 'user_by_id', user_table, id=int(form.relative_user_id.data)).first()
+        if not relative_user:
+            app.logger.warning("Relative user not found.")
+            flash("The selected relative does not exist.", "danger")
+            return False
 
-    # Check if the user is trying to add themselves as a relative
-    if relative_user and relative_user.id == user.id:
-        app.logger.warning("User attempted to add themselves as a relative.")
-        flash("You cannot add yourself as a relative.", "danger")
-        return False
+        # Check if the user is trying to add themselves as a relative
+        if relative_user and relative_user.id == user.id:
+            app.logger.warning("User attempted to add themselves as a relative.")
+            flash("You cannot add yourself as a relative.", "danger")
+            return False
 
-    # Check for duplicate relationships. There can only be one relationship between two users in one direction.
-    existing_relation = cursor.query(
-        db,
-        relatives_table,
-        filter_by=True,
-        user_id=user.id,
-        relative_user_id=int(form.relative_user_id.data)).first()
-    if existing_relation:
-        app.logger.warning(
-            "User attempted to add more than one relationship to a relative.")
-        flash("This relationship already exists.", "danger")
-        return False
+        # Check for duplicate relationships. There can only be one relationship between two users in one direction.
+        existing_relation = cursor.prepared(
+            db,
+            'relation_between',
+            relatives_table,
+            user_id=user.id,
+            relative_user_id=int(form.relative_user_id.data)).first()
+        if existing_relation:
+            app.logger.warning(
+                "User attempted to add more than one relationship to a relative.")
+            flash("This relationship already exists.", "danger")
+            return False
 
-    # Check that both user profiles exist
-    if not user.person or not relative_user.person:
-        app.logger.warning(
-            "One or both of the users does not have a complete profile.")
-        flash(
-            "Both users must have complete profiles to establish a relationship.", "danger")
-        return False
+        # Check that both user profiles exist
+        if not user.person or not relative_user.person:
+            app.logger.warning(
+                "One or both of the users does not have a complete profile.")
+            flash(
+                "Both users must have complete profiles to establish a relationship.", "danger")
+            return False
+
+        return True
+
+
+def check_lineage(db, closure_table, user_id, relative_user_id, relation_type):
+    """
+        Reject relations that contradict the existing lineage, using the
+        ancestry closure table as a reachability index so that the check is a
+        single indexed lookup regardless of the size of the tree.
+        1. a PARENT/CHILD relation must not make anyone their own ancestor
+        2. siblings cannot be each other's ancestor or descendant
+        Run it inside cursor.transaction() so that it reads from the primary.
 
+        Returns:
+            Bool
+    """
+    edge = lineage_edge(user_id, relative_user_id, relation_type)
+    if edge:
+        child_id, parent_id = edge
+        cycle = cursor.prepared(db, 'ancestor_of', closure_table,
+                                ancestor_id=child_id, descendant_id=parent_id).first()
+        if cycle:
+            app.logger.warning(
+                f'relation between {user_id} and {relative_user_id} would make user {child_id} their own ancestor')
+            flash('This relation would make a person their own ancestor.', 'danger')
+            return False
+
+    elif relation_type in ('SIBLING', 'HALFSIBLING'):
+        lineal = cursor.prepared(db, 'lineal_relatives', closure_table,
+                                 user_id=user_id, relative_user_id=relative_user_id).first()
+        if lineal:
+            app.logger.warning(
+                f'user {user_id} tried to add a direct ancestor or descendant {relative_user_id} as a sibling')
+            flash('A sibling cannot also be an ancestor or descendant.', 'danger')
+            return False
     return True
 
 
-def check_validity_relation(db, user_table, relatives_table, user, relative_user_id, relation_type):
+def check_validity_relation(db, user_table, relatives_table, closure_table, user, relative_user_id,
+                            relation_type):
     """
         This function assumes that 
         1. both user and relative exist 
         2. both user and relative profiles are created
         3. no previous relationship exists between user and relative
         4. user and relative are different
+        Lineage contradictions are rejected by check_lineage().
 
         Returns:
             Bool
     """
-    relative = cursor.query(db, user_table, filter_by=True,
-                            id=relative_user_id).first()
-    if not relative:
-        app.logger.warning(
-            f'relative user id {relative_user_id} does not exist')
-        return False
-
-    # Checks for relation_type PARENT
-    if relation_type == 'PARENT':
-        parents = cursor.query(db, relatives_table, filter_by=True,
-                               user_id=user.id, relation_type='PARENT').all()
-        # Check if there are currently no parents
-        if not parents:
-            app.logger.info(f'user {user.id} has no parents currently added')
-            return True
-        # Check if there already exists two parents
-        if len(parents) >= 2:
-            app.logger.warning(f'user {user.id} already has two parents')
-            flash('User already has two parents', 'danger')
-            return False
-
-        # Check if father already exists
-        parent = cursor.query(db, user_table, filter_by=True,
-                              id=parents[0].relative_user_id).first().person
-        if parent.gender.value == 'MALE' and relative.person.gender.value == 'MALE':
+    # Read from the primary so that a lagging replica cannot let a cycle,
+    # a third parent or a second spouse through
+    with cursor.transaction(db):
+        relative = cursor.prepared(db, 'user_by_id', user_table, id=int(relative_user_id)).first()
+        if not relative:
             app.logger.warning(
-                f'user {user.id} tried to add a father when one already exists')
-            flash(
-                'Cannot add parent as parent of the same gender already exists', 'danger')
+                f'relative user id {relative_user_id} does not exist')
             return False
 
-        # Check if mother already exists
-        if parent.gender.value == 'FEMALE' and relative.person.gender.value == 'FEMALE':
-            app.logger.warning(
-                f'user {user.id} tried to add a father when one already exists')
-            flash(
-                'Cannot add parent as parent of the same gender already exists', 'danger')
+        if not check_lineage(db, closure_table, user.id, int(relative_user_id), relation_type):
             return False
 
-    # Check for relation_type 'SPOUSE'
-    elif relation_type == 'SPOUSE':
-        spouse = cursor.query(
-            db, relatives_table, filter_by=True, user_id=user.id, relation_type='SPOUSE').first()
-        if not spouse:
-            app.logger.info(f'No spouse found for user {user.id}')
-            return True
-        else:
-            app.logger.info(f'user {user.id} already has a spouse')
-            flash('Cannot add more than one spouse', 'danger')
-            return False
-    return True
+        # Checks for relation_type PARENT
+        if relation_type == 'PARENT':
+            parents = cursor.prepared(db, 'relations_of_type', relatives_table,
+                                      user_id=user.id, relation_type='PARENT').all()
+            # Check if there are currently no parents
+            if not parents:
+                app.logger.info(f'user {user.id} has no parents currently added')
+                return True
+            # Check if there already exists two parents
+            if len(parents) >= 2:
+                app.logger.warning(f'user {user.id} already has two parents')
+                flash('User already has two parents', 'danger')
+                return False
+
+            # Check if father already exists
+            parent = cursor.prepared(db, 'user_by_id', user_table,
+                                     id=parents[0].relative_user_id).first().person
+            if parent.gender.value == 'MALE' and relative.person.gender.value == 'MALE':
+                app.logger.warning(
+                    f'user {user.id} tried to add a father when one already exists')
+                flash(
+                    'Cannot add parent as parent of the same gender already exists', 'danger')
+                return False
+
+            # Check if mother already exists
+            if parent.gender.value == 'FEMALE' and relative.person.gender.value == 'FEMALE':
+                app.logger.warning(
+                    f'user {user.id} tried to add a father when one already exists')
+                flash(
+                    'Cannot add parent as parent of the same gender already exists', 'danger')
+                return False
+
+        # Check for relation_type 'SPOUSE'
+        elif relation_type == 'SPOUSE':
+            spouse = cursor.prepared(
+                db, 'relations_of_type', relatives_table, user_id=user.id, relation_type='SPOUSE').first()
+            if not spouse:
+                app.logger.info(f'No spouse found for user {user.id}')
+                return True
+            else:
+                app.logger.info(f'user {user.id} already has a spouse')
+                flash('Cannot add more than one spouse', 'danger')
+                return False
+        return True
 
 
-def add_relative_to_database(db, relative_table, relative_enum, user, form):
-    cursor.add(
-        db,
-        relative_table,
-        user_id=user.id,
-        relative_user_id=int(form.relative_user_id.data),
-        relation_type=relative_enum(form.relation_type.data)
-    )
-    cursor.add(
-        db,
-        relative_table,
-        user_id=int(form.relative_user_id.data),
-        relative_user_id=user.id,
-        relation_type=relative_enum(
-            relative_table.get_reverse_relation(form.relation_type.data)
-        )
-    )
+def add_relative_to_database(db, relative_table, relative_enum, closure_table, person_table, user,
+                             form):
+    relative_user_id = int(form.relative_user_id.data)
+    edge = lineage_edge(user.id, relative_user_id, form.relation_type.data)
+    # The forward and reverse rows and the closure are committed together
+    try:
+        with cursor.transaction(db):
+            cursor.add(
+                db,
+                relative_table,
+                user_id=user.id,
+                relative_user_id=relative_user_id,
+                relation_type=relative_enum(form.relation_type.data)
+            )
+            cursor.add(
+                db,
+                relative_table,
+                user_id=relative_user_id,
+                relative_user_id=user.id,
+                relation_type=relative_enum(
+                    relative_table.get_reverse_relation(form.relation_type.data)
+                )
+            )
+            if edge:
+                refresh_closure(db, closure_table, relative_table, edge[0])
+    except IntegrityError:
+        # Another request added a relation between the two users after the
+        # checks ran; the unique index on Relatives turned this one away.
+        # A failed commit leaves the session to be rolled back here.
+        db.session.rollback()
+        app.logger.warning(
+            f'relation between user {user.id} and {relative_user_id} was added concurrently')
+        flash("This relationship already exists.", "danger")
+        return False
+    current_graph().add_edge(user.id, relative_user_id, form.relation_type.data,
+                             versions=committed_versions(db))
+    refresh_generations(db, person_table, [user.id, relative_user_id])
     app.logger.info(f"Relative added for user {user.username}.")
+    return True
 
 
-def delete_relative_from_database(db, user_table, relatives_table, user, relative_user_id):
+def delete_relative_from_database(db, user_table, relatives_table, closure_table, person_table,
+                                  user, relative_user_id):
     app.logger.info(
         f'Attempt to delete relative {relative_user_id} of user {user.id}')
-    relation = cursor.query(db, relatives_table, filter_by=True,
-                            user_id=user.id, relative_user_id=relative_user_id).first()
-    if not relation:
-        app.logger.info(
-            f'Could not find relative of user {user.id} with relative user id {relative_user_id}')
-        flash(
-            f'Could not find relation with relative user id {relative_user_id}')
-        return False
-    else:
-        reverse_relation = cursor.query(
-            db, relatives_table, filter_by=True, user_id=relative_user_id, relative_user_id=user.id).first()
-        if not reverse_relation:
+    pair = or_(
+        and_(relatives_table.user_id == user.id,
+             relatives_table.relative_user_id == relative_user_id),
+        and_(relatives_table.user_id == relative_user_id,
+             relatives_table.relative_user_id == user.id)
+    )
+    # The rows to delete are looked up inside the transaction, which reads
+    # from the primary, so a lagging replica cannot hide them
+    with cursor.transaction(db):
+        # Both directions are fetched in one round trip
+        rows = cursor.query(db, relatives_table, pair).all()
+        relation = next((row for row in rows if row.user_id == user.id), None)
+        if not relation:
             app.logger.info(
-                f'Could not find reverse relation from relative {relative_user_id} to user {user.id}')
-        else:
-            cursor.delete(db, relatives_table,
-                          user_id=relative_user_id, relative_user_id=user.id)
+                f'Could not find relative of user {user.id} with relative user id {relative_user_id}')
+            flash(
+                f'Could not find relation with relative user id {relative_user_id}')
+            return False
+        edge = lineage_edge(user.id, relative_user_id, relation.relation_type)
+        if len(rows) < 2:
             app.logger.info(
-                f'Successfully deleled reverse relation from relative {relative_user_id} to user {user.id}')
-        cursor.delete(db, relatives_table, user_id=user.id,
-                      relative_user_id=relative_user_id)
-        app.logger.info(
-            f'Successfully deleled relation from user {user.id} to relative {relative_user_id}')
-        return True
+                f'Could not find reverse relation from relative {relative_user_id} to user {user.id}')
+        cursor.delete(db, relatives_table, pair)
+        if edge:
+            refresh_closure(db, closure_table, relatives_table, edge[0])
+    current_graph().remove_edge(user.id, relative_user_id, versions=committed_versions(db))
+    refresh_generations(db, person_table, [user.id, relative_user_id])
+    app.logger.info(
+        f'Successfully deleled relation between user {user.id} and relative {relative_user_id}')
+    return True
     
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+Per-request SQL instrumentation.
+
+Engine events time every statement executed while a request is handled.
+At the end of the request the totals are reported in a Server-Timing
+header and a debug log line, and a warning is logged for every statement
+shape that ran more than SQL_REPEAT_WARNING times, which usually means a
+relationship is lazy loaded inside a loop (N+1 queries).
+"""
+import heapq
+import re
+import threading
+import time
+
+from flask import current_app as app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SQL_STATS = False
+DEFAULT_SQL_REPEAT_WARNING = 10
+DEFAULT_SQL_SLOWEST_SHOWN = 3
+
+# Runs of bind placeholders, e.g. the expanded parameters of an IN clause
+_PLACEHOLDERS = re.compile(r'(\?|%\(\w+\)s|%s|:\w+)(\s*,\s*(\?|%\(\w+\)s|%s|:\w+))+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """
+    Return the statement with its whitespace and placeholder lists collapsed,
+    so that the same query run with different parameters has one shape.
+    """
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    return _PLACEHOLDERS.sub('?', statement)
+
+
+class SqlStats:
+    def __init__(self, slowest_shown=DEFAULT_SQL_SLOWEST_SHOWN):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = {}
+        self._slowest_shown = slowest_shown
+        self._slowest = []
+        # cursor.gather() threads record into their request's stats
+        self._lock = threading.Lock()
+
+    def record(self, statement, duration):
+        shape = statement_shape(statement)
+        with self._lock:
+            self.count += 1
+            self.duration += duration
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+            entry = (duration, self.count, shape)
+            if len(self._slowest) < self._slowest_shown:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest_shown:
+                heapq.heappushpop(self._slowest, entry)
+
+    def slowest(self):
+        """
+        Return (duration, shape) of the slowest statements, slowest first.
+        """
+        return [(duration, shape) for duration, _, shape in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, threshold):
+        """
+        Return {shape: count} of the statement shapes run more than threshold times.
+        """
+        return {shape: count for shape, count in self.shapes.items() if count > threshold}
+
+
+def current_stats():
+    """
+    Return the SQL stats of the current request, or None outside a request
+    or when instrumentation is disabled. The app contexts of cursor.gather()
+    threads carry their request's stats.
+    """
+    if not has_app_context():
+        return None
+    return g.get('sql_stats')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_stats() is not None:
+        context._sql_stats_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_sql_stats_start', None)
+    stats = current_stats()
+    if start is None or stats is None:
+        return
+    stats.record(statement, time.perf_counter() - start)
+
+
+def _start_request():
+    g.sql_stats = SqlStats(app.config.get('SQL_SLOWEST_SHOWN', DEFAULT_SQL_SLOWEST_SHOWN))
+
+
+def _report_request(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+    milliseconds = stats.duration * 1000
+    response.headers.add(
+        'Server-Timing', f'db;dur={milliseconds:.2f};desc="{stats.count} queries"')
+    slowest = '; '.join(f'{duration * 1000:.2f}ms {shape}' for duration, shape in stats.slowest())
+    app.logger.debug(
+        f'{request.method} {request.path} ran {stats.count} queries in {milliseconds:.2f}ms'
+        + (f', slowest: {slowest}' if slowest else ''))
+    threshold = app.config.get('SQL_REPEAT_WARNING', DEFAULT_SQL_REPEAT_WARNING)
+    for shape, count in stats.repeated(threshold).items():
+        app.logger.warning(
+            f'{request.method} {request.path} ran the same statement {count} times: {shape}')
+    return response
+
+
+def init_sql_stats(app):
+    """
+    Instrument an app's requests if SQL_STATS is set.
+    """
+    if not app.config.get('SQL_STATS', DEFAULT_SQL_STATS):
+        return
+    app.before_request(_start_request)
+    app.after_request(_report_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
@@ -0,0 +1,98 @@
+"""
+Prebuilt, parameterised statements for the queries that run on every
+request (login, load_user and the relative checks).
+
+Each statement is built once per set of tables with bindparam()
+placeholders and then reused, so the hot paths only bind values instead of
+rebuilding a query object and its filters on every call. Execute them with
+cursor.prepared(db, name, *tables, **params).
+
+Statements read from a replica like cursor.query() does, unless the session
+already reads from the primary. Checks that decide whether a write is
+allowed run them inside cursor.transaction() for that reason.
+"""
+from sqlalchemy import and_, bindparam, or_, select
+
+from family_tree.routing import REPLICA_OPTION
+
+
+class StatementRegistry:
+    def __init__(self):
+        self._builders = {}
+        self._statements = {}
+
+    def register(self, name):
+        """
+        Decorator registering a function that builds the statement `name`
+        from the tables it is given.
+        """
+        def decorator(builder):
+            if name in self._builders:
+                raise ValueError(f"Statement {name!r} is already registered")
+            self._builders[name] = builder
+            return builder
+        return decorator
+
+    def get(self, name, *tables):
+        key = (name, tables)
+        statement = self._statements.get(key)
+        if statement is None:
+            try:
+                builder = self._builders[name]
+            except KeyError:
+                raise KeyError(f"No statement registered as {name!r}")
+            statement = builder(*tables).execution_options(**{REPLICA_OPTION: True})
+            self._statements[key] = statement
+        return statement
+
+    def __contains__(self, name):
+        return name in self._builders
+
+
+statements = StatementRegistry()
+
+
+@statements.register('user_by_id')
+def _user_by_id(user_table):
+    return select(user_table).where(user_table.id == bindparam('id'))
+
+
+@statements.register('user_by_email')
+def _user_by_email(user_table):
+    return select(user_table).where(user_table.email == bindparam('email'))
+
+
+@statements.register('user_by_username')
+def _user_by_username(user_table):
+    return select(user_table).where(user_table.username == bindparam('username'))
+
+
+@statements.register('relation_between')
+def _relation_between(relatives_table):
+    return select(relatives_table).where(
+        relatives_table.user_id == bindparam('user_id'),
+        relatives_table.relative_user_id == bindparam('relative_user_id'))
+
+
+@statements.register('relations_of_type')
+def _relations_of_type(relatives_table):
+    return select(relatives_table).where(
+        relatives_table.user_id == bindparam('user_id'),
+        relatives_table.relation_type == bindparam('relation_type'))
+
+
+@statements.register('ancestor_of')
+def _ancestor_of(closure_table):
+    return select(closure_table).where(
+        closure_table.ancestor_id == bindparam('ancestor_id'),
+        closure_table.descendant_id == bindparam('descendant_id'))
+
+
+@statements.register('lineal_relatives')
+def _lineal_relatives(closure_table):
+    return select(closure_table).where(or_(
+        and_(closure_table.ancestor_id == bindparam('user_id'),
+             closure_table.descendant_id == bindparam('relative_user_id')),
+        and_(closure_table.ancestor_id == bindparam('relative_user_id'),
+             closure_table.descendant_id == bindparam('user_id'))
+    ))
@@ -0,0 +1,79 @@
+"""index foreign keys and relatives lookups
+
+Revision ID: 5d1f3b7a9e24
+Revises: 9c2d7a41e5b8
+Create Date: 2026-10-18 19:32:45.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1f3b7a9e24'
+down_revision = '9c2d7a41e5b8'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns, unique)
+INDEXES = [
+    ('ix_picture_user_id', 'picture', ['user_id'], False),
+    ('ix_person_user_id', 'person', ['user_id'], False),
+    ('ix_address_user_id', 'address', ['user_id'], False),
+    ('ix_important_dates_user_id', 'important_dates', ['user_id'], False),
+    ('ix_contact_details_user_id', 'contact_details', ['user_id'], False),
+    ('ix_relatives_relative_user_id', 'relatives', ['relative_user_id'], False),
+    ('ix_relatives_user_id_relation_type', 'relatives', ['user_id', 'relation_type'], False),
+    # upgrade() refuses to run while rows would violate it
+    ('uq_relatives_user_id_relative_user_id', 'relatives', ['user_id', 'relative_user_id'], True),
+]
+
+
+def upgrade():
+    # Which of two relations between the same pair is the right one is for
+    # a person to decide, and dropping one here would leave the closure,
+    # generations and directory built from it behind
+    duplicates = op.get_bind().execute(sa.text(
+        'SELECT user_id, relative_user_id, COUNT(*) FROM relatives '
+        'GROUP BY user_id, relative_user_id HAVING COUNT(*) > 1 '
+        'ORDER BY user_id, relative_user_id'
+    )).all()
+    if duplicates:
+        pairs = ', '.join(f'{user_id} -> {relative_user_id} ({count} rows)'
+                          for user_id, relative_user_id, count in duplicates)
+        raise RuntimeError(
+            f'relatives has {len(duplicates)} pair(s) of users related more than once: {pairs}. '
+            'Run `flask audit-relatives` to list them, remove the wrong rows, '
+            'then run `flask rebuild-closure` and `flask rebuild-generations` before upgrading again.'
+        )
+    if op.get_bind().dialect.name == 'postgresql':
+        # CONCURRENTLY cannot run inside a transaction, but it does not lock
+        # the tables against writes while the indexes build
+        with op.get_context().autocommit_block():
+            for name, table, columns, unique in INDEXES:
+                # A failed concurrent build leaves an INVALID index behind,
+                # which IF NOT EXISTS would then take for the real one
+                invalid = op.get_bind().execute(sa.text(
+                    'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                    'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'
+                ), {'name': name}).first()
+                if invalid:
+                    op.drop_index(name, table_name=table, postgresql_concurrently=True)
+                # The unique index must really be built here, never skipped
+                op.create_index(name, table, columns, unique=unique,
+                                postgresql_concurrently=True, if_not_exists=not unique)
+    else:
+        for name, table, columns, unique in INDEXES:
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns, unique in reversed(INDEXES):
+                op.drop_index(name, table_name=table,
+                              postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, table, columns, unique in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,93 @@
+"""add name search indexes
+
+Revision ID: e7b4d2c8f190
+Revises: a3c9e6f1b752
+Create Date: 2026-10-18 20:48:33.571926
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b4d2c8f190'
+down_revision = 'a3c9e6f1b752'
+branch_labels = None
+depends_on = None
+
+
+# Must match family_tree.services.search.name_expression()
+NAME = "lower(first_name || ' ' || coalesce(middle_name, '') || ' ' || last_name)"
+
+# (name, method, expression) of the PostgreSQL indexes on person
+POSTGRESQL_INDEXES = [
+    ('ix_person_name_tsvector', 'gin', f"to_tsvector('simple'::regconfig, {NAME})"),
+    ('ix_person_first_name_trgm', 'gin', 'lower(first_name) gin_trgm_ops'),
+    ('ix_person_last_name_trgm', 'gin', 'lower(last_name) gin_trgm_ops'),
+    ('ix_person_first_name_soundex', 'btree', 'soundex(first_name)'),
+    ('ix_person_last_name_soundex', 'btree', 'soundex(last_name)'),
+]
+
+# Frozen copies of family_tree.services.search.full_name() and soundex() as
+# of this revision, so that later changes to them cannot change what this
+# migration writes
+_SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'), **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'), 'l': '4', **dict.fromkeys('mn', '5'), 'r': '6'
+}
+
+
+def _full_name(first_name, middle_name, last_name):
+    return ' '.join(name for name in (first_name, middle_name, last_name) if name)
+
+
+def _soundex(word):
+    letters = [c for c in word.lower() if 'a' <= c <= 'z']
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = _SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = _SOUNDEX_CODES.get(letter)
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate letters with the same code, vowels do
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+        with op.get_context().autocommit_block():
+            for name, method, expression in POSTGRESQL_INDEXES:
+                op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                           f'ON person USING {method} ({expression})')
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS person_search "
+                   "USING fts5(names, phonetic, tokenize='trigram')")
+        bind = op.get_bind()
+        rows = [{
+            'user_id': user_id,
+            'names': _full_name(first_name, middle_name, last_name).lower(),
+            'phonetic': ' '.join(_soundex(name) for name in (first_name, middle_name, last_name) if name)
+        } for user_id, first_name, middle_name, last_name in bind.execute(sa.text(
+            'SELECT user_id, first_name, middle_name, last_name FROM person'))]
+        if rows:
+            bind.execute(sa.text('INSERT INTO person_search (rowid, names, phonetic) '
+                                 'VALUES (:user_id, :names, :phonetic)'), rows)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, method, expression in reversed(POSTGRESQL_INDEXES):
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS person_search')
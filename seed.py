@@ -11,8 +11,19 @@ from family_tree.models import (
     Relatives,
     ImportantDates,
     ImportantDateTypeEnum,
-    ContactDetails
+    ContactDetails,
+    AncestryClosure,
+    Picture,
+    PersonDirectory
 )
+from family_tree.cursor import Cursor
+from family_tree.graph import current_graph
+from family_tree.services.closure import rebuild_closure
+from family_tree.services.directory import rebuild_directory
+from family_tree.services.search import rebuild_search_index
+from family_tree.services.generation import rebuild_generations
+
+cursor = Cursor()
 
 
 def seed_database(app=None):
@@ -22,45 +33,45 @@ def seed_database(app=None):
     with app.app_context():
         db.drop_all()
         db.create_all()
+        # Relatives is rewritten from scratch below
+        current_graph().invalidate()
+
+        # Every seeded user shares one password, so hash it only once
+        password_hash = bcrypt.generate_password_hash("password123").decode('utf-8')
 
         # 1. Create users
         users = [
-            User(
+            dict(
                 username="alice",
                 email="alice@example.com",
-                password_hash=bcrypt.generate_password_hash(
-                    "password123").decode('utf-8'),
+                password_hash=password_hash,
                 is_admin=True
             ),
-            User(
+            dict(
                 username="bob",
                 email="bob@example.com",
-                password_hash=bcrypt.generate_password_hash(
-                    "password123").decode('utf-8'),
+                password_hash=password_hash,
                 is_admin=False
             ),
-            User(
+            dict(
                 username="charlie",
                 email="charlie@example.com",
-                password_hash=bcrypt.generate_password_hash(
-                    "password123").decode('utf-8'),
+                password_hash=password_hash,
                 is_admin=False
             )
         ]
 
         for i in range(4, 24):  # Starts from user4 to user23
             users.append(
-                User(
+                dict(
                     username=f"user{i}",
                     email=f"user{i}@example.com",
-                    password_hash=bcrypt.generate_password_hash(
-                        "password123").decode('utf-8'),
+                    password_hash=password_hash,
                     is_admin=False
                 )
             )
 
-        db.session.bulk_save_objects(users)
-        db.session.commit()
+        cursor.bulk_add(db, User, users)
 
         # 2. Fetch user IDs (after commit, so they have IDs assigned)
         alice = User.query.filter_by(username="alice").first()
@@ -69,21 +80,21 @@ def seed_database(app=None):
 
         # 3. Create persons
         persons = [
-            Person(
+            dict(
                 user_id=alice.id,
                 gender=GenderEnum.FEMALE,
                 first_name="Alice",
                 middle_name="Marie",
                 last_name="Anderson"
             ),
-            Person(
+            dict(
                 user_id=bob.id,
                 gender=GenderEnum.MALE,
                 first_name="Bob",
                 middle_name=None,
                 last_name="Brown"
             ),
-            Person(
+            dict(
                 user_id=charlie.id,
                 gender=GenderEnum.OTHER,
                 first_name="Charlie",
@@ -94,7 +105,7 @@ def seed_database(app=None):
 
         for i in range(4, 24):
             persons.append(
-                Person(
+                dict(
                     user_id=i,
                     gender=GenderEnum.MALE if i % 3 == 0 else GenderEnum.FEMALE if i % 3 == 1 else GenderEnum.OTHER,
                     first_name=f'person_user_no_{i}',
@@ -103,12 +114,11 @@ def seed_database(app=None):
                 )
             )
 
-        db.session.bulk_save_objects(persons)
-        db.session.commit()
+        cursor.bulk_add(db, Person, persons)
 
         # 4. Create addresses
         addresses = [
-            Address(
+            dict(
                 user_id=alice.id,
                 is_permanent=True,
                 first_line="123 Maple Street",
@@ -118,7 +128,7 @@ def seed_database(app=None):
                 country="India",
                 landmark="Near Central Park"
             ),
-            Address(
+            dict(
                 user_id=bob.id,
                 is_permanent=False,
                 first_line="456 Oak Avenue",
@@ -128,7 +138,7 @@ def seed_database(app=None):
                 country="India",
                 landmark="Opposite City Mall"
             ),
-            Address(
+            dict(
                 user_id=charlie.id,
                 is_permanent=True,
                 first_line="789 Pine Road",
@@ -142,7 +152,7 @@ def seed_database(app=None):
 
         for i in range(4, 24):
             addresses.append(
-                Address(
+                dict(
                     user_id=i,
                     is_permanent=True if i % 2 == 1 else False,
                     first_line=f"address_{i}_789 Pine Road",
@@ -154,8 +164,7 @@ def seed_database(app=None):
                 )
             )
 
-        db.session.bulk_save_objects(addresses)
-        db.session.commit()
+        cursor.bulk_add(db, Address, addresses)
 
         # Fetch users
         alice = User.query.filter_by(username="alice").first()
@@ -164,17 +173,17 @@ def seed_database(app=None):
 
         # Create important dates
         important_dates = [
-            ImportantDates(
+            dict(
                 user_id=alice.id,
                 date_type=ImportantDateTypeEnum.BIRTH,
                 date=date(1990, 5, 21)
             ),
-            ImportantDates(
+            dict(
                 user_id=bob.id,
                 date_type=ImportantDateTypeEnum.BIRTH,
                 date=date(1985, 8, 14)
             ),
-            ImportantDates(
+            dict(
                 user_id=charlie.id,
                 date_type=ImportantDateTypeEnum.BIRTH,
                 date=date(2020, 2, 29)
@@ -183,7 +192,7 @@ def seed_database(app=None):
 
         for i in range(4, 24):
             important_dates.append(
-                ImportantDates(
+                dict(
                     user_id=i,
                     date_type=ImportantDateTypeEnum.BIRTH,
                     date=date(2000, 2, 29)
@@ -191,24 +200,23 @@ def seed_database(app=None):
             )
 
         # Insert into DB
-        db.session.bulk_save_objects(important_dates)
-        db.session.commit()
+        cursor.bulk_add(db, ImportantDates, important_dates)
 
         # Create contact details
         contact_details = [
-            ContactDetails(
+            dict(
                 user_id=alice.id,
                 country_code=91,
                 mobile_no="9876543210",
                 email="alice.contact@example.com"  # Optional override
             ),
-            ContactDetails(
+            dict(
                 user_id=bob.id,
                 country_code=1,
                 mobile_no="2025550181",
                 email="bob.contact@example.com"
             ),
-            ContactDetails(
+            dict(
                 user_id=charlie.id,
                 country_code=44,
                 mobile_no="7700900900",
@@ -217,44 +225,43 @@ def seed_database(app=None):
         ]
 
         # Insert into DB
-        db.session.bulk_save_objects(contact_details)
-        db.session.commit()
+        cursor.bulk_add(db, ContactDetails, contact_details)
 
         # Create relationships and reverse relationships
         relationships = []
 
 
         # 3 -> 4: PARENT, 4 -> 3: CHILD
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=4,
             relation_type=RelativesTypeEnum.PARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=4,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.CHILD
         ))
 
         # 5 -> 6: STEPPARENT, 6 -> 5: STEPCHILD
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=5,
             relative_user_id=6,
             relation_type=RelativesTypeEnum.STEPPARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=6,
             relative_user_id=5,
             relation_type=RelativesTypeEnum.STEPCHILD
         ))
 
         # 11 <-> 12: EXSPOUSE (bidirectional)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=11,
             relative_user_id=12,
             relation_type=RelativesTypeEnum.EXSPOUSE
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=12,
             relative_user_id=11,
             relation_type=RelativesTypeEnum.EXSPOUSE
@@ -264,80 +271,85 @@ def seed_database(app=None):
 
         for i in range(15, 23, 2):
             # i -> i+1: PARENT, i+1 -> i: CHILD
-            relationships.append(Relatives(
+            relationships.append(dict(
                 user_id=i,
                 relative_user_id=i+1,
                 relation_type=RelativesTypeEnum.PARENT
             ))
-            relationships.append(Relatives(
+            relationships.append(dict(
                 user_id=i+1,
                 relative_user_id=i,
                 relation_type=RelativesTypeEnum.CHILD
             ))
         
         # User 3 -> User 5 (PARENT), User 5 -> User 3 (CHILD)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=5,
             relation_type=RelativesTypeEnum.PARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=5,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.CHILD
         ))
 
         # User 3 -> User 6 (STEPPARENT), User 6 -> User 3 (STEPCHILD)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=6,
             relation_type=RelativesTypeEnum.STEPPARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=6,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.STEPCHILD
         ))
 
         # User 8 -> User 3 (CHILD -> PARENT)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=8,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.PARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=8,
             relation_type=RelativesTypeEnum.CHILD
         ))
 
         # User 9 -> User 3 (STEPCHILD -> STEPPARENT)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=9,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.STEPPARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=9,
             relation_type=RelativesTypeEnum.STEPCHILD
         ))
 
         # User 10 -> User 3 (CHILD -> PARENT)
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=10,
             relative_user_id=3,
             relation_type=RelativesTypeEnum.PARENT
         ))
-        relationships.append(Relatives(
+        relationships.append(dict(
             user_id=3,
             relative_user_id=10,
             relation_type=RelativesTypeEnum.CHILD
         ))
 
         # Commit to DB
-        db.session.bulk_save_objects(relationships)
-        db.session.commit()
+        cursor.bulk_add(db, Relatives, relationships)
+
+        # Derive the ancestry closure from the relationships above
+        rebuild_closure(db, AncestryClosure, Relatives)
+        rebuild_generations(db, Person, Relatives)
+        rebuild_directory(db, PersonDirectory, Person, Picture)
+        rebuild_search_index(db, Person)
         print("SEEDING SUCCESSFULL!")
 
 if __name__ == "__main__":
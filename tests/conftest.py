@@ -1,10 +1,13 @@
 
+from contextlib import contextmanager
+
 import pytest
+from sqlalchemy import event
 
 import family_tree
 
-from family_tree import create_app, db as _db
-from family_tree.models import User, Person
+from family_tree import create_app, bcrypt, db as _db
+from family_tree.models import User, GenderEnum, Person, RelativesTypeEnum, Relatives
 from tests.testconfig import TestConfig
 
 @pytest.fixture()
@@ -17,6 +20,23 @@ def app():
         _db.session.remove()
         _db.drop_all()
 
+@pytest.fixture()
+def worker_apps(tmp_path):
+    """
+    Two apps sharing one SQLite file, standing in for two worker processes.
+    Use each inside its own app_context().
+    """
+    class WorkerConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/shared.db'
+
+    apps = [create_app(config_class=WorkerConfig) for _ in range(2)]
+    with apps[0].app_context():
+        _db.create_all()
+    yield apps
+    for app in apps:
+        with app.app_context():
+            _db.engine.dispose()
+
 @pytest.fixture()
 def client(app):
     return app.test_client()
@@ -41,3 +61,35 @@ def logged_in_client(client, registered_user):
         'password': 'pass'
     }, follow_redirects=True)
     return client
+
+
+def create_family(db, count):
+    for i in range(1, count + 1):
+        db.session.add(User(id=i, username=f'user{i}', email=f'user{i}@example.com',
+                            password_hash=bcrypt.generate_password_hash('pass').decode('utf-8')))
+        db.session.add(Person(user_id=i, first_name=f'First{i}', last_name='Family',
+                              gender=GenderEnum.MALE if i % 2 else GenderEnum.FEMALE))
+    db.session.commit()
+
+
+def add_parent(db, child_id, parent_id):
+    db.session.add(Relatives(user_id=child_id, relative_user_id=parent_id,
+                             relation_type=RelativesTypeEnum.PARENT))
+    db.session.add(Relatives(user_id=parent_id, relative_user_id=child_id,
+                             relation_type=RelativesTypeEnum.CHILD))
+    db.session.commit()
+
+
+@contextmanager
+def count_queries(db):
+    """
+    Collect the SQL statements executed inside the block.
+    """
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
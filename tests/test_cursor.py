@@ -0,0 +1,549 @@
+import threading
+
+import pytest
+
+from family_tree.cursor import Cursor
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import selectinload
+
+from datetime import date
+
+from flask import g
+from werkzeug.datastructures import MultiDict
+
+from family_tree.models import (
+    User, Person, Address, ImportantDates, Relatives, RelativesTypeEnum, AncestryClosure
+)
+
+from family_tree import create_app, db as _db
+from family_tree.forms import UpsertRelativeForm
+from family_tree.pool_stats import TimedQueuePool, pool_snapshot
+from family_tree.query_cache import PENDING_TABLES_KEY, init_query_cache
+from family_tree.statements import StatementRegistry, statements
+from family_tree.services.user import (
+    add_relative_to_database,
+    check_relative_constraints,
+    check_validity_relation,
+    delete_relative_from_database
+)
+
+from tests.conftest import create_family, add_parent, count_queries
+from tests.testconfig import TestConfig
+
+cursor = Cursor()
+
+
+class TestQuery:
+    def test_loader_options(self, db):
+        create_family(db, 5)
+        db.session.expunge_all()
+
+        with count_queries(db) as statements:
+            users = cursor.query(db, User, User.id > 1,
+                                 options=[selectinload(User.person)]).all()
+            names = [user.person.first_name for user in users]
+        assert names == ['First2', 'First3', 'First4', 'First5']
+        # One query for the users and one for all of their persons
+        assert len(statements) == 2
+
+
+class TestPreparedStatements:
+    def test_built_once(self, db):
+        create_family(db, 2)
+        statement = statements.get('user_by_id', User)
+        assert statements.get('user_by_id', User) is statement
+
+        assert cursor.prepared(db, 'user_by_id', User, id=2).first().username == 'user2'
+        assert cursor.prepared(db, 'user_by_id', User, id=3).first() is None
+        assert statements.get('user_by_id', User) is statement
+
+    def test_relations_of_type(self, db):
+        create_family(db, 3)
+        add_parent(db, 1, 2)
+        add_parent(db, 1, 3)
+        parents = cursor.prepared(db, 'relations_of_type', Relatives,
+                                  user_id=1, relation_type='PARENT').all()
+        assert sorted(parent.relative_user_id for parent in parents) == [2, 3]
+
+    def test_registry(self):
+        registry = StatementRegistry()
+        registry.register('user_by_id')(lambda user_table: None)
+        assert 'user_by_id' in registry
+        with pytest.raises(ValueError):
+            registry.register('user_by_id')(lambda user_table: None)
+        with pytest.raises(KeyError):
+            registry.get('missing', User)
+
+
+class TestPaginate:
+    def test_keyset_pages(self, db):
+        create_family(db, 5)
+        query = cursor.query(db, Person)
+
+        pages = []
+        token = None
+        while True:
+            items, token = cursor.paginate(query, [Person.gender, Person.id], after=token, limit=2)
+            pages.append([person.user_id for person in items])
+            if token is None:
+                break
+        # SQLite sorts the gender enum by name, so females (even ids) come first
+        assert pages == [[2, 4], [1, 3], [5]]
+
+    def test_dates_and_extra_columns(self, db):
+        create_family(db, 1)
+        for year in (2001, 1999, 2000):
+            db.session.add(ImportantDates(user_id=1, date_type='BIRTH', date=date(year, 1, 1)))
+        db.session.commit()
+
+        query = db.session.query(ImportantDates.date, ImportantDates.id)
+        items, token = cursor.paginate(query, [ImportantDates.date, ImportantDates.id], limit=1)
+        assert [row[0] for row in items] == [date(1999, 1, 1)]
+        items, token = cursor.paginate(query, [ImportantDates.date, ImportantDates.id], after=token, limit=5)
+        assert [row[0].year for row in items] == [2000, 2001]
+        assert token is None
+
+    def test_invalid_token(self, db):
+        for token in ('not a token', 'WzEsIDJd', 'WyJ4Il0'):
+            with pytest.raises(ValueError):
+                cursor.paginate(cursor.query(db, ImportantDates), [ImportantDates.date], after=token)
+
+
+class TestTransaction:
+    def test_commits_once(self, db):
+        create_family(db, 2)
+
+        commits = []
+        event.listen(db.session(), 'after_commit', commits.append)
+        with cursor.transaction(db):
+            cursor.add(db, Relatives, user_id=1, relative_user_id=2, relation_type='SPOUSE')
+            with cursor.transaction(db):
+                cursor.add(db, Relatives, user_id=2, relative_user_id=1, relation_type='SPOUSE')
+            assert commits == []
+        assert len(commits) == 1
+        assert Relatives.query.count() == 2
+        assert not cursor.in_transaction(db)
+
+    def test_rolls_back_on_error(self, db):
+        create_family(db, 2)
+
+        try:
+            with cursor.transaction(db):
+                cursor.add(db, Relatives, user_id=1, relative_user_id=2, relation_type='SPOUSE')
+                raise ValueError('second row failed')
+        except ValueError:
+            pass
+        assert Relatives.query.count() == 0
+        assert not cursor.in_transaction(db)
+
+
+class TestWrites:
+    def test_update_is_one_statement(self, db):
+        create_family(db, 1)
+        person_id = Person.query.first().id
+        db.session.expunge_all()
+
+        with count_queries(db) as statements:
+            cursor.update(db, Person, person_id, first_name='Renamed')
+        # One UPDATE after a lookup of the user ids whose person_directory
+        # and person_search rows are refreshed with it
+        assert [s.split()[0] for s in statements[:2]] == ['SELECT', 'UPDATE']
+        assert statements[0].startswith('SELECT person.user_id')
+        assert sum(s.startswith('UPDATE') for s in statements) == 1
+        assert Person.query.first().first_name == 'Renamed'
+
+        with pytest.raises(ValueError):
+            cursor.update(db, Person, 9999, first_name='Nobody')
+
+    def test_delete_paths(self, db):
+        create_family(db, 3)
+        add_parent(db, 2, 1)
+        db.session.expunge_all()
+
+        with count_queries(db) as statements:
+            assert cursor.delete(db, Relatives, user_id=2) == 1
+        # One DELETE, plus the graph_version bump every Relatives write makes
+        assert [s.split()[:2] for s in statements] == [['UPDATE', 'graph_version'], ['DELETE', 'FROM']]
+        assert cursor.delete(db, Relatives, user_id=2) == 0
+
+        # Users are deleted through the session so their Person goes too
+        assert cursor.delete(db, User, id=1) == 1
+        assert Person.query.filter_by(user_id=1).count() == 0
+        assert Relatives.query.count() == 0
+
+
+class TestBulkWrites:
+    def test_bulk_add_and_delete(self, db):
+        create_family(db, 4)
+        rows = [{'user_id': 1, 'relative_user_id': i, 'relation_type': 'CHILD'} for i in range(2, 5)]
+
+        assert cursor.bulk_add(db, Relatives, rows) == 3
+        assert Relatives.query.filter_by(user_id=1).count() == 3
+
+        assert cursor.bulk_delete(db, Relatives, Relatives.relative_user_id > 2, user_id=1) == 2
+        assert [r.relative_user_id for r in Relatives.query.all()] == [2]
+
+    def test_bulk_upsert(self, db):
+        create_family(db, 3)
+        cursor.bulk_add(db, AncestryClosure, [
+            {'ancestor_id': 1, 'descendant_id': 3, 'depth': 5}
+        ])
+
+        assert cursor.bulk_upsert(db, AncestryClosure, [
+            {'ancestor_id': 1, 'descendant_id': 3, 'depth': 2},
+            {'ancestor_id': 2, 'descendant_id': 3, 'depth': 1}
+        ], ['ancestor_id', 'descendant_id']) == 2
+        db.session.expire_all()
+        assert [(r.ancestor_id, r.descendant_id, r.depth) for r in
+                AncestryClosure.query.order_by(AncestryClosure.ancestor_id)] == [(1, 3, 2), (2, 3, 1)]
+
+    def test_relatives_edge_is_unique(self, db):
+        create_family(db, 2)
+        cursor.add(db, Relatives, user_id=1, relative_user_id=2, relation_type='SIBLING')
+        with pytest.raises(exc.IntegrityError):
+            cursor.add(db, Relatives, user_id=1, relative_user_id=2, relation_type='SPOUSE')
+        db.session.rollback()
+
+        # The directed edge can be upserted on
+        cursor.bulk_upsert(db, Relatives, [
+            {'user_id': 1, 'relative_user_id': 2, 'relation_type': 'SPOUSE'}
+        ], ['user_id', 'relative_user_id'])
+        db.session.expire_all()
+        assert [r.relation_type.value for r in Relatives.query.all()] == ['SPOUSE']
+
+
+class TestQueryCache:
+    def enable_cache(self, app, db, size=16, ttl=60):
+        app.config.update(QUERY_CACHE_SIZE=size, QUERY_CACHE_TTL=ttl)
+        init_query_cache(app, db)
+        return app.extensions['query_cache']
+
+    def add_address(self, db, user_id, first_line):
+        cursor.add(db, Address, user_id=user_id, is_permanent=True, first_line=first_line,
+                   pin_code=1, state='State', country='Country')
+
+    def test_read_through(self, app, db):
+        cache = self.enable_cache(app, db)
+        create_family(db, 2)
+        self.add_address(db, 1, 'First Street')
+
+        assert len(cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all()) == 1
+        with count_queries(db) as statements:
+            addresses = cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all()
+        assert statements == []
+        assert addresses[0].first_line == 'First Street'
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Other parameters are cached separately, uncached queries are left alone
+        assert cursor.query(db, Address, filter_by=True, cache=True, user_id=2).all() == []
+        assert len(cache) == 2
+        cursor.query(db, Person).all()
+        assert len(cache) == 2
+
+    def test_invalidated_per_table(self, app, db):
+        cache = self.enable_cache(app, db)
+        create_family(db, 2)
+        self.add_address(db, 1, 'First Street')
+        cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all()
+        cursor.query(db, Person, filter_by=True, cache=True, user_id=1).first()
+
+        # Writes to another table keep the entry
+        cursor.add(db, Relatives, user_id=1, relative_user_id=2, relation_type='SPOUSE')
+        assert len(cache) == 2
+
+        self.add_address(db, 1, 'Second Street')
+        assert len(cache) == 1
+        assert len(cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all()) == 2
+
+        cursor.update(db, Person, Person.query.filter_by(user_id=1).first().id, first_name='Renamed')
+        assert cursor.query(db, Person, filter_by=True, cache=True, user_id=1).first().first_name == 'Renamed'
+
+        cursor.delete(db, Address, user_id=1)
+        assert cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all() == []
+
+    def test_invalidated_at_transaction_end(self, app, db):
+        cache = self.enable_cache(app, db)
+        create_family(db, 2)
+        for end in (db.session.commit, db.session.rollback):
+            db.session.add(Address(user_id=1, is_permanent=True, first_line='Street',
+                                   pin_code=1, state='State', country='Country'))
+            db.session.flush()
+            # Reads of the uncommitted row are not cached
+            cursor.query(db, Address, filter_by=True, cache=True, user_id=1).all()
+            assert len(cache) == 0
+
+            # Entries cached by another thread before the commit are dropped by it
+            cache.put('other thread', None, frozenset({'address'}))
+            end()
+            assert len(cache) == 0
+            assert PENDING_TABLES_KEY not in db.session.info
+
+    def test_writes_of_other_processes(self, worker_apps):
+        first, second = worker_apps
+        caches = [self.enable_cache(app, _db) for app in worker_apps]
+        with first.app_context():
+            create_family(_db, 1)
+            self.add_address(_db, 1, 'First Street')
+        with first.test_request_context():
+            assert len(cursor.query(_db, Address, filter_by=True, cache=True, user_id=1).all()) == 1
+            assert len(caches[0]) == 1
+
+        # The second worker's write reaches the first worker on its next request
+        with second.test_request_context():
+            self.add_address(_db, 1, 'Second Street')
+        with first.test_request_context():
+            assert len(cursor.query(_db, Address, filter_by=True, cache=True, user_id=1).all()) == 2
+            # Its version is compared once per request
+            with count_queries(_db) as statements:
+                cursor.query(_db, Address, filter_by=True, cache=True, user_id=1).all()
+            assert statements == []
+
+    def test_ttl_and_lru(self, app, db):
+        cache = self.enable_cache(app, db, size=2, ttl=0)
+        create_family(db, 3)
+        cursor.query(db, Person, filter_by=True, cache=True, user_id=1).first()
+        cursor.query(db, Person, filter_by=True, cache=True, user_id=1).first()
+        assert cache.hits == 0
+
+        cache.ttl = 60
+        for user_id in (1, 2, 3):
+            cursor.query(db, Person, filter_by=True, cache=True, user_id=user_id).first()
+        assert len(cache) == 2
+        cursor.query(db, Person, filter_by=True, cache=True, user_id=3).first()
+        assert cache.hits == 1
+
+
+class TestReadReplicas:
+    @pytest.fixture()
+    def replica_app(self, tmp_path):
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/primary.db'
+            SQLALCHEMY_REPLICA_URIS = [f'sqlite:///{tmp_path}/replica.db']
+
+        app = create_app(config_class=ReplicaConfig)
+        with app.app_context():
+            _db.create_all()
+            replica = app.extensions['replicas'][0]
+            _db.metadata.create_all(replica)
+            # The replica lags behind: it only has user 1
+            with replica.begin() as connection:
+                connection.execute(User.__table__.insert(), [
+                    {'id': 1, 'username': 'replicated', 'email': 'replicated@example.com',
+                     'password_hash': 'x', 'is_admin': False}
+                ])
+            yield app
+            _db.session.remove()
+            _db.drop_all()
+            replica.dispose()
+
+    def test_reads_go_to_replica(self, replica_app):
+        assert [user.username for user in cursor.query(_db, User).all()] == ['replicated']
+        assert cursor.query(_db, User, primary=True).all() == []
+        # Plain session queries stay on the primary
+        assert _db.session.query(User).all() == []
+
+    def test_read_your_writes(self, replica_app):
+        cursor.query(_db, User).all()
+        cursor.add(_db, User, id=2, username='fresh', email='fresh@example.com', password_hash='x')
+        assert [user.username for user in cursor.query(_db, User).all()] == ['fresh']
+
+        # A new session (i.e. the next request) reads from the replica again
+        _db.session.remove()
+        assert [user.username for user in cursor.query(_db, User).all()] == ['replicated']
+
+        with cursor.transaction(_db):
+            assert [user.username for user in cursor.query(_db, User).all()] == ['fresh']
+
+    def test_delete_sees_rows_missing_on_replica(self, replica_app):
+        create_family(_db, 2)
+        add_parent(_db, 2, 1)
+        # The next request: the relation has not reached the replica yet
+        _db.session.remove()
+        assert cursor.query(_db, Relatives).all() == []
+
+        assert delete_relative_from_database(
+            _db, User, Relatives, AncestryClosure, Person, _db.session.get(User, 2), 1)
+        assert _db.session.query(Relatives).all() == []
+
+    def test_relative_checks_see_rows_missing_on_replica(self, replica_app):
+        create_family(_db, 3)
+        with replica_app.test_request_context():
+            for parent_id in (1, 3):
+                form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': parent_id,
+                                                              'relation_type': 'PARENT'}))
+                add_relative_to_database(_db, Relatives, RelativesTypeEnum, AncestryClosure, Person,
+                                         _db.session.get(User, 2), form)
+        # The next request: the relations have not reached the replica yet
+        _db.session.remove()
+        assert cursor.query(_db, Relatives).all() == []
+
+        child = _db.session.get(User, 2)
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 1, 'relation_type': 'SIBLING'}))
+        with replica_app.test_request_context():
+            # The relation already exists, 2 would become their own ancestor,
+            # and 2 already has two parents
+            assert not check_relative_constraints(_db, User, Relatives, child, form)
+            assert not check_validity_relation(
+                _db, User, Relatives, AncestryClosure, _db.session.get(User, 1), 2, 'PARENT')
+            assert not check_validity_relation(
+                _db, User, Relatives, AncestryClosure, child, 1, 'PARENT')
+
+    def test_concurrent_duplicate_relation(self, replica_app):
+        create_family(_db, 2)
+        child = _db.session.get(User, 2)
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 1, 'relation_type': 'PARENT'}))
+        with replica_app.test_request_context():
+            assert add_relative_to_database(
+                _db, Relatives, RelativesTypeEnum, AncestryClosure, Person, child, form)
+            # A second request that passed the checks before the first committed
+            assert not add_relative_to_database(
+                _db, Relatives, RelativesTypeEnum, AncestryClosure, Person, child, form)
+        assert _db.session.query(Relatives).count() == 2
+
+
+class TestGather:
+    def file_app(self, tmp_path, **engine_options):
+        # Concurrent lookups each take their own pooled connection
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/family.db'
+            SQLALCHEMY_ENGINE_OPTIONS = engine_options
+
+        return create_app(config_class=FileConfig)
+
+    def lookup(self, threads):
+        def usernames(db):
+            threads.add(threading.current_thread().name)
+            return [user.username for user in cursor.query(db, User).all()]
+        return usernames
+
+    def test_workers_follow_the_request(self, tmp_path):
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/primary.db'
+            SQLALCHEMY_REPLICA_URIS = [f'sqlite:///{tmp_path}/replica.db']
+
+        app = create_app(config_class=ReplicaConfig)
+        threads = set()
+        with app.app_context():
+            _db.create_all()
+            replica = app.extensions['replicas'][0]
+            _db.metadata.create_all(replica)
+            with app.test_request_context():
+                app.preprocess_request()
+                # The write is not on the replica, so the workers must read the primary
+                cursor.add(_db, User, id=1, username='fresh', email='fresh@example.com',
+                           password_hash='x')
+                before = g.sql_stats.count
+                result = cursor.gather(_db, first=self.lookup(threads),
+                                       second=self.lookup(threads))
+                assert result == {'first': ['fresh'], 'second': ['fresh']}
+                assert threading.current_thread().name not in threads
+                assert g.sql_stats.count - before == 2
+            _db.session.remove()
+            _db.drop_all()
+            replica.dispose()
+        app.extensions['read_executor'].shutdown()
+
+    def test_sequential_inside_transaction(self, tmp_path):
+        app = self.file_app(tmp_path)
+        threads = set()
+        with app.app_context():
+            _db.create_all()
+            with cursor.transaction(_db):
+                cursor.add(_db, User, id=1, username='pending', email='pending@example.com',
+                           password_hash='x')
+                result = cursor.gather(_db, first=self.lookup(threads),
+                                       second=self.lookup(threads))
+            assert result == {'first': ['pending'], 'second': ['pending']}
+            assert threads == {threading.current_thread().name}
+            _db.session.remove()
+            _db.drop_all()
+
+    def test_sequential_when_pool_is_short(self, tmp_path):
+        app = self.file_app(tmp_path, poolclass=TimedQueuePool, pool_size=2, max_overflow=0)
+        threads = set()
+        with app.app_context():
+            _db.create_all()
+            # The request holds one of the two connections, leaving one for two lookups
+            _db.session.connection()
+            result = cursor.gather(_db, first=self.lookup(threads),
+                                   second=self.lookup(threads))
+            assert result == {'first': [], 'second': []}
+            assert threads == {threading.current_thread().name}
+            _db.session.remove()
+            _db.drop_all()
+
+
+class TestPoolStats:
+    def test_snapshot(self, tmp_path):
+        engine = create_engine(f'sqlite:///{tmp_path}/pool.db', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        first = engine.connect()
+        snapshot = pool_snapshot(engine)
+        assert (snapshot['size'], snapshot['checked_out'], snapshot['checkouts']) == (1, 1, 1)
+        assert snapshot['connects_per_second'] > 0
+
+        # The only connection is taken, so the next checkout waits and times out
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+        first.close()
+        snapshot = pool_snapshot(engine)
+        assert (snapshot['checked_out'], snapshot['checkouts'], snapshot['timeouts']) == (0, 2, 1)
+        assert snapshot['max_wait'] >= 0.05
+        engine.dispose()
+
+    def test_snapshot_of_other_pools(self, db):
+        snapshot = pool_snapshot(db.engine)
+        assert snapshot['pool'] == 'StaticPool'
+        assert snapshot['checked_out'] is None
+
+
+class TestLineageQueries:
+    def create_lineage(self, db):
+        # 1 -> 2 -> 3 -> 4 down the generations, 5 is the other parent of 3
+        create_family(db, 5)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 2)
+        add_parent(db, 3, 5)
+        add_parent(db, 4, 3)
+
+    def test_ancestors(self, db):
+        self.create_lineage(db)
+
+        assert cursor.ancestors(db, Relatives, 4) == [(3, 1), (2, 2), (5, 2), (1, 3)]
+        assert cursor.ancestors(db, Relatives, 4, max_depth=2) == [(3, 1), (2, 2), (5, 2)]
+        assert cursor.ancestors(db, Relatives, 1) == []
+
+    def test_descendants(self, db):
+        self.create_lineage(db)
+
+        assert cursor.descendants(db, Relatives, 1) == [(2, 1), (3, 2), (4, 3)]
+        assert cursor.descendants(db, Relatives, 5, max_depth=1) == [(3, 1)]
+        assert cursor.descendants(db, Relatives, 4) == []
+
+    def test_pedigree_collapse(self, db):
+        # A ladder: both people of every generation are the parents of both
+        # people of the next, so there are 2**30 paths up from the bottom
+        generations = 30
+        for user_id in range(1, 2 * generations + 1):
+            db.session.add(User(id=user_id, username=f'user{user_id}',
+                                email=f'user{user_id}@example.com', password_hash='x'))
+        db.session.commit()
+        for generation in range(generations - 1):
+            for child_id in (2 * generation + 1, 2 * generation + 2):
+                for parent_id in (2 * generation + 3, 2 * generation + 4):
+                    db.session.add(Relatives(user_id=child_id, relative_user_id=parent_id,
+                                             relation_type=RelativesTypeEnum.PARENT))
+        db.session.commit()
+
+        ancestors = cursor.ancestors(db, Relatives, 1)
+        assert len(ancestors) == 2 * generations - 2
+        assert ancestors[-1] == (2 * generations, generations - 1)
+
+    def test_cycle_terminates(self, db):
+        create_family(db, 3)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 2)
+        add_parent(db, 1, 3)
+
+        assert cursor.ancestors(db, Relatives, 1) == [(3, 1), (2, 2)]
@@ -0,0 +1,261 @@
+from werkzeug.datastructures import MultiDict
+
+from family_tree.models import (
+    User,
+    Person,
+    RelativesTypeEnum,
+    Relatives,
+    AncestryClosure
+)
+
+from family_tree.forms import UpsertRelativeForm
+
+from family_tree import db as _db
+
+from family_tree.graph import KinshipGraph, get_graph, invalidate_graphs, stored_version
+
+from family_tree.clusters import FamilyClusters, get_clusters
+
+from family_tree.lineage import LineageIndex
+
+from family_tree.services.user import (
+    add_relative_to_database,
+    delete_relative_from_database
+)
+
+from tests.conftest import create_family, add_parent
+
+
+class TestKinshipGraph:
+    def test_traversals(self):
+        # 1 and 2 are parents of 3 and 4, 3 is the parent of 5, 5 is married to 6
+        graph = KinshipGraph()
+        graph.load_rows([
+            (3, 1, 'PARENT'),
+            (3, 2, 'PARENT'),
+            (4, 1, 'PARENT'),
+            (4, 2, 'PARENT'),
+            (5, 3, 'PARENT'),
+            (5, 6, 'SPOUSE'),
+            (6, 7, 'EXSPOUSE')
+        ])
+
+        assert graph.ancestors(5) == {3: 1, 1: 2, 2: 2}
+        assert graph.ancestors(5, max_depth=1) == {3: 1}
+        assert graph.descendants(1) == {3: 1, 4: 1, 5: 2}
+        assert graph.siblings(3) == {4}
+        assert graph.spouses(6) == [5]
+        assert sorted(graph.spouses(6, include_former=True)) == [5, 7]
+        # Reverse rows are mirrored even when only one direction was stored
+        assert graph.parents(3) == [1, 2]
+        assert graph.children(3) == [5]
+
+    def test_incremental_updates(self):
+        graph = KinshipGraph()
+        graph.load_rows([(2, 1, 'PARENT')])
+        version = graph.version
+
+        graph.add_edge(3, 2, 'PARENT')
+        assert graph.ancestors(3) == {2: 1, 1: 2}
+        assert graph.version > version
+
+        # Overwriting an edge that is already in the CSR arrays
+        graph.add_edge(2, 1, 'STEPPARENT')
+        assert graph.ancestors(3) == {2: 1}
+        assert (1, RelativesTypeEnum.STEPCHILD) not in graph.relatives(1)
+        assert (2, RelativesTypeEnum.STEPCHILD) in graph.relatives(1)
+
+        graph.remove_edge(3, 2)
+        assert graph.ancestors(3) == {}
+        assert graph.children(2) == []
+
+        graph.add_edge(2, 1, 'PARENT')
+        graph.remove_user(1)
+        assert graph.ancestors(2) == {}
+
+    def test_updates_ignored_until_loaded(self):
+        graph = KinshipGraph()
+        graph.add_edge(2, 1, 'PARENT')
+        assert graph.relatives(2) == []
+
+
+class TestGraphServices:
+    def test_graph_follows_service_writes(self, db):
+        create_family(db, 3)
+        add_parent(db, 2, 1)
+
+        graph = get_graph(db)
+        assert graph.ancestors(2) == {1: 1}
+
+        user = User.query.filter_by(id=3).first()
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 2, 'relation_type': 'PARENT'}))
+        add_relative_to_database(db, Relatives, RelativesTypeEnum, AncestryClosure, Person, user, form)
+        assert graph.ancestors(3) == {2: 1, 1: 2}
+
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, user, 2)
+        assert graph.ancestors(3) == {}
+        assert graph.descendants(1) == {2: 1}
+
+    def test_own_writes_keep_graph_current(self, app, db, monkeypatch):
+        create_family(db, 3)
+        graph = get_graph(db)
+        loads = []
+        monkeypatch.setattr(graph, 'load', lambda *args: loads.append(args))
+
+        user = User.query.filter_by(id=3).first()
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 2, 'relation_type': 'PARENT'}))
+        add_relative_to_database(db, Relatives, RelativesTypeEnum, AncestryClosure, Person, user, form)
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, user, 2)
+        assert get_graph(db) is graph
+        assert graph.db_version == stored_version(db)
+        assert loads == []
+
+        # Writes that bypass the graph make get_graph() reload, from the
+        # next request on
+        add_parent(db, 2, 1)
+        get_graph(db)
+        assert loads == []
+        with app.test_request_context():
+            get_graph(db)
+        assert len(loads) == 1
+
+    def test_other_workers_writes_are_picked_up(self, worker_apps):
+        first, second = worker_apps
+        with first.app_context():
+            create_family(_db, 3)
+            assert get_graph(_db).parents(2) == []
+        with second.app_context():
+            add_parent(_db, 2, 1)
+        with first.app_context():
+            assert get_graph(_db).parents(2) == [1]
+
+        with second.app_context():
+            delete_relative_from_database(
+                _db, User, Relatives, AncestryClosure, Person, _db.session.get(User, 2), 1)
+        with first.app_context():
+            assert get_graph(_db).parents(2) == []
+
+        # Edits made outside the session are announced with `flask invalidate-graph`
+        with second.app_context():
+            with _db.engine.begin() as connection:
+                connection.execute(Relatives.__table__.insert(), [
+                    {'user_id': 3, 'relative_user_id': 1, 'relation_type': 'PARENT'}])
+        with first.app_context():
+            assert get_graph(_db).parents(3) == []
+        with second.app_context():
+            invalidate_graphs(_db)
+        with first.app_context():
+            assert get_graph(_db).parents(3) == [1]
+
+
+class TestFamilyClusters:
+    def test_union_find(self, app):
+        graph = KinshipGraph()
+        graph.load_rows([(2, 1, 'PARENT'), (3, 2, 'PARENT'), (5, 4, 'SPOUSE')])
+        clusters = FamilyClusters()
+        graph.listeners.append(clusters)
+        clusters.rebuild(graph)
+
+        assert clusters.same_family(1, 3)
+        assert not clusters.same_family(1, 4)
+        assert clusters.component_size(3) == 3
+        assert clusters.component_size(99) == 1
+        assert sorted(clusters.components().values()) == [[1, 2, 3], [4, 5]]
+
+        # Additions are unioned in place
+        graph.add_edge(4, 3, 'SIBLING')
+        assert not clusters.dirty
+        assert clusters.component(5) == [1, 2, 3, 4, 5]
+
+        # Removals mark the index for a batch rebuild
+        graph.remove_edge(4, 3)
+        assert clusters.stale()
+        clusters.rebuild(graph)
+        assert not clusters.same_family(1, 5)
+
+    def test_clusters_follow_service_writes(self, db):
+        create_family(db, 4)
+        add_parent(db, 2, 1)
+
+        clusters = get_clusters(db)
+        assert not clusters.same_family(1, 3)
+
+        user = User.query.filter_by(id=3).first()
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 2, 'relation_type': 'PARENT'}))
+        add_relative_to_database(db, Relatives, RelativesTypeEnum, AncestryClosure, Person, user, form)
+        assert get_clusters(db).same_family(1, 3)
+
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, user, 2)
+        assert not get_clusters(db).same_family(1, 3)
+
+    def test_clusters_follow_other_workers(self, worker_apps):
+        first, second = worker_apps
+        with first.app_context():
+            create_family(_db, 3)
+            assert not get_clusters(_db).same_family(1, 2)
+        with second.app_context():
+            add_parent(_db, 2, 1)
+        with first.app_context():
+            assert get_clusters(_db).same_family(1, 2)
+
+
+class TestLineageIndex:
+    def test_nearest_common_ancestors(self):
+        # 1 + 2 -> 3 and 4; 3 -> 5; 4 -> 6 -> 7; 8 -> 7 (7's other parent)
+        graph = KinshipGraph()
+        graph.load_rows([
+            (3, 1, 'PARENT'), (3, 2, 'PARENT'),
+            (4, 1, 'PARENT'), (4, 2, 'PARENT'),
+            (5, 3, 'PARENT'), (6, 4, 'PARENT'),
+            (7, 6, 'PARENT'), (7, 8, 'PARENT')
+        ])
+        lineage = LineageIndex(graph)
+        graph.listeners.append(lineage)
+
+        # Full siblings share both parents
+        assert lineage.nearest_common_ancestors(3, 4) == ([1, 2], 1, 1)
+        assert lineage.nearest_common_ancestors(5, 7) == ([1, 2], 2, 3)
+        assert lineage.nearest_common_ancestors(1, 7) == ([1], 0, 3)
+        assert lineage.nearest_common_ancestors(5, 8) is None
+        assert lineage.cousin_degree(5, 7) == (1, 1)
+        assert lineage.cousin_degree(3, 7) is None
+        assert lineage.line_to(7, 1) == [7, 6, 4, 1]
+
+        # Tables below a changed relation are rebuilt
+        graph.add_edge(8, 3, 'PARENT')
+        assert lineage.nearest_common_ancestors(5, 7) == ([3], 1, 2)
+        graph.remove_edge(8, 3)
+        assert lineage.nearest_common_ancestors(5, 7) == ([1, 2], 2, 3)
+
+    def test_cycle_does_not_loop(self):
+        graph = KinshipGraph()
+        graph.load_rows([(1, 2, 'PARENT'), (2, 1, 'PARENT')])
+        lineage = LineageIndex(graph)
+        assert lineage.ancestor_table(1) == {1: 0, 2: 1}
+        assert lineage.line_to(1, 2) == [1, 2]
+
+    def test_tables_are_built_once(self, monkeypatch):
+        # A ladder of 20 generations: 2k + 1 and 2k + 2 are the children of 2k - 1 and 2k
+        graph = KinshipGraph()
+        graph.load_rows([(child, parent, 'PARENT') for child in range(3, 41)
+                         for parent in ((child - 1) // 2 * 2 - 1, (child - 1) // 2 * 2)])
+        lineage = LineageIndex(graph, maxsize=100)
+        graph.listeners.append(lineage)
+        assert lineage.nearest_common_ancestors(39, 40) == ([37, 38], 1, 1)
+
+        walks = []
+        parents = graph.parents
+        monkeypatch.setattr(graph, 'parents', lambda user_id: walks.append(user_id) or parents(user_id))
+        assert lineage.nearest_common_ancestors(39, 40) == ([37, 38], 1, 1)
+        assert lineage.cousin_degree(39, 36) is None
+        assert walks == []
+
+        # Only the tables below a changed relation are rebuilt, from their parents' tables
+        graph.add_edge(39, 41, 'PARENT')
+        assert lineage.ancestor_table(39)[41] == 1
+        assert set(walks) == {39, 41}
+
+        # The cache is bounded
+        small = LineageIndex(graph, maxsize=5)
+        small.ancestor_table(40)
+        assert len(small) == 5
@@ -0,0 +1,103 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+VERSIONS = Path(__file__).resolve().parent.parent / 'migrations' / 'versions'
+
+
+def load_migration(revision):
+    spec = importlib.util.spec_from_file_location(f'migration_{revision}', VERSIONS / f'{revision}_.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture()
+def connection():
+    engine = sa.create_engine('sqlite://')
+    metadata = sa.MetaData()
+    for table in ('picture', 'address', 'important_dates', 'contact_details'):
+        sa.Table(table, metadata,
+                 sa.Column('id', sa.Integer, primary_key=True),
+                 sa.Column('user_id', sa.Integer))
+    sa.Table('person', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('user_id', sa.Integer),
+             sa.Column('first_name', sa.String(50)),
+             sa.Column('middle_name', sa.String(50)),
+             sa.Column('last_name', sa.String(50)))
+    sa.Table('relatives', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('user_id', sa.Integer),
+             sa.Column('relative_user_id', sa.Integer),
+             sa.Column('relation_type', sa.String(20)))
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        yield conn
+    engine.dispose()
+
+
+def add_relations(connection, rows):
+    connection.execute(sa.text(
+        'INSERT INTO relatives (user_id, relative_user_id, relation_type) '
+        'VALUES (:user_id, :relative_user_id, :relation_type)'
+    ), [dict(zip(('user_id', 'relative_user_id', 'relation_type'), row)) for row in rows])
+
+
+def run_upgrade(connection, revision):
+    with Operations.context(MigrationContext.configure(connection)):
+        load_migration(revision).upgrade()
+
+
+class TestRelativesIndexMigration:
+    def test_refuses_duplicate_relations(self, connection):
+        add_relations(connection, [
+            (1, 2, 'PARENT'),
+            (2, 1, 'CHILD'),
+            (1, 2, 'SIBLING'),
+            (2, 1, 'SIBLING')
+        ])
+
+        with pytest.raises(RuntimeError) as error:
+            run_upgrade(connection, '5d1f3b7a9e24')
+
+        assert 'flask audit-relatives' in str(error.value)
+        assert '1 -> 2 (2 rows)' in str(error.value)
+        assert '2 -> 1 (2 rows)' in str(error.value)
+        # Nothing was thrown away and no index was built
+        assert connection.execute(sa.text('SELECT COUNT(*) FROM relatives')).scalar() == 4
+        assert not sa.inspect(connection).get_indexes('relatives')
+
+    def test_builds_indexes(self, connection):
+        add_relations(connection, [
+            (1, 2, 'PARENT'),
+            (2, 1, 'CHILD')
+        ])
+
+        run_upgrade(connection, '5d1f3b7a9e24')
+
+        indexes = {index['name']: index for index in sa.inspect(connection).get_indexes('relatives')}
+        assert indexes['uq_relatives_user_id_relative_user_id']['unique']
+        assert 'ix_relatives_relative_user_id' in indexes
+        assert connection.execute(sa.text('SELECT COUNT(*) FROM relatives')).scalar() == 2
+
+
+class TestNameSearchMigration:
+    def test_fills_person_search(self, connection):
+        connection.execute(sa.text(
+            "INSERT INTO person (user_id, first_name, middle_name, last_name) "
+            "VALUES (1, 'Ashcraft', NULL, 'Tymms'), (2, 'Iba', 'Sara', 'Lyngdoh')"))
+
+        run_upgrade(connection, 'e7b4d2c8f190')
+
+        rows = connection.execute(sa.text(
+            'SELECT rowid, names, phonetic FROM person_search ORDER BY rowid')).all()
+        assert [tuple(row) for row in rows] == [
+            (1, 'ashcraft tymms', 'A261 T520'),
+            (2, 'iba sara lyngdoh', 'I100 S600 L523')
+        ]
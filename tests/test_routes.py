@@ -1,23 +1,31 @@
 import pytest
 
-from sqlalchemy import or_ 
+from sqlalchemy import or_
 
 from flask_login import current_user
 
 from seed import seed_database
 
+from family_tree.services.generation import rebuild_generations
+from family_tree.services.search import rebuild_search_index
+from family_tree.sql_stats import statement_shape
+
+from tests.conftest import count_queries
+
 from family_tree import db, bcrypt
 
 from family_tree.models import (
     User,
     GenderEnum,
     Person,
+    Picture,
     RelativesTypeEnum,
     Relatives,
     Address,
     ImportantDateTypeEnum,
     ImportantDates,
-    ContactDetails
+    ContactDetails,
+    AncestryClosure
 )
 
 
@@ -706,6 +714,29 @@ class TestUserRoutes:
         assert response.status_code == 200 or response.status_code == 302
         assert b'Important date not found.' in response.data or b'No important dates found.' in response.data
 
+    def test_display_important_dates_pages(self, client):
+        client.post('/register', data={
+            'username': 'pageuser',
+            'email': 'pageuser@example.com',
+            'password': 'pass'
+        })
+        client.post('/login', data={
+            'email': 'pageuser@example.com',
+            'password': 'pass',
+        }, follow_redirects=True)
+        for year in range(1990, 1993):
+            client.post('/add_important_date', data={
+                'date_type': 'BIRTH',
+                'date': f'{year}-01-01'
+            }, follow_redirects=True)
+
+        response = client.get('/display_important_dates')
+        assert b'1992-01-01' in response.data
+        assert b'Next page' not in response.data
+
+        response = client.get('/display_important_dates?after=garbage', follow_redirects=True)
+        assert b'Invalid page.' in response.data
+
     def test_edit_important_date_success(self, client):
         from family_tree.models import ImportantDates
         import datetime
@@ -1048,6 +1079,161 @@ class TestUserRoutes:
         assert response.status_code == 200 or response.status_code == 302
         assert b'Could not find relation with relative user id' in response.data
 
+    def test_relationship(self, client):
+        self.create_users()
+        self.create_persons()
+
+        # Bob is Charlie's father, Alice is Bob's mother
+        db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
+        db.session.add(Relatives(user_id=2, relative_user_id=3, relation_type='CHILD'))
+        db.session.add(Relatives(user_id=2, relative_user_id=1, relation_type='PARENT'))
+        db.session.add(Relatives(user_id=1, relative_user_id=2, relation_type='CHILD'))
+        db.session.commit()
+
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/relationship/3/1')
+        assert response.status_code == 200
+        assert b"Alice Anderson is Charlie Campbell's grandmother" in response.data
+
+        db.session.add(User(username='dan', email='dan@example.com', password_hash='password123'))
+        db.session.commit()
+        response = client.get('/relationship/3/4')
+        assert b'No relationship found between these two people.' in response.data
+
+    def test_my_generation(self, client):
+        self.create_users()
+        self.create_persons()
+
+        # Alice and Bob are siblings, Charlie is Bob's child
+        db.session.add(Relatives(user_id=1, relative_user_id=2, relation_type='SIBLING'))
+        db.session.add(Relatives(user_id=2, relative_user_id=1, relation_type='SIBLING'))
+        db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
+        db.session.add(Relatives(user_id=2, relative_user_id=3, relation_type='CHILD'))
+        db.session.commit()
+        rebuild_generations(db, Person, Relatives)
+
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/my_generation')
+        assert response.status_code == 200
+        assert b'Alice Anderson' in response.data
+        assert b'Charlie Campbell' not in response.data
+
+    def test_overview(self, client):
+        self.create_users()
+        self.create_persons()
+        db.session.add(Relatives(user_id=2, relative_user_id=3, relation_type='CHILD'))
+        db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
+        db.session.commit()
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/overview')
+        assert response.status_code == 200
+        assert b'Bob' in response.data
+        assert b'Charlie' in response.data
+
+    def test_chart(self, client):
+        self.create_users()
+        self.create_persons()
+
+        # Bob is Charlie's father
+        db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
+        db.session.add(Relatives(user_id=2, relative_user_id=3, relation_type='CHILD'))
+        db.session.commit()
+
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/chart/pedigree/3')
+        assert response.status_code == 200
+        assert b'<svg' in response.data
+        assert b'Bob Brown' in response.data
+
+        response = client.get('/chart/descendants/2/svg?generations=2')
+        assert response.mimetype == 'image/svg+xml'
+        assert b'Charlie Campbell' in response.data
+
+        response = client.get('/chart/cousins/2', follow_redirects = True)
+        assert b'Unknown chart type.' in response.data
+        assert client.get('/chart/cousins/2/svg').status_code == 404
+
+    def test_relatives_json(self, client):
+        self.create_users()
+        self.create_persons()
+
+        # Bob is Charlie's father and Alice's husband
+        db.session.add(Relatives(user_id=2, relative_user_id=3, relation_type='CHILD'))
+        db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
+        db.session.add(Relatives(user_id=2, relative_user_id=1, relation_type='SPOUSE'))
+        db.session.add(Relatives(user_id=1, relative_user_id=2, relation_type='SPOUSE'))
+        db.session.add(Picture(user_id=3, picture_filename='charlie.png'))
+        db.session.commit()
+
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        with count_queries(db) as statements:
+            response = client.get('/api/relatives/2')
+        statements = [statement for statement in statements if 'relatives' in statement]
+
+        assert len(statements) == 1
+        data = response.get_json()
+        assert data['fields'] == ['user_id', 'relation', 'first_name', 'last_name',
+                                  'gender', 'picture', 'relative_count']
+        assert data['relatives'] == [
+            [3, 'CHILD', 'Charlie', 'Campbell', 'OTHER', 'charlie.png', 1],
+            [1, 'SPOUSE', 'Alice', 'Anderson', 'FEMALE', None, 1]
+        ]
+
+    def test_search_people(self, client):
+        self.create_users()
+        self.create_persons()
+        # bulk_save_objects() skips the flush events that keep the index in sync
+        rebuild_search_index(db, Person)
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        data = client.get('/api/search/people?q=anders').get_json()
+        assert data['results'] == [{'user_id': 1, 'name': 'Alice Marie Anderson'}]
+        # Misspelt first name
+        assert [r['user_id'] for r in client.get('/api/search/people?q=Charly').get_json()['results']] == [3]
+        assert client.get('/api/search/people?q=a').get_json()['results'] == []
+
+    def test_typeahead_people(self, client):
+        self.create_users()
+        self.create_persons()
+        client.post('/login', data={
+            'email' : 'bob@example.com',
+            'password' : 'password123'
+        }, follow_redirects = True)
+
+        data = client.get('/api/typeahead/people?q=a').get_json()
+        assert data['results'] == [{'user_id': 1, 'name': 'Alice Anderson'}]
+        # The current user is never suggested
+        assert client.get('/api/typeahead/people?q=b').get_json()['results'] == []
+        assert [r['user_id'] for r in client.get('/api/typeahead/people?q=c').get_json()['results']] == [3]
+
+        # The add relative page no longer lists every user
+        response = client.get('/add_relative')
+        assert b'Charlie' not in response.data
+        assert b'name="relative_user_id" type="hidden"' in response.data
+
 class TestAdminRoutes:
     def test_delete_user(self, client, app):
         seed_database(app)
@@ -1077,6 +1263,11 @@ class TestAdminRoutes:
         ).all()
         assert len(relatives) != 0       
 
+        closure = AncestryClosure.query.filter(
+            or_(AncestryClosure.ancestor_id == 3, AncestryClosure.descendant_id == 3)
+        ).all()
+        assert len(closure) != 0
+
         # Delete user. Make sure that all corresponding entries in other tables are deleted.
         response = client.post('/admin/delete_user/3', follow_redirects = True)
 
@@ -1103,3 +1294,69 @@ class TestAdminRoutes:
         ).all()
         assert len(relatives) == 0
 
+        closure = AncestryClosure.query.filter(
+            or_(AncestryClosure.ancestor_id == 3, AncestryClosure.descendant_id == 3)
+        ).all()
+        assert len(closure) == 0
+
+    def test_family_clusters(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/family_clusters')
+        assert response.status_code == 200
+        # Users 3, 4, 5, 6, 8, 9 and 10 are all related to Charlie
+        assert b'7 members' in response.data
+        assert b'Charlie Campbell' in response.data
+
+    def test_pool_stats(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/pool_stats')
+        assert response.status_code == 200
+        assert response.json['primary']['pool'] == 'StaticPool'
+        assert response.json['replicas'] == []
+
+
+class TestSqlStats:
+    def test_server_timing_header(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/display_users')
+        timing = response.headers['Server-Timing']
+        assert timing.startswith('db;dur=')
+        assert 'queries"' in timing
+
+    def test_repeated_statement_warning(self, client, app, caplog):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        # Users and their persons are loaded in one query each, not one per user
+        app.config['SQL_REPEAT_WARNING'] = 2
+        with caplog.at_level('WARNING'):
+            client.get('/admin/display_users')
+        assert not any('ran the same statement' in r.message for r in caplog.records)
+
+        app.config['SQL_REPEAT_WARNING'] = 0
+        with caplog.at_level('WARNING'):
+            client.get('/admin/display_users')
+        assert any('ran the same statement' in r.message for r in caplog.records)
+
+    def test_statement_shape(self):
+        first = statement_shape('SELECT person.id FROM person\nWHERE person.user_id IN (?, ?, ?)')
+        second = statement_shape('SELECT person.id FROM person WHERE person.user_id IN (?)')
+        assert first == second == 'SELECT person.id FROM person WHERE person.user_id IN (?)'
@@ -1,14 +1,26 @@
-from family_tree import db, bcrypt
+import threading
+from datetime import date
+
+from werkzeug.datastructures import MultiDict
+
+from family_tree import create_app, db, bcrypt
 
 from family_tree.models import (
     User,
     GenderEnum,
     Person,
     RelativesTypeEnum,
-    Relatives
+    Relatives,
+    Address,
+    ImportantDates,
+    ContactDetails,
+    AncestryClosure,
+    Picture,
+    PersonDirectory
 )
 
 from family_tree.forms import (
+    UpsertPersonForm,
     UpsertRelativeForm
 )
 
@@ -16,8 +28,36 @@ from family_tree.services.user import (
     check_relative_constraints,
     check_validity_relation,
     add_relative_to_database,
-    delete_relative_from_database
+    delete_relative_from_database,
+    update_person,
+    get_relative_details,
+    get_profile_overview
+)
+from family_tree.services.kinship import (
+    blood_label,
+    describe_relationship,
+    find_relationship,
+    get_path_cache
+)
+from family_tree.services.chart import (
+    build_tree,
+    tidy_layout,
+    render_chart,
+    get_chart_cache
 )
+from family_tree.services.closure import rebuild_closure
+from family_tree.services.audit import audit_relatives
+from family_tree.services.generation import rebuild_generations, same_generation
+from family_tree.services.directory import rebuild_directory
+from family_tree.services.search import rebuild_search_index, search_people, soundex
+from family_tree.graph import KinshipGraph, get_graph, stored_version
+from family_tree.name_index import get_name_index
+from family_tree.cursor import Cursor
+
+from tests.conftest import create_family, add_parent, count_queries
+from tests.testconfig import TestConfig
+
+cursor = Cursor()
 
 class TestUserService:
     def create_users(self):
@@ -246,7 +286,8 @@ class TestUserService:
         }
         alice = User.query.filter_by(id=1).first()
         form = UpsertRelativeForm(formdata=MultiDict(form_data))
-        add_relative_to_database(db, Relatives, RelativesTypeEnum, alice, form)
+        add_relative_to_database(
+            db, Relatives, RelativesTypeEnum, AncestryClosure, Person, alice, form)
 
         rel1 = Relatives.query.filter_by(user_id=1).first()
         rel2 = Relatives.query.filter_by(user_id=2).first()
@@ -273,7 +314,7 @@ class TestUserService:
         assert len(relations) == 2
 
         alice = User.query.filter_by(id=1).first()
-        result = delete_relative_from_database(db, User, Relatives, alice, 2)
+        result = delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, alice, 2)
 
         assert result == True
         relations = Relatives.query.all() 
@@ -281,35 +322,671 @@ class TestUserService:
         assert len(relations) == 0
 
     def test_check_validity_relation(self, db):
-        # check_validity_relation(db, user_table, relatives_table, user, relative_user_id, relation_type)
+        # check_validity_relation(db, user_table, relatives_table, closure_table, user,
+        #                         relative_user_id, relation_type)
         self.create_users()
         self.create_persons()
 
         # TEST 1: IF NO PARENTS EXIST
         charlie = User.query.filter_by(id=3).first()
-        result = check_validity_relation(db, User, Relatives, charlie, 2, 'PARENT')
+        result = check_validity_relation(db, User, Relatives, AncestryClosure, charlie, 2, 'PARENT')
         assert result == True
 
         # TEST 2: IF A PARENT OF THE SAME GENDER ALREADY EXISTS
         # If a father already exists
         db.session.add(Relatives(user_id=3, relative_user_id=2, relation_type='PARENT'))
-        result = check_validity_relation(db, User, Relatives, charlie, 2, 'PARENT')
+        result = check_validity_relation(db, User, Relatives, AncestryClosure, charlie, 2, 'PARENT')
         assert result == False
 
         # If a mother already exists
         db.session.add(Relatives(user_id=3, relative_user_id=1, relation_type='PARENT'))
-        result = check_validity_relation(db, User, Relatives, charlie, 1, 'PARENT')
+        result = check_validity_relation(db, User, Relatives, AncestryClosure, charlie, 1, 'PARENT')
         assert result == False
 
         # TEST 3: IF TWO PARENTS ALREADY EXIST
         db.session.add(User(id=4,username='dick',email='dick@example.com',password_hash='password123'))
         db.session.add(Person(user_id=4, first_name='Dick', last_name="Oswald", gender = GenderEnum.MALE))
         db.session.commit()
-        result = check_validity_relation(db, User, Relatives, charlie, 4, 'PARENT')
+        result = check_validity_relation(db, User, Relatives, AncestryClosure, charlie, 4, 'PARENT')
         assert result == False
 
         # TEST 4: IF A SPOUSE ALREADY EXISTS
         db.session.add(Relatives(user_id=3, relative_user_id=4, relation_type='SPOUSE'))
         db.session.commit()
-        result = check_validity_relation(db, User, Relatives, charlie, 4, 'SPOUSE')
-        assert result == False
\ No newline at end of file
+        result = check_validity_relation(db, User, Relatives, AncestryClosure, charlie, 4, 'SPOUSE')
+        assert result == False
+
+
+class TestRelativeDetails:
+    def test_single_query(self, db):
+        create_family(db, 4)
+        add_parent(db, 1, 2)
+        add_parent(db, 3, 1)
+        add_parent(db, 1, 4)
+        db.session.expunge_all()
+
+        with count_queries(db) as statements:
+            details, next_token = get_relative_details(db, Relatives, PersonDirectory, 1, limit=2)
+        assert len(statements) == 1
+        assert [(d['relative_user_id'], d['relationship'], d['display_name']) for d in details] == [
+            (2, 'PARENT', 'First2 Family'), (3, 'CHILD', 'First3 Family')
+        ]
+
+        details, next_token = get_relative_details(db, Relatives, PersonDirectory, 1, after=next_token, limit=2)
+        assert [d['relative_user_id'] for d in details] == [4]
+        assert next_token is None
+
+
+class TestProfileOverview:
+    def test_gathers_every_section(self, tmp_path):
+        # Concurrent lookups each take their own pooled connection, so the
+        # database has to be a file rather than the shared in-memory one
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/family.db'
+
+        app = create_app(config_class=FileConfig)
+        with app.app_context():
+            db.create_all()
+            create_family(db, 2)
+            add_parent(db, 1, 2)
+            db.session.add(Address(user_id=1, is_permanent=True, first_line='First Street',
+                                   pin_code=1, state='State', country='Country'))
+            db.session.add(ContactDetails(user_id=1, country_code=91, mobile_no='12345'))
+            db.session.commit()
+
+            overview = get_profile_overview(
+                db, Person, Address, ImportantDates, ContactDetails, Relatives, 1)
+            assert overview['person'].first_name == 'First1'
+            assert [address.first_line for address in overview['addresses']] == ['First Street']
+            assert overview['important_dates'] == []
+            assert [contact.mobile_no for contact in overview['contact_details']] == ['12345']
+            assert [tuple(row[:3]) for row in overview['relatives']] == [
+                (2, RelativesTypeEnum.PARENT, 'First2')
+            ]
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+        app.extensions['read_executor'].shutdown()
+
+    def test_lookups_run_at_once(self, tmp_path, monkeypatch):
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/family.db'
+
+        app = create_app(config_class=FileConfig)
+        # Each lookup waits for all the others, which only works if every
+        # one of them has a worker thread of its own
+        barrier = threading.Barrier(5, timeout=5)
+        gather = cursor.gather
+
+        def gather_at_once(db, **lookups):
+            def waiting(lookup):
+                def run(db):
+                    barrier.wait()
+                    return lookup(db)
+                return run
+            assert len(lookups) == 5
+            return gather(db, **{name: waiting(lookup) for name, lookup in lookups.items()})
+
+        monkeypatch.setattr('family_tree.services.user.cursor.gather', gather_at_once)
+        with app.app_context():
+            db.create_all()
+            create_family(db, 1)
+            overview = get_profile_overview(
+                db, Person, Address, ImportantDates, ContactDetails, Relatives, 1)
+            assert overview['person'].first_name == 'First1'
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+        app.extensions['read_executor'].shutdown()
+
+
+class TestPersonDirectory:
+    def directory(self):
+        return {entry.user_id: (entry.display_name, entry.sort_key, entry.picture_filename,
+                                entry.generation) for entry in PersonDirectory.query.all()}
+
+    def test_follows_person_and_picture_writes(self, db):
+        create_family(db, 3)
+        assert self.directory()[1] == ('First1 Family', 'family first1', None, 0)
+
+        person = Person.query.filter_by(user_id=1).first()
+        person.last_name = 'Renamed'
+        db.session.add(Picture(user_id=1, picture_filename='one.png'))
+        db.session.commit()
+        assert self.directory()[1] == ('First1 Renamed', 'renamed first1', 'one.png', 0)
+
+        # Generations are written with Core statements
+        add_parent(db, 2, 3)
+        rebuild_generations(db, Person, Relatives)
+        assert self.directory()[2][3] == 1
+
+        db.session.delete(User.query.filter_by(id=3).first())
+        db.session.commit()
+        assert sorted(self.directory()) == [1, 2]
+
+    def test_follows_core_writes(self, db):
+        create_family(db, 3)
+        cursor.update(db, Person, Person.query.filter_by(user_id=1).first().id, last_name='Renamed')
+        assert self.directory()[1] == ('First1 Renamed', 'renamed first1', None, 0)
+
+        cursor.bulk_add(db, Picture, [{'user_id': 2, 'picture_filename': 'two.png'}])
+        assert self.directory()[2][2] == 'two.png'
+
+        cursor.bulk_delete(db, Person, user_id=3)
+        assert sorted(self.directory()) == [1, 2]
+
+    def test_rebuild(self, db):
+        create_family(db, 3)
+        db.session.execute(PersonDirectory.__table__.delete())
+        db.session.commit()
+        assert rebuild_directory(db, PersonDirectory, Person, Picture) == 3
+        assert self.directory()[3] == ('First3 Family', 'family first3', None, 0)
+
+
+class TestNameSearch:
+    def add_people(self, db, names):
+        for user_id, (first_name, last_name) in enumerate(names, start=1):
+            db.session.add(User(id=user_id, username=f'user{user_id}', email=f'user{user_id}@example.com',
+                                password_hash='x'))
+            db.session.add(Person(user_id=user_id, first_name=first_name, last_name=last_name,
+                                  gender=GenderEnum.FEMALE))
+        db.session.commit()
+
+    def names(self, db, query):
+        return [result['name'] for result in search_people(db, Person, query)]
+
+    def test_prefix_typo_and_phonetic(self, db):
+        self.add_people(db, [('Banri', 'Lyngdoh'), ('Iba', 'Kharkongor'),
+                             ('Daphi', 'Lingdoh'), ('Wanda', 'Syiem')])
+        assert self.names(db, 'lyng') == ['Banri Lyngdoh']
+        assert self.names(db, 'ban lyng') == ['Banri Lyngdoh']
+        # Misspelt
+        assert self.names(db, 'Kharkonger') == ['Iba Kharkongor']
+        # Sounds alike; the exact prefix ranks first
+        assert self.names(db, 'Lyngdoh') == ['Banri Lyngdoh', 'Daphi Lingdoh']
+        assert self.names(db, 'Siem') == ['Wanda Syiem']
+        # Too short to search
+        assert self.names(db, 'ly') == []
+
+    def test_index_follows_writes(self, db):
+        self.add_people(db, [('Banri', 'Lyngdoh')])
+        person = Person.query.filter_by(user_id=1).first()
+        person.last_name = 'Marbaniang'
+        db.session.commit()
+        assert self.names(db, 'marb') == ['Banri Marbaniang']
+        assert self.names(db, 'lyngdoh') == []
+
+        db.session.delete(person)
+        db.session.commit()
+        assert self.names(db, 'marb') == []
+
+        db.session.add(Person(user_id=1, first_name='Banri', last_name='Nongrum',
+                              gender=GenderEnum.FEMALE))
+        db.session.commit()
+        assert rebuild_search_index(db, Person) == 1
+        assert self.names(db, 'nong') == ['Banri Nongrum']
+
+    def test_index_follows_core_writes(self, db):
+        self.add_people(db, [('Banri', 'Lyngdoh'), ('Iba', 'Syiem')])
+        cursor.update(db, Person, Person.query.filter_by(user_id=1).first().id,
+                      last_name='Marbaniang')
+        assert self.names(db, 'marb') == ['Banri Marbaniang']
+        assert self.names(db, 'lyngdoh') == []
+
+        cursor.bulk_upsert(db, Person, [{'id': Person.query.filter_by(user_id=2).first().id,
+                                         'user_id': 2, 'first_name': 'Iba', 'last_name': 'Nongrum',
+                                         'gender': GenderEnum.FEMALE}], ['id'])
+        assert self.names(db, 'nong') == ['Iba Nongrum']
+        assert self.names(db, 'syiem') == []
+
+    def test_soundex(self):
+        assert soundex('Robert') == soundex('Rupert') == 'R163'
+        assert soundex('Ashcraft') == 'A261'
+        assert soundex('Tymczak') == 'T522'
+
+
+class TestNameIndex:
+    def names(self, db, query, **kwargs):
+        return [result['name'] for result in get_name_index(db).complete(query, **kwargs)]
+
+    def test_prefix_matches(self, db):
+        TestNameSearch().add_people(db, [('Banri', 'Lyngdoh'), ('Iba', 'Lyngdoh'),
+                                         ('Daphi', 'Lingdoh'), ('Lynda', 'Syiem')])
+        # Ordered by the matched name, then last and first name
+        assert self.names(db, 'lyn') == ['Lynda Syiem', 'Banri Lyngdoh', 'Iba Lyngdoh']
+        assert self.names(db, 'L') == ['Daphi Lingdoh', 'Lynda Syiem',
+                                       'Banri Lyngdoh', 'Iba Lyngdoh']
+        assert self.names(db, 'lyngdoh i') == ['Iba Lyngdoh']
+        assert self.names(db, 'lyn', limit=1) == ['Lynda Syiem']
+        assert self.names(db, 'lyn', exclude=(4,)) == ['Banri Lyngdoh', 'Iba Lyngdoh']
+        assert self.names(db, 'x') == []
+        assert self.names(db, '') == []
+
+    def test_index_follows_writes(self, db):
+        TestNameSearch().add_people(db, [('Banri', 'Lyngdoh')])
+        index = get_name_index(db)
+        person = Person.query.filter_by(user_id=1).first()
+        person.last_name = 'Marbaniang'
+        person.middle_name = 'Kyntiew'
+        db.session.commit()
+        assert self.names(db, 'marb') == ['Banri Marbaniang']
+        assert self.names(db, 'kyn') == ['Banri Marbaniang']
+        assert self.names(db, 'lyng') == []
+
+        db.session.delete(person)
+        db.session.commit()
+        assert self.names(db, 'banri') == []
+        assert len(index) == 0
+        # Entries were updated in place, not reloaded
+        assert get_name_index(db) is index
+
+    def test_index_follows_committed_writes_only(self, db):
+        TestNameSearch().add_people(db, [('Banri', 'Lyngdoh'), ('Iba', 'Syiem')])
+        get_name_index(db)
+        person = Person.query.filter_by(user_id=1).first()
+        person.last_name = 'Marbaniang'
+        db.session.flush()
+        assert self.names(db, 'marb') == []
+        db.session.rollback()
+        assert self.names(db, 'marb') == []
+        assert self.names(db, 'lyng') == ['Banri Lyngdoh']
+
+        # Core writes are picked up as well
+        cursor.update(db, Person, Person.query.filter_by(user_id=2).first().id,
+                      last_name='Nongrum')
+        assert self.names(db, 'nong') == ['Iba Nongrum']
+        cursor.bulk_delete(db, Person, user_id=1)
+        assert self.names(db, 'lyng') == []
+
+
+class TestKinshipService:
+    def test_blood_label(self):
+        assert blood_label(1, 0, GenderEnum.MALE) == 'father'
+        assert blood_label(3, 0, GenderEnum.FEMALE) == 'great-grandmother'
+        assert blood_label(0, 2) == 'grandchild'
+        assert blood_label(1, 1, GenderEnum.FEMALE, half=True) == 'half-sister'
+        assert blood_label(3, 1, GenderEnum.FEMALE) == 'great-aunt'
+        assert blood_label(1, 2, GenderEnum.MALE) == 'nephew'
+        assert blood_label(2, 2) == 'first cousin'
+        assert blood_label(3, 4) == 'second cousin once removed'
+        assert blood_label(2, 5) == 'first cousin thrice removed'
+        assert blood_label(2, 1, GenderEnum.MALE, half=True) == 'half-uncle'
+        assert blood_label(2, 2, half=True) == 'half-first cousin'
+
+    def test_describe_relationship(self):
+        assert describe_relationship([RelativesTypeEnum.SPOUSE, RelativesTypeEnum.PARENT],
+                                     GenderEnum.FEMALE) == 'mother-in-law'
+        assert describe_relationship([RelativesTypeEnum.CHILD, RelativesTypeEnum.SPOUSE],
+                                     GenderEnum.MALE) == 'son-in-law'
+        assert describe_relationship([RelativesTypeEnum.PARENT, RelativesTypeEnum.STEPCHILD],
+                                     GenderEnum.MALE) == "parent's stepson"
+        assert describe_relationship([RelativesTypeEnum.PARENT, RelativesTypeEnum.SIBLING,
+                                      RelativesTypeEnum.CHILD]) == 'first cousin'
+
+    def test_find_relationship(self, db):
+        # 1 is the grandparent of 4 through 2 and of 5 through 3
+        create_family(db, 6)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 1)
+        add_parent(db, 4, 2)
+        add_parent(db, 5, 3)
+
+        result = find_relationship(db, Person, 4, 3)
+        assert result['label'] == 'uncle'
+        assert [step['user_id'] for step in result['path']] == [4, 2, 1, 3]
+
+        assert find_relationship(db, Person, 4, 5)['label'] == 'first cousin'
+        assert find_relationship(db, Person, 4, 6) is None
+
+    def test_path_cache_invalidation(self, db):
+        # 1 and 2 are married; paths between in-laws go through the BFS cache
+        create_family(db, 3)
+        db.session.add(Relatives(user_id=1, relative_user_id=2, relation_type='SPOUSE'))
+        db.session.add(Relatives(user_id=2, relative_user_id=1, relation_type='SPOUSE'))
+        db.session.commit()
+
+        user = User.query.filter_by(id=3).first()
+        assert find_relationship(db, Person, 2, 1)['label'] == 'husband'
+        cache = get_path_cache()
+        assert len(cache) == 1
+
+        # Adding a relation clears every cached path
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 2, 'relation_type': 'PARENT'}))
+        add_relative_to_database(
+            db, Relatives, RelativesTypeEnum, AncestryClosure, Person, user, form)
+        assert len(cache) == 0
+        assert find_relationship(db, Person, 3, 1)['label'] == "parent's husband"
+
+        # Removing it drops the cached paths that touch either user
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, user, 2)
+        assert cache.get((3, 1)) == (False, None)
+        assert find_relationship(db, Person, 3, 1) is None
+        assert get_graph(db).spouses(2) == [1]
+
+    def test_other_workers_relations_are_found(self, worker_apps):
+        first, second = worker_apps
+        with first.app_context():
+            create_family(db, 2)
+            assert find_relationship(db, Person, 2, 1) is None
+        with second.app_context():
+            db.session.add(Relatives(user_id=1, relative_user_id=2, relation_type='SPOUSE'))
+            db.session.add(Relatives(user_id=2, relative_user_id=1, relation_type='SPOUSE'))
+            db.session.commit()
+        with first.app_context():
+            assert find_relationship(db, Person, 2, 1)['label'] == 'husband'
+
+    def test_blood_relatives_use_common_ancestor(self, db):
+        # 3 and 4 are first cousins through grandparent 1; 3 also married 4's brother 5
+        create_family(db, 6)
+        add_parent(db, 2, 1)
+        add_parent(db, 6, 1)
+        add_parent(db, 3, 2)
+        add_parent(db, 4, 6)
+        add_parent(db, 5, 6)
+        db.session.add(Relatives(user_id=3, relative_user_id=5, relation_type='SPOUSE'))
+        db.session.add(Relatives(user_id=5, relative_user_id=3, relation_type='SPOUSE'))
+        db.session.commit()
+
+        result = find_relationship(db, Person, 3, 4)
+        assert result['label'] == 'first cousin'
+        assert [step['user_id'] for step in result['path']] == [3, 2, 1, 6, 4]
+
+
+    def test_half_relatives(self, db):
+        # 1 is the father of 2 and 3, whose mothers are 4 and 5; 6 is the son of 2 and 7 of 3
+        create_family(db, 8)
+        add_parent(db, 2, 1)
+        add_parent(db, 2, 4)
+        add_parent(db, 8, 1)
+        add_parent(db, 8, 4)
+        add_parent(db, 3, 1)
+        add_parent(db, 3, 5)
+        add_parent(db, 6, 2)
+        add_parent(db, 7, 3)
+
+        result = find_relationship(db, Person, 2, 3)
+        assert result['label'] == 'half-brother'
+        assert [step['user_id'] for step in result['path']] == [2, 1, 3]
+        assert find_relationship(db, Person, 6, 3)['label'] == 'half-uncle'
+        assert find_relationship(db, Person, 6, 7)['label'] == 'half-first cousin'
+
+        # 8 shares both parents with 2
+        assert find_relationship(db, Person, 2, 8)['label'] == 'sister'
+
+
+class TestClosureService:
+    def closure(self):
+        return sorted((row.ancestor_id, row.descendant_id, row.depth)
+                      for row in AncestryClosure.query.all())
+
+    def add_parent(self, db, child_id, parent_id):
+        child = User.query.filter_by(id=child_id).first()
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': parent_id, 'relation_type': 'PARENT'}))
+        add_relative_to_database(
+            db, Relatives, RelativesTypeEnum, AncestryClosure, Person, child, form)
+
+    def test_closure_follows_relatives(self, db):
+        create_family(db, 5)
+        self.add_parent(db, 2, 1)
+        self.add_parent(db, 3, 2)
+        assert self.closure() == [(1, 2, 1), (1, 3, 2), (2, 3, 1)]
+
+        # Adding a parent above an existing subtree extends every descendant
+        self.add_parent(db, 1, 4)
+        assert self.closure() == [(1, 2, 1), (1, 3, 2), (2, 3, 1),
+                                  (4, 1, 1), (4, 2, 2), (4, 3, 3)]
+
+        # A CHILD relation added from the parent's side is the same edge
+        parent = User.query.filter_by(id=3).first()
+        form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 5, 'relation_type': 'CHILD'}))
+        add_relative_to_database(
+            db, Relatives, RelativesTypeEnum, AncestryClosure, Person, parent, form)
+        assert (4, 5, 4) in self.closure()
+
+        # Removing the middle edge cuts the lineage below it
+        two = User.query.filter_by(id=2).first()
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, two, 1)
+        assert self.closure() == [(2, 3, 1), (2, 5, 2), (3, 5, 1), (4, 1, 1)]
+
+    def test_large_subtree_is_refreshed_in_batches(self, db, monkeypatch):
+        monkeypatch.setattr('family_tree.services.closure.BULK_BATCH_SIZE', 2)
+        # 2 has children 3 to 6, whose other parent 7 is outside the subtree
+        create_family(db, 8)
+        for child_id in range(3, 7):
+            self.add_parent(db, child_id, 2)
+            self.add_parent(db, child_id, 7)
+
+        # Adding a parent above 2 rewrites the closure of all five below it
+        self.add_parent(db, 2, 1)
+        incremental = self.closure()
+        assert [row for row in incremental if row[0] == 1] == [
+            (1, 2, 1), (1, 3, 2), (1, 4, 2), (1, 5, 2), (1, 6, 2)]
+        rebuild_closure(db, AncestryClosure, Relatives)
+        assert self.closure() == incremental
+
+    def test_rebuild_closure(self, db):
+        # 4 descends from 1 both through 2 and, more closely, directly through 3
+        create_family(db, 4)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 2)
+        add_parent(db, 3, 1)
+        add_parent(db, 4, 3)
+
+        assert rebuild_closure(db, AncestryClosure, Relatives) == 6
+        assert self.closure() == [(1, 2, 1), (1, 3, 1), (1, 4, 2),
+                                  (2, 3, 1), (2, 4, 2), (3, 4, 1)]
+
+
+class TestLineageValidation:
+    def test_check_validity_rejects_cycles(self, app, db):
+        # 1 -> 2 -> 3 down the generations
+        create_family(db, 4)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 2)
+        rebuild_closure(db, AncestryClosure, Relatives)
+
+        one = User.query.filter_by(id=1).first()
+        three = User.query.filter_by(id=3).first()
+        with app.test_request_context():
+            # 3 cannot become a parent of their grandparent
+            assert check_validity_relation(db, User, Relatives, AncestryClosure, one, 3, 'PARENT') == False
+            # ... nor can 1 become a child of their grandchild
+            assert check_validity_relation(db, User, Relatives, AncestryClosure, three, 1, 'CHILD') == False
+            # A grandparent is not a sibling
+            assert check_validity_relation(db, User, Relatives, AncestryClosure, three, 1, 'SIBLING') == False
+            assert check_validity_relation(db, User, Relatives, AncestryClosure, one, 4, 'PARENT') == True
+
+    def test_audit_relatives(self, db):
+        create_family(db, 7)
+        add_parent(db, 2, 1)
+        add_parent(db, 7, 2)
+        add_parent(db, 1, 7)
+        # Three parents for 3, two of them male
+        add_parent(db, 3, 4)
+        add_parent(db, 3, 5)
+        add_parent(db, 3, 6)
+        # Reverse row missing
+        db.session.add(Relatives(user_id=6, relative_user_id=4, relation_type='SPOUSE'))
+        db.session.commit()
+
+        issues = {(issue['issue'], tuple(issue['user_ids'])) for issue in
+                  audit_relatives(db, Relatives, Person, AncestryClosure)}
+        assert issues == {
+            ('ancestry_cycle', (1, 2, 7)),
+            ('too_many_parents', (3, 4, 5, 6)),
+            ('same_gender_parents', (3, 4, 5, 6)),
+            ('missing_reverse', (6, 4)),
+            # The rows were written directly, so generations were never layered
+            ('stale_generation', (3,))
+        }
+
+
+class TestGenerations:
+    def generations(self):
+        return {person.user_id: person.generation for person in Person.query.all()}
+
+    def relate(self, db, user_id, relative_user_id, relation_type):
+        user = User.query.filter_by(id=user_id).first()
+        form = UpsertRelativeForm(formdata=MultiDict({
+            'relative_user_id': relative_user_id, 'relation_type': relation_type}))
+        add_relative_to_database(
+            db, Relatives, RelativesTypeEnum, AncestryClosure, Person, user, form)
+
+    def test_generations_follow_relations(self, db):
+        create_family(db, 6)
+        # 1 and 2 are 3's parents; 4 married into the family and has 5 with 3;
+        # 6 married 5 and has no children
+        self.relate(db, 3, 1, 'PARENT')
+        self.relate(db, 3, 2, 'PARENT')
+        self.relate(db, 5, 3, 'PARENT')
+        self.relate(db, 5, 4, 'PARENT')
+        self.relate(db, 6, 5, 'SPOUSE')
+        assert self.generations() == {1: 0, 2: 0, 3: 1, 4: 1, 5: 2, 6: 2}
+        assert [p.user_id for p in same_generation(db, Person, 3)] == [4]
+        assert [p.user_id for p in same_generation(db, Person, 6)] == [5]
+
+        # Cutting 3 off from their parents makes 3 and 4 the oldest generation
+        three = User.query.filter_by(id=3).first()
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, three, 1)
+        delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, three, 2)
+        assert self.generations() == {1: 0, 2: 0, 3: 0, 4: 0, 5: 1, 6: 1}
+        assert same_generation(db, Person, 1) == []
+
+    def test_same_generation_of_a_large_family(self, db, monkeypatch):
+        monkeypatch.setattr('family_tree.services.generation.BULK_BATCH_SIZE', 2)
+        create_family(db, 6)
+        for child_id in range(2, 7):
+            self.relate(db, child_id, 1, 'PARENT')
+
+        with count_queries(db) as statements:
+            assert [p.user_id for p in same_generation(db, Person, 2)] == [3, 4, 5, 6]
+        # The five other members are read two at a time
+        assert sum('person.user_id IN' in statement for statement in statements) == 3
+
+    def test_only_affected_people_are_relayered(self, db, monkeypatch):
+        create_family(db, 6)
+        # 2 and 3 are 1's children; 3's stored generation is off
+        self.relate(db, 2, 1, 'PARENT')
+        self.relate(db, 3, 1, 'PARENT')
+        Person.query.filter_by(user_id=3).first().generation = 7
+        db.session.commit()
+
+        locked = []
+        monkeypatch.setattr('family_tree.graph.stored_version', lambda db, for_update=False: (
+            locked.append(for_update), stored_version(db, for_update))[1])
+        # 5 joins below 2 and 6 marries 5; 3's branch is not re-layered
+        self.relate(db, 5, 2, 'PARENT')
+        self.relate(db, 6, 5, 'SPOUSE')
+        assert self.generations() == {1: 0, 2: 1, 3: 7, 4: 0, 5: 2, 6: 2}
+        # The graph version is checked, but never locked
+        assert locked and not any(locked)
+
+    def test_generations_use_current_relations(self, worker_apps):
+        first, second = worker_apps
+        with first.app_context():
+            create_family(db, 4)
+        with first.test_request_context():
+            # The first worker loads its graph, then the second one adds a
+            # 1 -> 2 -> 3 line behind its back within the same request
+            get_graph(db)
+            with second.app_context():
+                self.relate(db, 2, 1, 'PARENT')
+                self.relate(db, 3, 2, 'PARENT')
+            self.relate(db, 4, 3, 'PARENT')
+            assert self.generations() == {1: 0, 2: 1, 3: 2, 4: 3}
+
+    def test_rebuild_generations(self, db):
+        create_family(db, 4)
+        add_parent(db, 2, 1)
+        add_parent(db, 3, 2)
+        Person.query.filter_by(user_id=4).first().generation = 7
+        db.session.commit()
+
+        with count_queries(db) as statements:
+            assert rebuild_generations(db, Person, Relatives) == 3
+        assert self.generations() == {1: 0, 2: 1, 3: 2, 4: 0}
+        # Related people are found with a subquery rather than a list of every related id
+        assert not any('NOT IN' in statement.upper() for statement in statements)
+        assert any('EXISTS' in statement.upper() for statement in statements)
+        assert rebuild_generations(db, Person, Relatives) == 0
+
+    def test_audit_birth_order(self, db):
+        create_family(db, 2)
+        add_parent(db, 2, 1)
+        rebuild_generations(db, Person, Relatives)
+        db.session.add(ImportantDates(user_id=1, date_type='BIRTH', date=date(1990, 5, 1)))
+        db.session.add(ImportantDates(user_id=2, date_type='BIRTH', date=date(1960, 5, 1)))
+        db.session.commit()
+
+        issues = audit_relatives(db, Relatives, Person, AncestryClosure, ImportantDates)
+        assert [(issue['issue'], issue['user_ids']) for issue in issues] == [
+            ('parent_born_after_child', [2, 1])
+        ]
+
+
+class TestCharts:
+    def test_tidy_layout(self):
+        # 1 has children 2 and 3; 2 has children 4, 5 and 6; 3 has child 7
+        graph = KinshipGraph()
+        graph.load_rows([(2, 1, 'PARENT'), (3, 1, 'PARENT'), (4, 2, 'PARENT'),
+                         (5, 2, 'PARENT'), (6, 2, 'PARENT'), (7, 3, 'PARENT')])
+        nodes = build_tree(graph, 1, 'descendants', 3)
+        slots = dict(zip((node[0] for node in nodes), tidy_layout(nodes)))
+        assert slots == {1: (2.0, 0), 2: (1.0, 1), 3: (3.0, 1),
+                         4: (0.0, 2), 5: (1.0, 2), 6: (2.0, 2), 7: (3.0, 2)}
+
+        # Generations are capped and the pedigree goes the other way
+        assert [node[0] for node in build_tree(graph, 1, 'descendants', 2)] == [1, 2, 3]
+        assert [node[0] for node in build_tree(graph, 7, 'pedigree', 4)] == [7, 3, 1]
+
+    def test_chart_cache(self, app, db):
+        create_family(db, 3)
+        add_parent(db, 2, 1)
+        with app.test_request_context():
+            svg = render_chart(db, Person, 2, 'pedigree', 3)
+            assert 'First1 Family' in svg and 'First3' not in svg
+            cache = get_chart_cache(db)
+            assert len(cache) == 1
+            assert render_chart(db, Person, 2, 'pedigree', 3) is svg
+
+            # Renaming someone in the family re-renders the chart
+            form = UpsertPersonForm(formdata=MultiDict({
+                'first_name': 'Renamed', 'last_name': 'Family', 'gender': 'MALE'}))
+            update_person(db, User.query.filter_by(id=1).first(), form)
+            svg = render_chart(db, Person, 2, 'pedigree', 3)
+            assert 'Renamed Family' in svg
+
+            # So does a new relation
+            two = User.query.filter_by(id=2).first()
+            form = UpsertRelativeForm(formdata=MultiDict({'relative_user_id': 3, 'relation_type': 'PARENT'}))
+            add_relative_to_database(
+                db, Relatives, RelativesTypeEnum, AncestryClosure, Person, two, form)
+            assert 'First3 Family' in render_chart(db, Person, 2, 'pedigree', 3)
+
+            # Removing it drops every cached chart
+            delete_relative_from_database(db, User, Relatives, AncestryClosure, Person, two, 3)
+            assert len(cache) == 0
+            assert 'First3' not in render_chart(db, Person, 2, 'pedigree', 3)
+
+    def test_charts_follow_other_workers(self, worker_apps):
+        first, second = worker_apps
+        # Renames made by another worker only show once the cached chart expires
+        first.config['CHART_CACHE_TTL'] = 0
+        with first.test_request_context():
+            create_family(db, 3)
+            add_parent(db, 2, 1)
+            assert 'First1 Family' in render_chart(db, Person, 2, 'pedigree', 3)
+        with second.app_context():
+            form = UpsertPersonForm(formdata=MultiDict({
+                'first_name': 'Renamed', 'last_name': 'Family', 'gender': 'MALE'}))
+            update_person(db, db.session.get(User, 1), form)
+        with first.test_request_context():
+            assert 'Renamed Family' in render_chart(db, Person, 2, 'pedigree', 3)
+
+            # New relations show right away through the graph version
+            get_chart_cache(db).ttl = 60
+            assert 'First3' not in render_chart(db, Person, 2, 'pedigree', 3)
+        with second.app_context():
+            add_parent(db, 2, 3)
+        with first.test_request_context():
+            assert 'First3 Family' in render_chart(db, Person, 2, 'pedigree', 3)